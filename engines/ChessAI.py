@@ -1,10 +1,20 @@
 """
 Handling the AI moves.
 """
+import itertools
+import math
 import random
+import time
 import chess
+import chess.engine
+import chess.polyglot
+from queue import Queue
+from collections.abc import Callable, Iterable, Iterator
+from typing import Optional, Protocol
+from .transposition import TranspositionTable, push_with_key, EXACT, LOWER, UPPER
+from .pawns import PawnHashTable, king_shield, pawn_key, update_pawn_key
 
-piece_score = {"K": 0, "Q": 9, "R": 5, "B": 3, "N": 3, "p": 1}
+piece_score = {"K": 0, "Q": 9, "R": 5, "B": 3, "N": 3, "P": 1}
 
 knight_scores = [[0.0, 0.1, 0.2, 0.2, 0.2, 0.2, 0.1, 0.0],
                  [0.1, 0.3, 0.5, 0.5, 0.5, 0.5, 0.3, 0.1],
@@ -59,18 +69,88 @@ piece_position_scores = {"wN": knight_scores,
                          "bQ": queen_scores[::-1],
                          "wR": rook_scores,
                          "bR": rook_scores[::-1],
-                         "wp": pawn_scores,
-                         "bp": pawn_scores[::-1]}
+                         "wP": pawn_scores,
+                         "bP": pawn_scores[::-1]}
+
+
+def build_piece_square_values() -> list[float]:
+    """
+    Flatten `piece_score` and `piece_position_scores` into one table.
+
+    The score of a piece on a square is at index `64 * (2 * (piece_type - 1) + color) + square` (the same order as the
+    Zobrist keys). Black's scores are negative, so the score of a position is the sum over its pieces.
+    """
+    values = [0.0] * 768
+    for piece_type in chess.PIECE_TYPES:
+        for color in chess.COLORS:
+            symbol = chess.piece_symbol(piece_type).upper()
+            position_scores = piece_position_scores.get(("w" if color == chess.WHITE else "b") + symbol)
+            sign = 1 if color == chess.WHITE else -1
+            for square in chess.SQUARES:
+                row = 7 - chess.square_rank(square)
+                col = chess.square_file(square)
+                position_score = position_scores[row][col] if position_scores else 0
+                values[64 * (2 * (piece_type - 1) + color) + square] = sign * (piece_score[symbol] + position_score)
+    return values
+
+
+piece_square_values = build_piece_square_values()
 
 CHECKMATE = 1000
 STALEMATE = 0
 DEPTH = 3
+MAX_PLY = 64
+# The size of the transposition table in MB, unless set by the `Hash` option in `homemade_options`.
+DEFAULT_HASH_SIZE = 64
+
+# A score this close to CHECKMATE can only come from a forced mate.
+MATE_THRESHOLD = CHECKMATE - MAX_PLY
+
+# Time management. Without a moves-to-go count from lichess, assume the game lasts this many more moves.
+MOVES_TO_GO = 30
+# Fraction of the increment that can be spent on each move.
+INCREMENT_USAGE = 0.75
+# The hard deadline is at most this many times the soft budget...
+HARD_LIMIT_FACTOR = 4
+# ...and never more than this fraction of the remaining clock.
+MAX_CLOCK_FRACTION = 0.25
+# With a fixed time per move, don't start a new iteration after this fraction of it has been used.
+MOVETIME_SOFT_FRACTION = 0.5
+# How often (in nodes) the search checks the clock.
+TIME_CHECK_INTERVAL = 256
+
+# Selective search. The width of a null window (in pawns). Scores are stored in the transposition table in centipawns,
+# with bounds rounded outwards, so a null window of one centipawn is the narrowest that stays sound.
+NULL_WINDOW = 0.01
+# Null-move pruning is tried from this depth, skipping this many plies (one more for deeper searches).
+NULL_MOVE_MIN_DEPTH = 3
+NULL_MOVE_REDUCTION = 2
+NULL_MOVE_DEEP_DEPTH = 7
+# Late move reductions start at this depth and move index.
+LMR_MIN_DEPTH = 3
+LMR_MIN_INDEX = 3
+# Quiescence search skips a capture if winning the captured piece and this much more can't raise the score to alpha.
+DELTA_MARGIN = 2
+# The value of a king in static exchange evaluation, so it is always the last piece to recapture.
+SEE_KING_VALUE = 100
 
 
 CAPTURE_BONUS = 1000
 PROMOTION_BONUS = 900
 CHECK_BONUS = 50
 
+# piece_score indexed by chess.PieceType.
+piece_values = [0] + [piece_score[chess.piece_symbol(piece_type).upper()] for piece_type in chess.PIECE_TYPES]
+
+
+def capture_score(board: chess.Board, move: chess.Move) -> int:
+    """Score a capture by MVV-LVA (Most Valuable Victim - Least Valuable Aggressor)."""
+    # En passant captures land on an empty square.
+    captured_value = piece_values[board.piece_type_at(move.to_square) or chess.PAWN]
+    moving_value = piece_values[board.piece_type_at(move.from_square) or chess.PAWN]
+    return CAPTURE_BONUS + captured_value * 10 - moving_value + (move.promotion or 0)
+
+
 def score_move(board: chess.Board, move: chess.Move) -> int:
     """
     Assign a score to a move based on heuristics.
@@ -78,200 +158,719 @@ def score_move(board: chess.Board, move: chess.Move) -> int:
     """
     score = 0
 
-    # 1. Captures (MVV-LVA: Most Valuable Victim - Least Valuable Aggressor)
+    # 1. Captures
     if board.is_capture(move):
-        # Get the piece being captured (victim)
-        captured_piece_type = board.piece_type_at(move.to_square)
-        captured_value = piece_score.get(chess.Piece(captured_piece_type, not board.turn).symbol().upper(), 0)
-
-        # Get the piece making the capture (aggressor)
-        moving_piece_type = board.piece_type_at(move.from_square)
-        moving_value = piece_score.get(chess.Piece(moving_piece_type, board.turn).symbol().upper(), 0)
-
-        # Calculate a score based on MVV-LVA. Higher value for captured piece, lower for moving piece.
-        score += CAPTURE_BONUS + (captured_value * 10) - moving_value
+        score += capture_score(board, move)
 
     # 2. Promotions
     if move.promotion is not None:
         # Give a big bonus for promotion, especially to a queen
-        promoted_value = piece_score.get(chess.Piece(move.promotion, board.turn).symbol().upper(), 0)
-        score += PROMOTION_BONUS + promoted_value
+        score += PROMOTION_BONUS + piece_values[move.promotion]
 
     # 3. Checks
-    # Temporarily make the move to see if it results in a check
-    board.push(move)
-    if board.is_check():
+    if board.gives_check(move):
         score += CHECK_BONUS
-    board.pop() 
 
     return score
 
-def quiescence_search(board: chess.Board, alpha: int, beta: int, turn_multiplier: int) -> int:
+
+def static_exchange(board: chess.Board, move: chess.Move) -> int:
     """
-    Performs a quiescence search to avoid the horizon effect.
-    Only evaluates 'noisy' moves (captures, checks, promotions).
+    Get the material won by a capture, by static exchange evaluation.
+
+    Both sides keep recapturing on the square with their least valuable piece, and either side can stop when
+    recapturing would lose material. Pieces behind the capturing pieces (e.g. a rook behind a rook) join in as the
+    squares in front of them empty. Pins are ignored.
+
+    :return: The material gained in pawns. A negative number means the capture loses material.
     """
-    # 1. Stand-pat evaluation: If the current position is already good enough,
-    # or it's a quiet position, return the static evaluation.
-    # This is also the base case if no noisy moves are found.
-    stand_pat = turn_multiplier * scoreBoard(board)
-    if stand_pat >= beta:
-        return beta # Prune this node, we've found a better path
-    if alpha < stand_pat:
-        alpha = stand_pat
-
-    # Generate only "noisy" moves: captures and potentially promotions.
-    # If the king is in check, ALL legal moves must be considered (evasions).
-    noisy_moves = []
-    if board.is_check():
-        # If in check, all legal moves are "noisy" as they are forced responses.
-        # It's important to order these too!
-        moves_to_search = list(board.legal_moves)
-        scored_moves = []
-        for move in moves_to_search:
-            score = score_move(board, move) # Reuse your move scoring for ordering
-            scored_moves.append((score, move))
-        scored_moves.sort(key=lambda x: x[0], reverse=True)
-        noisy_moves = [move for score, move in scored_moves]
+    to_square = move.to_square
+    occupied = board.occupied ^ chess.BB_SQUARES[move.from_square]
+    if board.is_en_passant(move):
+        captured_square = to_square - 8 if board.turn == chess.WHITE else to_square + 8
+        occupied ^= chess.BB_SQUARES[captured_square]
+        gains = [piece_values[chess.PAWN]]
     else:
-        # If not in check, only consider captures and promotions for quiescence
-        for move in board.legal_moves:
-            if board.is_capture(move) or move.promotion is not None:
-                noisy_moves.append(move)
-        
-        # Order the noisy moves (captures and promotions first)
-        # Re-using score_move is fine here as it prioritizes these.
-        scored_noisy_moves = []
-        for move in noisy_moves:
-            score = score_move(board, move)
-            scored_noisy_moves.append((score, move))
-        scored_noisy_moves.sort(key=lambda x: x[0], reverse=True)
-        noisy_moves = [move for score, move in scored_noisy_moves]
-
-    for move in noisy_moves:
-        board.push(move)
-        # Recursively call quiescence search for these noisy moves
-        # The depth doesn't explicitly decrease here, it continues until quiet.
-        score = -quiescence_search(board, -beta, -alpha, -turn_multiplier)
-        board.pop()
+        gains = [piece_values[board.piece_type_at(to_square) or 0]]
+    piece_type = move.promotion or board.piece_type_at(move.from_square) or chess.PAWN
+    if move.promotion:
+        gains[0] += piece_values[move.promotion] - piece_values[chess.PAWN]
+
+    color = not board.turn
+    while True:
+        attackers = board.attackers_mask(color, to_square, occupied) & occupied
+        if not attackers:
+            break
+        # The side to move gains the piece on the square, minus what the other side has gained so far.
+        gains.append((SEE_KING_VALUE if piece_type == chess.KING else piece_values[piece_type]) - gains[-1])
+        for piece_type in chess.PIECE_TYPES:
+            least_valuable = attackers & board.pieces_mask(piece_type, color)
+            if least_valuable:
+                break
+        occupied ^= chess.BB_SQUARES[chess.lsb(least_valuable)]
+        color = not color
+
+    # Each side only recaptures if it gains something.
+    for index in range(len(gains) - 1, 0, -1):
+        gains[index - 1] = -max(-gains[index - 1], gains[index])
+    return gains[0]
+
+
+def noisy_moves_worth_searching(board: chess.Board, stand_pat: float, alpha: float) -> list[chess.Move]:
+    """
+    Get the captures and promotions that the quiescence search should try, the best static exchange first.
 
-        if score >= beta:
-            return beta  # Beta cutoff
-        if score > alpha:
-            alpha = score # Update alpha (best score found so far for this node)
-
-    return alpha # Return the best score found for this node
-
-
-# def findBestMove(board, valid_moves, return_queue):
-#     global next_move
-#     next_move = None
-#     random.shuffle(valid_moves)
-#     findMoveNegaMaxAlphaBeta(board, valid_moves, DEPTH, -CHECKMATE, CHECKMATE,
-#                              1 if board.turn == chess.WHITE else -1)
-#     return_queue.put(next_move)
-
-
-def findBestMove(board, valid_moves, return_queue):
-    global next_move
-    next_move = None
-
-    # --- Start of Move Ordering ---
-    # Create a list of (score, move) tuples
-    scored_moves = []
-    for move in valid_moves:
-        score = score_move(board, move)
-        scored_moves.append((score, move))
-
-    # Sort moves in descending order of score
-    # The 'key=lambda x: x[0]' tells sorted() to sort based on the first element of each tuple (the score)
-    # 'reverse=True' ensures descending order (highest score first)
-    scored_moves.sort(key=lambda x: x[0], reverse=True)
-
-    # Extract only the moves in the new sorted order
-    ordered_moves = [move for score, move in scored_moves]
-    # --- End of Move Ordering ---
-
-    # Pass the ordered moves to the NegaMax function
-    findMoveNegaMaxAlphaBeta(board, ordered_moves, DEPTH, -CHECKMATE, CHECKMATE,
-                             1 if board.turn == chess.WHITE else -1)
-    return_queue.put(next_move)
-
-
-def findMoveNegaMaxAlphaBeta(board, valid_moves, depth, alpha, beta, turn_multiplier):
-    global next_move
-    
-    # Base case for the main search: call quiescence search instead of static evaluation
-    if depth == 0:
-        return quiescence_search(board, alpha, beta, turn_multiplier) # <--- CHANGE HERE
-
-    # No legal moves means checkmate or stalemate
-    if not valid_moves:
-        if board.is_checkmate():
-            # Current player is checkmated, so previous player wins
-            return -CHECKMATE
-        elif board.is_stalemate():
-            return STALEMATE
-        return turn_multiplier * scoreBoard(board) # Should ideally not be reached if board is terminal
-
-    max_score = -CHECKMATE # Use a very small number for initial max_score
-    for move in valid_moves:
-        board.push(move)
-        next_moves = list(board.legal_moves)
-        score = -findMoveNegaMaxAlphaBeta(board, next_moves, depth - 1, -beta, -alpha, -turn_multiplier)
-        if score > max_score:
-            max_score = score
-            if depth == DEPTH: # Only update next_move at the root depth
-                next_move = move
-        board.pop()
-        if max_score > alpha:
-            alpha = max_score
-        if alpha >= beta:
-            break # Alpha-beta cutoff
-    return max_score
+    Captures that lose material by static exchange evaluation are skipped, and so are captures that can't raise the
+    score to alpha even if the captured piece is won for free (delta pruning).
+
+    :param stand_pat: The static score of the position for the side to move.
+    :param alpha: The score the side to move already has.
+    """
+    promotion_squares = chess.BB_BACKRANKS & ~board.occupied
+    exchanges = []
+    for move in itertools.chain(board.generate_legal_captures(),
+                                board.generate_legal_moves(board.pawns, promotion_squares)):
+        # Delta pruning: even winning the captured piece for free isn't enough.
+        if (move.promotion is None and stand_pat + DELTA_MARGIN
+                + piece_values[board.piece_type_at(move.to_square) or chess.PAWN] <= alpha):
+            continue
+        gain = static_exchange(board, move)
+        if gain >= 0:
+            exchanges.append((gain, move))
+    exchanges.sort(key=lambda exchange: exchange[0], reverse=True)
+    return [move for _, move in exchanges]
+
+
+def order_moves(board: chess.Board, moves: list[chess.Move], *first_moves: Optional[chess.Move]) -> list[chess.Move]:
+    """
+    Sort moves from most to least promising according to `score_move`.
+
+    :param first_moves: Moves to search before all others (e.g. from the transposition table or the previous
+        iteration's PV). Later arguments go first.
+    """
+    ordered_moves = sorted(moves, key=lambda move: score_move(board, move), reverse=True)
+    for first_move in first_moves:
+        if first_move is not None and first_move in ordered_moves:
+            ordered_moves.remove(first_move)
+            ordered_moves.insert(0, first_move)
+    return ordered_moves
+
+
+def late_move_reduction(depth: int, index: int) -> int:
+    """Get how many plies to reduce the search of a late quiet move. Later moves at deeper nodes are reduced more."""
+    return max(1, int(0.75 + math.log(depth) * math.log(index) / 2.25))
+
+
+def score_to_tt(score: float, ply: int) -> float:
+    """Convert a mate score from distance-to-root to distance-to-this-position before storing it."""
+    if score >= MATE_THRESHOLD:
+        return score + ply
+    if score <= -MATE_THRESHOLD:
+        return score - ply
+    return score
+
+
+def score_from_tt(score: float, ply: int) -> float:
+    """Convert a mate score from the transposition table back to distance-to-root."""
+    if score >= MATE_THRESHOLD:
+        return score - ply
+    if score <= -MATE_THRESHOLD:
+        return score + ply
+    return score
 
 
+def engine_score(score: float) -> chess.engine.Score:
+    """Convert a search score in pawns to a python-chess score, e.g. to report it like a UCI engine."""
+    if score >= MATE_THRESHOLD:
+        return chess.engine.Mate((round(CHECKMATE - score) + 1) // 2)
+    if score <= -MATE_THRESHOLD:
+        return chess.engine.Mate(-(round(CHECKMATE + score) // 2))
+    return chess.engine.Cp(round(score * 100))
 
-def scoreBoard(board):
+
+def search_time_limits(board: chess.Board, time_limit: chess.engine.Limit) -> tuple[Optional[float], Optional[float]]:
     """
-    Score the board. A positive score is good for white, a negative score is good for black.
+    Split the time given by lichess-bot into a soft and a hard budget (in seconds).
+
+    No new iteration is started once the soft budget has been used, and the search is aborted at the hard budget.
+
+    :param board: The current position.
+    :param time_limit: The time constraints from lichess-bot.
+    :return: The soft and hard budgets. Both are `None` if `time_limit` doesn't limit the time.
     """
-    import chess
-    
-    if board.is_checkmate():
-        if board.turn == chess.WHITE:
-            return -CHECKMATE  # black wins
+    soft: Optional[float] = None
+    hard: Optional[float] = None
+
+    clock = time_limit.white_clock if board.turn == chess.WHITE else time_limit.black_clock
+    if clock is not None:
+        increment = (time_limit.white_inc if board.turn == chess.WHITE else time_limit.black_inc) or 0
+        moves_to_go = time_limit.remaining_moves or MOVES_TO_GO
+        soft = clock / moves_to_go + increment * INCREMENT_USAGE
+        hard = min(soft * HARD_LIMIT_FACTOR, clock * MAX_CLOCK_FRACTION + increment * INCREMENT_USAGE)
+        # Never plan on using time that isn't on the clock.
+        hard = min(hard, clock * 0.9)
+        soft = min(soft, hard)
+
+    if time_limit.time is not None:
+        soft = min(soft, time_limit.time * MOVETIME_SOFT_FRACTION) if soft is not None else (
+            time_limit.time * MOVETIME_SOFT_FRACTION)
+        hard = min(hard, time_limit.time) if hard is not None else time_limit.time
+
+    return soft, hard
+
+
+class SearchTimeoutError(Exception):
+    """Raised inside the search when the hard deadline has passed."""
+
+
+class Evaluator(Protocol):
+    """An evaluation that is kept up to date move by move during the search, like `engines.nnue.NNUEEvaluator`."""
+
+    def reset(self, board: chess.Board) -> None:
+        """Start a search at `board`."""
+
+    def push(self, board: chess.Board, move: chess.Move) -> None:
+        """Update the evaluation for a move that is about to be made on `board`."""
+
+    def pop(self) -> None:
+        """Go back to the position before the last move."""
+
+    def evaluate(self, board: chess.Board) -> float:
+        """Score the current position. A positive score is good for white, a negative score is good for black."""
+
+
+class Searcher:
+    """An iterative-deepening negamax search with alpha-beta pruning, quiescence search and a transposition table."""
+
+    def __init__(self, transposition_table: Optional[TranspositionTable] = None,
+                 evaluate_children: Optional[Callable[[chess.Board, list[chess.Move]], list[float]]] = None,
+                 pvs: bool = True, null_move: bool = True, late_move_reductions: bool = True,
+                 evaluator: Optional[Evaluator] = None, pawn_structure: bool = True) -> None:
+        """
+        Set up the per-search state.
+
+        :param transposition_table: The table to store search results in. Pass the same table to each search to reuse
+            results from the previous moves. If `None`, a table of `DEFAULT_HASH_SIZE` MB is created.
+        :param evaluate_children: A function that scores the positions after each of a list of moves in one call (e.g.
+            `engines.batch_evaluation.evaluate_children`). It is used for the nodes whose children are scored. If
+            `None`, the score is updated move by move.
+        :param pvs: Whether to use principal variation search (null-window searches of all but the first move).
+        :param null_move: Whether to use null-move pruning.
+        :param late_move_reductions: Whether to search late quiet moves to a lower depth.
+        :param evaluator: An evaluation to use instead of the material and position score (e.g.
+            `engines.nnue.NNUEEvaluator`). If it is set, `evaluate_children` isn't used.
+        :param pawn_structure: Whether to score doubled, isolated, passed, and shield pawns (see `engines/pawns.py`) on
+            top of the material and position score.
+        """
+        self.evaluator = evaluator
+        self.evaluate_children = evaluate_children if evaluator is None else None
+        self.pvs = pvs
+        self.null_move = null_move
+        self.late_move_reductions = late_move_reductions
+        self.tt = transposition_table if transposition_table is not None else TranspositionTable(DEFAULT_HASH_SIZE)
+        # Called every `TIME_CHECK_INTERVAL` nodes. The search stops if it returns `True`.
+        self.should_stop: Optional[Callable[[], bool]] = None
+        self.nodes = 0
+        # The nodes searched by quiescence search. These are also counted in `nodes`.
+        self.qnodes = 0
+        # The deepest ply reached, including quiescence search.
+        self.seldepth = 0
+        self.deadline: Optional[float] = None
+        self.key = 0
+        self.key_stack: list[int] = []
+        self.score = 0.0
+        self.score_stack: list[float] = []
+        # The pawn hash table is kept between searches, like the transposition table.
+        self.pawn_table = PawnHashTable() if pawn_structure and evaluator is None else None
+        self.pawn_key = 0
+        self.pawn_key_stack: list[int] = []
+        # The score of the best root move found so far in the current iteration.
+        self.root_score: float = -CHECKMATE
+        self.pv_table: list[list[chess.Move]] = [[] for _ in range(MAX_PLY + 1)]
+        # Two quiet moves per ply that recently caused a beta cutoff.
+        self.killers: list[list[Optional[chess.Move]]] = [[None, None] for _ in range(MAX_PLY + 1)]
+        # How often each quiet move caused a beta cutoff, weighted by depth, at index 4096 * color + 64 * from + to.
+        self.history = [0] * (2 * 64 * 64)
+        self.previous_pv: list[chess.Move] = []
+        self.follow_pv = False
+        # The moves that led to the position of the last search.
+        self.root_move_stack: list[chess.Move] = []
+        # (depth, nodes, seconds) when each iteration of the last search was completed.
+        self.iterations: list[tuple[int, int, float]] = []
+
+    def new_search(self, board: chess.Board) -> None:
+        """
+        Get ready to search a new position, keeping what was learned in earlier searches of the same game.
+
+        Transposition table entries from earlier searches are replaced first, and the history scores are halved, so
+        recent results count more. If `board` follows from the last position searched, the killer moves are shifted
+        to the plies they now apply to, and the rest of the principal variation is searched first if the game followed
+        it. Otherwise (e.g. after a takeback), the killer moves and the principal variation are forgotten.
+
+        :param board: The position that will be searched next.
+        """
+        self.tt.new_search()
+        if self.pawn_table is not None:
+            self.pawn_table.new_search()
+        self.nodes = 0
+        self.qnodes = 0
+        self.seldepth = 0
+        for index, value in enumerate(self.history):
+            self.history[index] = value // 2
+
+        old_stack = self.root_move_stack
+        played = len(board.move_stack) - len(old_stack)
+        if 0 <= played <= MAX_PLY and board.move_stack[:len(old_stack)] == old_stack:
+            new_moves = board.move_stack[len(old_stack):]
+            self.killers = self.killers[played:] + [[None, None] for _ in range(played)]
+            self.previous_pv = self.previous_pv[played:] if self.previous_pv[:played] == new_moves else []
         else:
-            return CHECKMATE  # white wins
-    elif board.is_stalemate():
-        return STALEMATE
-    
-    score = 0
-    for square in chess.SQUARES:
-        piece = board.piece_at(square)
-        if piece is not None:
-            piece_type = piece.symbol().upper()
-            piece_color = 'w' if piece.color == chess.WHITE else 'b'
-            piece_key = piece_color + piece_type
-            
-            # Convert square to row/col for position scoring
-            row = 7 - (square // 8)  # chess.py uses 0-63, we need 0-7 rows
-            col = square % 8
-            
-            piece_position_score = 0
-            if piece_type != "K":
-                if piece_key in piece_position_scores:
-                    piece_position_score = piece_position_scores[piece_key][row][col]
-            
-            if piece.color == chess.WHITE:
-                score += piece_score[piece_type] + piece_position_score
-            else:
-                score -= piece_score[piece_type] + piece_position_score
+            self.killers = [[None, None] for _ in range(MAX_PLY + 1)]
+            self.previous_pv = []
+        self.root_move_stack = board.move_stack[:]
+
+    def iterative_deepening(self, board: chess.Board, valid_moves: list[chess.Move],
+                            time_limit: Optional[chess.engine.Limit] = None,
+                            start_depth: int = 1,
+                            max_depth: Optional[int] = None) -> tuple[Optional[chess.Move], float, int]:
+        """
+        Search one ply deeper at a time until the time runs out.
+
+        Each iteration searches the previous iteration's principal variation first. If the hard deadline is reached
+        (or `should_stop` returns `True`) in the middle of an iteration, the search unwinds at once. The unfinished
+        iteration's best move is only used if it beat the previous iteration's best move.
+
+        Call `new_search` before searching each new position.
+
+        :param board: The current position.
+        :param valid_moves: The moves to choose from.
+        :param time_limit: The time constraints from lichess-bot. If it doesn't limit the time, search to `DEPTH` plies.
+        :param start_depth: The depth of the first iteration.
+        :param max_depth: The depth of the last iteration. If `None`, the time limit decides.
+        :return: The best move of the last completed iteration, its score for the side to move, and its depth. If no
+            iteration completed, the first of `valid_moves` is returned with a depth of 0.
+        """
+        soft, hard = search_time_limits(board, time_limit or chess.engine.Limit())
+        start = time.perf_counter()
+        self.deadline = start + hard if hard is not None else None
+        if max_depth is None:
+            max_depth = MAX_PLY if hard is not None else max(DEPTH, start_depth)
+        self.key = chess.polyglot.zobrist_hash(board)
+        self.key_stack = []
+        self.score = scoreBoard(board)
+        self.score_stack = []
+        if self.evaluator is not None:
+            self.evaluator.reset(board)
+        self.pawn_key = pawn_key(board)
+        self.pawn_key_stack = []
+
+        # If even the first iteration is aborted, play the first move rather than no move.
+        best_move: Optional[chess.Move] = valid_moves[0] if valid_moves else None
+        best_score: float = -CHECKMATE
+        completed_depth = 0
+        self.iterations = []
+        self.root_move_stack = board.move_stack[:]
+        for depth in range(start_depth, max_depth + 1):
+            self.follow_pv = True
+            try:
+                score = self.negamax(board, depth, -CHECKMATE, CHECKMATE, 0, valid_moves, pv_node=True)
+            except SearchTimeoutError:
+                # Unwind the moves made by the aborted iteration.
+                while self.key_stack:
+                    self.unmake(board)
+                # The previous best move is searched first, so a different best move in the aborted iteration was
+                # fully searched and proven better at this depth.
+                partial_pv = self.pv_table[0]
+                if partial_pv and partial_pv[0] != best_move:
+                    self.previous_pv = partial_pv[:]
+                    best_move = partial_pv[0]
+                    best_score = self.root_score
+                break
+
+            self.previous_pv = self.pv_table[0][:]
+            if self.previous_pv:
+                best_move = self.previous_pv[0]
+                best_score = score
+                completed_depth = depth
+            self.iterations.append((depth, self.nodes, time.perf_counter() - start))
+
+            if abs(score) >= MATE_THRESHOLD:
+                break
+            if soft is not None and time.perf_counter() - start >= soft:
+                break
+
+        return best_move, best_score, completed_depth
+
+    def check_time(self, ply: int) -> None:
+        """Count a node and abort the search if the hard deadline has passed or the search was told to stop."""
+        self.nodes += 1
+        self.seldepth = max(self.seldepth, ply)
+        if self.nodes % TIME_CHECK_INTERVAL == 0:
+            if self.deadline is not None and time.perf_counter() > self.deadline:
+                raise SearchTimeoutError
+            if self.should_stop is not None and self.should_stop():
+                raise SearchTimeoutError
+
+    def make(self, board: chess.Board, move: chess.Move, score: Optional[float] = None) -> None:
+        """
+        Make a move and update the Zobrist keys and the material and position score.
+
+        :param score: The score after the move, if it is already known.
+        """
+        self.key_stack.append(self.key)
+        self.score_stack.append(self.score)
+        new_pawn_key: Optional[int] = None
+        if self.pawn_table is not None:
+            self.pawn_key_stack.append(self.pawn_key)
+            new_pawn_key = update_pawn_key(board, move, self.pawn_key)
+        if self.evaluator is not None:
+            # The evaluator keeps its own state, so `score` isn't updated.
+            self.evaluator.push(board, move)
+            self.key = push_with_key(board, move, self.key)
+        elif score is None:
+            score_change = move_score_change(board, move)
+            self.key = push_with_key(board, move, self.key)
+            self.score = self.score + score_change if score_change is not None else scoreBoard(board)
+        else:
+            self.key = push_with_key(board, move, self.key)
+            self.score = score
+        if self.pawn_table is not None:
+            self.pawn_key = new_pawn_key if new_pawn_key is not None else pawn_key(board)
+
+    def child_scores(self, board: chess.Board, moves: list[chess.Move]) -> list[Optional[float]]:
+        """Score the positions after each move with `evaluate_children`, if it is set."""
+        if self.evaluate_children is None or not moves:
+            return [None] * len(moves)
+        return list(self.evaluate_children(board, moves))
+
+    def unmake(self, board: chess.Board) -> None:
+        """Take back the last move and restore the Zobrist key and the score."""
+        board.pop()
+        self.key = self.key_stack.pop()
+        self.score = self.score_stack.pop()
+        if self.evaluator is not None:
+            self.evaluator.pop()
+        if self.pawn_table is not None:
+            self.pawn_key = self.pawn_key_stack.pop()
+
+    def static_score(self, board: chess.Board) -> float:
+        """Get the static evaluation of the current position. A positive score is good for white."""
+        if self.evaluator is not None:
+            return self.evaluator.evaluate(board)
+        if self.pawn_table is None:
+            return self.score
+        return self.score + self.pawn_table.score(board, self.pawn_key) + king_shield(board)
+
+    def pv_move(self, ply: int) -> Optional[chess.Move]:
+        """Get the move from the previous iteration's PV at this ply, if we are still on that PV."""
+        if self.follow_pv and ply < len(self.previous_pv):
+            return self.previous_pv[ply]
+        self.follow_pv = False
+        return None
+
+    def staged_moves(self, board: chess.Board, ply: int, *first_moves: Optional[chess.Move]) -> Iterator[chess.Move]:
+        """
+        Generate the legal moves in the order they should be searched.
+
+        Each stage is only generated when the moves before it didn't cause a cutoff:
+
+        1. `first_moves` (e.g. the previous PV move and the hash move), if they are legal,
+        2. captures, by MVV-LVA,
+        3. killer moves,
+        4. the other quiet moves, promotions first and then by history score.
+        """
+        searched: list[chess.Move] = []
+        for move in first_moves:
+            if move is not None and move not in searched and board.is_legal(move):
+                searched.append(move)
+                yield move
+
+        captures = sorted(board.generate_legal_captures(), key=lambda move: capture_score(board, move), reverse=True)
+        for move in captures:
+            if move not in searched:
+                yield move
+
+        for move in self.killers[ply]:
+            if move is not None and move not in searched and not board.is_capture(move) and board.is_legal(move):
+                searched.append(move)
+                yield move
+
+        history = self.history
+        color_index = 4096 * board.turn
+        # Castling moves are generated as the king capturing its own rook, so the own pieces stay in the mask.
+        not_captures = chess.BB_ALL & ~board.occupied_co[not board.turn]
+        quiet_moves = [move for move in board.generate_legal_moves(chess.BB_ALL, not_captures)
+                       if move not in searched and not board.is_en_passant(move)]
+        quiet_moves.sort(key=lambda move: (move.promotion or 0,
+                                           history[color_index + 64 * move.from_square + move.to_square]),
+                         reverse=True)
+        yield from quiet_moves
+
+    def update_quiet_cutoff(self, board: chess.Board, move: chess.Move, depth: int, ply: int) -> None:
+        """Remember a quiet move that caused a beta cutoff in the killer and history tables."""
+        killers = self.killers[ply]
+        if killers[0] != move:
+            killers[1] = killers[0]
+            killers[0] = move
+        self.history[4096 * board.turn + 64 * move.from_square + move.to_square] += depth * depth
+
+    def negamax(self, board: chess.Board, depth: int, alpha: float, beta: float, ply: int,
+                root_moves: Optional[list[chess.Move]] = None, pv_node: bool = False) -> float:
+        """
+        Search the position with alpha-beta pruning.
+
+        :param ply: The distance from the root.
+        :param root_moves: At the root, the moves to choose from.
+        :param pv_node: Whether the position is on the principal variation: the root, the first move searched from a
+            principal variation node, and the full-window re-searches of PVS.
+        :return: The score of the position for the side to move.
+        """
+        self.check_time(ply)
+        self.pv_table[ply] = []
+
+        # Base case for the main search: call quiescence search instead of static evaluation
+        if depth == 0 or ply >= MAX_PLY:
+            return self.quiescence_search(board, alpha, beta, ply)
+
+        hash_move, tt_score = self.probe_tt(depth, alpha, beta, ply, pv_node)
+        if tt_score is not None:
+            return tt_score
+
+        in_check = board.is_check()
+        if self.null_move_cutoff(board, depth, beta, ply, in_check):
+            return beta
+
+        original_alpha = alpha
+        max_score: float = -CHECKMATE
+        best_move = None
+        moves, child_scores = self.node_moves(board, depth, ply, root_moves, hash_move)
+        index = -1
+        for index, (move, child_score) in enumerate(zip(moves, child_scores)):
+            quiet = not board.is_capture(move) and move.promotion is None
+            self.make(board, move, child_score)
+            score = self.search_child(board, depth, alpha, beta, ply, index, pv_node, quiet and not in_check)
+            self.unmake(board)
+            if index == 0:
+                # Only the first move at each node continues along the previous PV.
+                self.follow_pv = False
+            if score > max_score:
+                max_score = score
+                best_move = move
+                self.update_pv(move, score, ply)
+            alpha = max(alpha, max_score)
+            if alpha >= beta:
+                if quiet:
+                    self.update_quiet_cutoff(board, move, depth, ply)
+                break  # Alpha-beta cutoff
+
+        # No legal moves means checkmate or stalemate
+        if index < 0:
+            # Prefer quicker mates and slower losses.
+            return -CHECKMATE + ply if in_check else STALEMATE
+
+        bound = LOWER if max_score >= beta else UPPER if max_score <= original_alpha else EXACT
+        self.tt.store(self.key, depth, bound, score_to_tt(max_score, ply), best_move)
+        return max_score
+
+    def update_pv(self, move: chess.Move, score: float, ply: int) -> None:
+        """Make `move` and the principal variation after it the principal variation at `ply`."""
+        self.pv_table[ply] = [move] + self.pv_table[ply + 1]
+        if ply == 0:
+            self.root_score = score
+
+    def node_moves(self, board: chess.Board, depth: int, ply: int, root_moves: Optional[list[chess.Move]],
+                   hash_move: Optional[chess.Move]) -> tuple[Iterable[chess.Move], Iterable[Optional[float]]]:
+        """
+        Get the moves of a node in the order they are searched.
+
+        :param root_moves: At the root, the moves to choose from.
+        :param hash_move: The best move stored in the transposition table.
+        :return: The moves, and the score after each move if it is already known.
+        """
+        pv_move = self.pv_move(ply)
+        if root_moves is not None:
+            moves: Iterable[chess.Move] = order_moves(board, root_moves, hash_move, pv_move)
+        else:
+            moves = self.staged_moves(board, ply, pv_move, hash_move)
+        if depth == 1 and self.evaluate_children is not None:
+            # The children of depth 1 nodes are leaves, so score them all at once.
+            moves = list(moves)
+            return moves, self.child_scores(board, moves)
+        return moves, itertools.repeat(None)
+
+    def probe_tt(self, depth: int, alpha: float, beta: float, ply: int,
+                 pv_node: bool) -> tuple[Optional[chess.Move], Optional[float]]:
+        """
+        Look the current position up in the transposition table.
+
+        :return: The stored best move, and the stored score if it is deep enough and its bound cuts the search off.
+            Cutoffs are skipped in principal variation nodes, so the principal variation isn't cut short.
+        """
+        entry = self.tt.probe(self.key)
+        if entry is None:
+            return None, None
+        if not pv_node and entry.depth >= depth:
+            score = score_from_tt(entry.score, ply)
+            if (entry.bound == EXACT
+                    or entry.bound == LOWER and score >= beta
+                    or entry.bound == UPPER and score <= alpha):
+                return entry.move, score
+        return entry.move, None
+
+    def null_move_cutoff(self, board: chess.Board, depth: int, beta: float, ply: int, in_check: bool) -> bool:
+        """
+        Check whether the position fails high even if the side to move passes, in which case a real move would too.
+
+        This is unsound in zugzwang, which is common in pawn endings, so it's only tried when the side to move has a
+        piece.
+        """
+        if not (self.null_move and ply > 0 and not self.follow_pv and not in_check and depth >= NULL_MOVE_MIN_DEPTH
+                and beta < MATE_THRESHOLD and board.move_stack and board.move_stack[-1]
+                and (1 if board.turn == chess.WHITE else -1) * self.static_score(board) >= beta
+                and board.occupied_co[board.turn] & ~(board.pawns | board.kings)):
+            return False
+        reduction = NULL_MOVE_REDUCTION + (depth >= NULL_MOVE_DEEP_DEPTH)
+        self.make(board, chess.Move.null())
+        score = -self.negamax(board, max(depth - 1 - reduction, 0), -beta, -beta + NULL_WINDOW, ply + 1)
+        self.unmake(board)
+        return score >= beta
+
+    def search_child(self, board: chess.Board, depth: int, alpha: float, beta: float, ply: int, index: int,
+                     pv_node: bool, reducible: bool) -> float:
+        """
+        Search the position after a move, with principal variation search and late move reductions.
+
+        :param depth: The depth of the parent node.
+        :param index: The move's place in the move order. The first move is searched with the full window.
+        :param pv_node: Whether the parent node is on the principal variation.
+        :param reducible: Whether the move may be searched less deeply if it comes late.
+        :return: The score of the move for the side that made it.
+        """
+        if index == 0:
+            return -self.negamax(board, depth - 1, -beta, -alpha, ply + 1, pv_node=pv_node)
+        reduction = 0
+        if (self.late_move_reductions and depth >= LMR_MIN_DEPTH and index >= LMR_MIN_INDEX
+                and reducible and not board.is_check()):
+            reduction = min(late_move_reduction(depth, index), depth - 1)
+        # With PVS, later moves only need to be proven worse than the best so far.
+        window = NULL_WINDOW if self.pvs else beta - alpha
+        score = -self.negamax(board, depth - 1 - reduction, -alpha - window, -alpha, ply + 1)
+        if reduction and score > alpha:
+            score = -self.negamax(board, depth - 1, -alpha - window, -alpha, ply + 1)
+        if self.pvs and alpha < score < beta:
+            score = -self.negamax(board, depth - 1, -beta, -alpha, ply + 1, pv_node=pv_node)
+        return score
+
+    def quiescence_search(self, board: chess.Board, alpha: float, beta: float, ply: int) -> float:
+        """
+        Performs a quiescence search to avoid the horizon effect.
+        Only evaluates 'noisy' moves (captures, promotions, and check evasions). Captures that lose material by static
+        exchange evaluation, or that can't raise the score to alpha, are skipped.
+        """
+        self.check_time(ply)
+        self.qnodes += 1
+
+        entry = self.tt.probe(self.key)
+        if entry is not None:
+            score = score_from_tt(entry.score, ply)
+            if (entry.bound == EXACT
+                    or entry.bound == LOWER and score >= beta
+                    or entry.bound == UPPER and score <= alpha):
+                return score
+
+        original_alpha = alpha
+        if board.is_check():
+            # If the king is in check, ALL legal moves must be considered (evasions).
+            noisy_moves = order_moves(board, list(board.legal_moves))
+            if not noisy_moves:
+                return -CHECKMATE + ply
+        else:
+            # 1. Stand-pat evaluation: If the current position is already good enough,
+            # or it's a quiet position, return the static evaluation.
+            # This is also the base case if no noisy moves are found.
+            turn_multiplier = 1 if board.turn == chess.WHITE else -1
+            stand_pat = turn_multiplier * self.static_score(board)
+            if stand_pat >= beta:
+                return beta  # Prune this node, we've found a better path
+            alpha = max(alpha, stand_pat)
+            noisy_moves = noisy_moves_worth_searching(board, stand_pat, alpha)
+
+        best_move = None
+        for move, child_score in zip(noisy_moves, self.child_scores(board, noisy_moves)):
+            self.make(board, move, child_score)
+            # The depth doesn't explicitly decrease here, it continues until quiet.
+            score = -self.quiescence_search(board, -beta, -alpha, ply + 1)
+            self.unmake(board)
+
+            if score >= beta:
+                self.tt.store(self.key, 0, LOWER, score_to_tt(beta, ply), move)
+                return beta  # Beta cutoff
+            if score > alpha:
+                alpha = score  # Update alpha (best score found so far for this node)
+                best_move = move
+
+        bound = EXACT if alpha > original_alpha else UPPER
+        self.tt.store(self.key, 0, bound, score_to_tt(alpha, ply), best_move)
+        return alpha  # Return the best score found for this node
+
+
+def findBestMove(board: chess.Board, valid_moves: list[chess.Move], return_queue: Queue[Optional[chess.Move]],
+                 time_limit: Optional[chess.engine.Limit] = None,
+                 transposition_table: Optional[TranspositionTable] = None) -> None:
+    """
+    Search for the best move and put it in `return_queue`.
 
-    return score
+    :param time_limit: The time constraints from lichess-bot. If it doesn't limit the time, search to `DEPTH` plies.
+    :param transposition_table: The table to store search results in.
+    """
+    searcher = Searcher(transposition_table)
+    searcher.new_search(board)
+    best_move, _, _ = searcher.iterative_deepening(board, valid_moves, time_limit)
+    return_queue.put(best_move)
+
+
+def scoreBoard(board: chess.Board) -> float:
+    """
+    Score the material and piece positions on the board.
+
+    A positive score is good for white, a negative score is good for black. Checkmate and stalemate are not detected
+    here. The search finds them when a position has no legal moves.
+    """
+    values = piece_square_values
+    return sum(values[64 * (2 * (piece.piece_type - 1) + piece.color) + square]
+               for square, piece in board.piece_map().items())
+
+
+def move_score_change(board: chess.Board, move: chess.Move) -> Optional[float]:
+    """
+    Get how much `scoreBoard` changes when a move is made.
+
+    :param board: The position before the move.
+    :param move: The move to make.
+    :return: The change in score, or `None` for moves that are easier to score from scratch (castling, drops, and
+        variants).
+    """
+    if board.is_castling(move) or move.drop or board.uci_variant != "chess":
+        return None
+    if not move:
+        return 0.0
+
+    values = piece_square_values
+    color = board.turn
+    moving_piece = board.piece_type_at(move.from_square) or chess.PAWN
+    change = (values[64 * (2 * ((move.promotion or moving_piece) - 1) + color) + move.to_square]
+              - values[64 * (2 * (moving_piece - 1) + color) + move.from_square])
+    if board.is_en_passant(move):
+        captured_square = move.to_square - 8 if color == chess.WHITE else move.to_square + 8
+        change -= values[64 * (2 * (chess.PAWN - 1) + (not color)) + captured_square]
+    else:
+        captured_piece = board.piece_type_at(move.to_square)
+        if captured_piece:
+            change -= values[64 * (2 * (captured_piece - 1) + (not color)) + move.to_square]
+    return change
 
 
-def findRandomMove(valid_moves):
+def findRandomMove(valid_moves: list[chess.Move]) -> chess.Move:
     """
     Picks and returns a random valid move.
     """
@@ -1,20 +1,75 @@
 import chess
 from chess.engine import PlayResult, Limit
 from lib.engine_wrapper import MinimalEngine
-from lib.lichess_types import MOVE, HOMEMADE_ARGS_TYPE
+from lib.lichess_types import MOVE, COMMANDS_TYPE, OPTIONS_GO_EGTB_TYPE
+from lib.config import Configuration
+from lib import model
+from typing import Any, Optional
+from collections.abc import Callable
+import dataclasses
 import logging
-from queue import Queue
+import threading
+import time
 from . import ChessAI
+from .mate_solver import MateSolver
+from .smp import LazySMP
+from .transposition import TranspositionTable
 
 logger = logging.getLogger(__name__)
 
+# The share of the time budget the mate solver may use before the alpha-beta search starts.
+MATE_SOLVER_TIME_FRACTION = 0.1
+# The time the mate solver may use when the search has no time limit (in seconds).
+MATE_SOLVER_DEFAULT_TIME = 0.5
+
+
+def number_option(options: OPTIONS_GO_EGTB_TYPE, name: str, default: float) -> float:
+    """
+    Read a number from the `homemade_options` of the config.
+
+    :raises ValueError: If the option isn't a number.
+    """
+    value = options.get(name, default)
+    if not isinstance(value, (int, float, str)):
+        raise ValueError(f"The homemade option {name} must be a number, not {value!r}.")
+    return float(value)
+
+
 class ChessAIEngine(MinimalEngine):
     """
     Wrapper for ChessAI to make it compatible with lichess-bot
     """
-    def __init__(self, commands, options, stderr, draw_or_resign, name=None, **popen_args):
-        super().__init__(commands, options, stderr, draw_or_resign, name, **popen_args)
-        self.queue = Queue()
+    def __init__(self, commands: COMMANDS_TYPE, options: OPTIONS_GO_EGTB_TYPE, stderr: Optional[int],
+                 draw_or_resign: Configuration, game: Optional[model.Game] = None, name: Optional[str] = None,
+                 **popen_args: str) -> None:
+        super().__init__(commands, options, stderr, draw_or_resign, game, name, **popen_args)
+        hash_size = number_option(options, "Hash", ChessAI.DEFAULT_HASH_SIZE)
+        self.evaluate_children: Optional[Callable[[chess.Board, list[chess.Move]], list[float]]] = None
+        evaluator: Optional[ChessAI.Evaluator] = None
+        evaluation = options.get("Evaluation", "incremental")
+        if evaluation == "numpy":
+            from .batch_evaluation import evaluate_children
+            self.evaluate_children = evaluate_children
+        elif evaluation == "nnue":
+            from .nnue import NNUEEvaluator, DEFAULT_WEIGHTS
+            evaluator = NNUEEvaluator(str(options.get("NNUEWeights", DEFAULT_WEIGHTS)))
+        self.searcher_options: dict[str, Any] = {"evaluate_children": self.evaluate_children,
+                                                 "evaluator": evaluator,
+                                                 "pvs": bool(options.get("PVS", True)),
+                                                 "null_move": bool(options.get("NullMove", True)),
+                                                 "late_move_reductions": bool(options.get("LMR", True)),
+                                                 "pawn_structure": bool(options.get("PawnStructure", True))}
+
+        self.smp: Optional[LazySMP] = None
+        threads = int(number_option(options, "Threads", 1))
+        if threads > 1:
+            self.smp = LazySMP(threads, hash_size, self.searcher_options)
+            self.transposition_table = self.smp.transposition_table
+        else:
+            self.transposition_table = TranspositionTable(hash_size)
+        self.searcher = ChessAI.Searcher(self.transposition_table, **self.searcher_options)
+        # Its node table is kept between moves, like the transposition table.
+        self.mate_solver = MateSolver() if options.get("MateSolver", False) else None
         logger.info("ChessAI engine initialized")
 
     def search(self, board: chess.Board, time_limit: Limit, ponder: bool, draw_offered: bool, root_moves: MOVE) -> PlayResult:
@@ -33,17 +88,131 @@ class ChessAIEngine(MinimalEngine):
         
         logger.debug(f"Searching for best move among {len(valid_moves)} moves")
         
-        # Call the engine's findBestMove function
-        ChessAI.findBestMove(board, valid_moves, self.queue)
-        best_move = self.queue.get()
+        time_limit = self.add_go_commands(time_limit)
+        # A stop request left over from the last move must not end the mate solver before it starts.
+        self.search_controller.reset()
+        if self.mate_solver is not None:
+            start = time.perf_counter()
+            result = self.solve_mate(board, valid_moves, time_limit, draw_offered)
+            if result is not None:
+                return self.record_score(result, board)
+            time_limit = remaining_time(time_limit, board.turn, time.perf_counter() - start)
+        result = self.run_search(board, valid_moves, time_limit, draw_offered=draw_offered)
+        return self.record_score(result, board)
+
+    def solve_mate(self, board: chess.Board, valid_moves: list[chess.Move], time_limit: Limit,
+                   draw_offered: bool) -> Optional[PlayResult]:
+        """
+        Look for a forced mate with the mate solver for a short time.
+
+        :param time_limit: The limits of the search. The solver uses `MATE_SOLVER_TIME_FRACTION` of its time budget.
+        :return: The first move of the mate, or `None` if no mate was proven or the solver isn't used.
+        """
+        if self.mate_solver is None:
+            return None
+        soft_limit, _ = ChessAI.search_time_limits(board, time_limit)
+        solver_time = soft_limit * MATE_SOLVER_TIME_FRACTION if soft_limit is not None else MATE_SOLVER_DEFAULT_TIME
+        start = time.perf_counter()
+        pv = self.mate_solver.solve(board, valid_moves, solver_time, self.search_controller.stop_event.is_set)
+        elapsed = time.perf_counter() - start
+        nodes = self.mate_solver.nodes
+        if not pv:
+            logger.debug(f"No mate found in {nodes} mate solver nodes")
+            return None
+        logger.info(f"Mate solver found mate in {(len(pv) + 1) // 2}: {board.variation_san(pv)}")
+        info: chess.engine.InfoDict = {"depth": len(pv),
+                                       "nodes": nodes,
+                                       "nps": round(nodes / elapsed) if elapsed else 0,
+                                       "time": elapsed,
+                                       "pv": pv,
+                                       "score": chess.engine.PovScore(chess.engine.Mate((len(pv) + 1) // 2), board.turn),
+                                       "string": "mate solver"}
+        return PlayResult(pv[0], pv[1] if len(pv) > 1 else None, info, draw_offered=draw_offered)
+
+    def ponder(self, board: chess.Board, stop: threading.Event) -> Optional[PlayResult]:
+        """
+        Search the position after the expected reply until the opponent moves.
+
+        The transposition table filled while pondering is reused by the next search even if the opponent plays
+        something else.
+        """
+        valid_moves = list(board.legal_moves)
+        if not valid_moves:
+            return None
+        # Pondering has no time or depth limit. It ends when the opponent moves.
+        result = self.run_search(board, valid_moves, Limit(), stop.is_set, max_depth=ChessAI.MAX_PLY)
+        logger.debug(f"Pondering {board.peek()} reached depth {result.info.get('depth')}")
+        return result if result.info.get("depth") else None
+
+    def ponder_hit_is_enough(self, result: PlayResult, board: chess.Board, time_limit: Limit) -> bool:
+        """Also compare the time spent pondering with the soft time budget that ChessAI works out from the clock."""
+        soft_limit, _ = ChessAI.search_time_limits(board, self.add_go_commands(dataclasses.replace(time_limit)))
+        return (super().ponder_hit_is_enough(result, board, time_limit)
+                or (soft_limit is not None and result.info.get("time", 0.0) >= soft_limit))
+
+    def run_search(self, board: chess.Board, valid_moves: list[chess.Move], time_limit: Limit,
+                   should_stop: Optional[Callable[[], bool]] = None, draw_offered: bool = False,
+                   max_depth: Optional[int] = None) -> PlayResult:
+        """
+        Search the position with ChessAI.
+
+        :param time_limit: The limits of the search. The clock fields and `time` set the time budget, and `nodes`,
+            `depth`, and `mate` are honored too.
+        :param should_stop: Called during the search. The search stops if it returns `True`. If `None`, the search
+            stops when it reaches a limit of `time_limit` or when `stop_search` is called.
+        :param max_depth: The depth of the last iteration, when `should_stop` is given. If `None`, the time limit
+            decides.
+        :return: The best move, the expected reply from the principal variation, and the search statistics.
+        """
+        # The searcher is kept between moves, so each search starts with what the earlier ones learned.
+        tt = self.transposition_table
+        searcher = self.searcher
+        searcher.new_search(board)
+        if should_stop is None:
+            controller = self.search_controller
+            _, hard_limit = ChessAI.search_time_limits(board, time_limit)
+            controller.start(time_limit, hard_limit)
+
+            def should_stop() -> bool:
+                return controller.should_stop(searcher.nodes)
+
+            max_depth = controller.max_depth()
+            if max_depth is None and hard_limit is None and time_limit.nodes is not None:
+                # Only the node limit ends the search.
+                max_depth = ChessAI.MAX_PLY
+        searcher.should_stop = should_stop
+        start = time.perf_counter()
+        if self.smp:
+            best_move, score, depth = self.smp.search(searcher, board, valid_moves, time_limit, max_depth)
+            nodes = searcher.nodes + self.smp.helper_nodes
+        else:
+            best_move, score, depth = searcher.iterative_deepening(board, valid_moves, time_limit, max_depth=max_depth)
+            nodes = searcher.nodes
+        elapsed = time.perf_counter() - start
 
         # If no move is found, make a random move
         if best_move is None:
             logger.warning("No best move found, selecting random move")
             best_move = ChessAI.findRandomMove(valid_moves)
-        
+
+        # A Lazy SMP helper may have found a different move than the main search's principal variation.
+        pv = searcher.previous_pv if searcher.previous_pv[:1] == [best_move] else [best_move]
+        ponder_move = pv[1] if len(pv) > 1 else None
+
         logger.info(f"Selected move: {best_move}")
-        return PlayResult(best_move, None, draw_offered=draw_offered)
+        info: chess.engine.InfoDict = {"depth": depth,
+                                       "seldepth": searcher.seldepth,
+                                       "nodes": nodes,
+                                       "nps": round(nodes / elapsed) if elapsed else 0,
+                                       "time": elapsed,
+                                       "hashfull": tt.hashfull(),
+                                       "pv": pv,
+                                       "string": f"qnodes {searcher.qnodes} TT hit rate {tt.hit_rate():.1%}"}
+        if searcher.pawn_table is not None:
+            info["string"] += f" pawn hit rate {searcher.pawn_table.hit_rate():.1%}"
+        if depth:
+            info["score"] = chess.engine.PovScore(ChessAI.engine_score(score), board.turn)
+        return PlayResult(best_move, ponder_move, info, draw_offered=draw_offered)
 
     def get_opponent_info(self, game):
         pass  # Optional: Implement if you want to use opponent's info
@@ -54,5 +223,25 @@ class ChessAIEngine(MinimalEngine):
     def report_game_result(self, game, board):
         pass  # Optional: Implement to handle game results
 
-    def quit(self):
-        pass  # Optional: Implement if you need cleanup on exit
+    def quit(self) -> None:
+        """Stop searching and pondering, and stop the Lazy SMP helpers."""
+        super().quit()
+        if self.smp:
+            self.smp.quit()
+
+
+def remaining_time(time_limit: Limit, turn: chess.Color, elapsed: float) -> Limit:
+    """Take the time already used by this move out of the movetime and the clock of the side to move."""
+    def subtract(seconds: Optional[float]) -> Optional[float]:
+        return max(seconds - elapsed, 0.0) if seconds is not None else None
+
+    return Limit(time=subtract(time_limit.time),
+                 depth=time_limit.depth,
+                 nodes=time_limit.nodes,
+                 mate=time_limit.mate,
+                 white_clock=subtract(time_limit.white_clock) if turn == chess.WHITE else time_limit.white_clock,
+                 black_clock=subtract(time_limit.black_clock) if turn == chess.BLACK else time_limit.black_clock,
+                 white_inc=time_limit.white_inc,
+                 black_inc=time_limit.black_inc,
+                 remaining_moves=time_limit.remaining_moves,
+                 clock_id=time_limit.clock_id)
@@ -0,0 +1,111 @@
+"""
+Score many positions at once with NumPy.
+
+This is an alternative to the move-by-move score updates in `engines/ChessAI.py`. Each position is turned into its
+12 piece bitboards, which are unpacked into a 12x64 occupancy array and multiplied with the piece-square table. All
+the children of a node are scored in one call, so the Python overhead is paid once per node instead of once per child.
+
+Select it with `Evaluation: numpy` in `homemade_options`. Run `python -m engines.batch_evaluation` to compare its speed
+with the other ways of scoring positions.
+"""
+import random
+import sys
+import time
+from collections.abc import Iterable
+import chess
+import numpy as np
+import numpy.typing as npt
+from .ChessAI import piece_square_values, scoreBoard, move_score_change
+
+# The (piece_type, color) pairs in the same order as the rows of `piece_square_values`.
+PIECES = [(piece_type, color) for piece_type in chess.PIECE_TYPES for color in (chess.BLACK, chess.WHITE)]
+WEIGHTS = np.array(piece_square_values, dtype=np.float64)
+
+
+def bitboards(board: chess.Board) -> list[int]:
+    """Get the 12 piece bitboards of a position."""
+    return [board.pieces_mask(piece_type, color) for piece_type, color in PIECES]
+
+
+def score_bitboards(masks: npt.NDArray[np.uint64]) -> npt.NDArray[np.float64]:
+    """
+    Score positions from their piece bitboards.
+
+    :param masks: An array of shape (n, 12) with the output of `bitboards` for n positions.
+    :return: The score of each position. A positive score is good for white, a negative score is good for black.
+    """
+    occupancy = np.unpackbits(masks.astype("<u8").view(np.uint8), axis=1, bitorder="little")
+    return occupancy @ WEIGHTS
+
+
+def evaluate_batch(boards: Iterable[chess.Board]) -> npt.NDArray[np.float64]:
+    """Score positions the same way as `scoreBoard`."""
+    return score_bitboards(np.array([bitboards(board) for board in boards], dtype=np.uint64).reshape(-1, 12))
+
+
+def evaluate_children(board: chess.Board, moves: list[chess.Move]) -> list[float]:
+    """
+    Score the positions after each move the same way as `scoreBoard`.
+
+    :param board: The current position.
+    :param moves: The moves to make from the current position.
+    :return: The score after each move.
+    """
+    masks = []
+    for move in moves:
+        board.push(move)
+        masks.append(bitboards(board))
+        board.pop()
+    scores: list[float] = score_bitboards(np.array(masks, dtype=np.uint64).reshape(-1, 12)).tolist()
+    return scores
+
+
+def random_positions(count: int, rng: random.Random) -> list[tuple[chess.Board, list[chess.Move]]]:
+    """Play random games to reach `count` positions that have legal moves, and get each one with its moves."""
+    nodes: list[tuple[chess.Board, list[chess.Move]]] = []
+    while len(nodes) < count:
+        board = chess.Board()
+        for _ in range(rng.randint(0, 80)):
+            moves = list(board.legal_moves)
+            if not moves:
+                break
+            board.push(rng.choice(moves))
+        moves = list(board.legal_moves)
+        if moves:
+            nodes.append((board, moves))
+    return nodes
+
+
+def benchmark(positions: int = 200, seed: int = 0) -> dict[str, float]:
+    """
+    Time scoring every child of random positions with each evaluation backend.
+
+    :param positions: How many positions to expand.
+    :param seed: The seed for playing random games to reach the positions.
+    :return: The microseconds spent per child position by each backend.
+    """
+    nodes = random_positions(positions, random.Random(seed))
+    children = sum(len(moves) for _, moves in nodes)
+
+    def scalar(board: chess.Board, moves: list[chess.Move]) -> None:
+        for move in moves:
+            board.push(move)
+            scoreBoard(board)
+            board.pop()
+
+    def incremental(board: chess.Board, moves: list[chess.Move]) -> None:
+        for move in moves:
+            move_score_change(board, move)
+
+    results = {}
+    for name, backend in [("scoreBoard", scalar), ("incremental", incremental), ("numpy", evaluate_children)]:
+        start = time.perf_counter()
+        for board, moves in nodes:
+            backend(board, moves)
+        results[name] = (time.perf_counter() - start) / children * 1e6
+    return results
+
+
+if __name__ == "__main__":
+    for backend_name, microseconds in benchmark().items():
+        sys.stdout.write(f"{backend_name:>12}: {microseconds:.2f} us per position\n")
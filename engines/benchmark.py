@@ -0,0 +1,184 @@
+"""
+Measure the speed of move generation and the ChessAI search.
+
+Run `python -m engines.benchmark` to run perft on the positions of `engines/benchmark.epd` that have perft counts
+(`D1`, `D2`, ... operations), and to search every position of the suite to a fixed depth and for a fixed time. The
+results are printed as JSON, so the output of two commits run on the same machine can be compared.
+"""
+import argparse
+import json
+import logging
+import platform
+import sys
+import time
+from pathlib import Path
+from typing import Any, Optional
+import chess
+import chess.engine
+from .ChessAI import DEFAULT_HASH_SIZE, Searcher
+from .transposition import TranspositionTable
+
+logger = logging.getLogger(__name__)
+
+SUITE = Path(__file__).with_name("benchmark.epd")
+Suite = list[tuple[chess.Board, dict[str, Any]]]
+
+
+def load_suite(path: Path = SUITE) -> Suite:
+    """Read the positions and operations (e.g. `id`, `bm`, `D3`) of an EPD file."""
+    with open(path) as epd_file:
+        return [chess.Board.from_epd(line) for line in epd_file if line.strip()]
+
+
+def perft(board: chess.Board, depth: int) -> int:
+    """Count the leaf nodes of the legal move tree to `depth` plies with python-chess."""
+    if depth <= 1:
+        return board.legal_moves.count() if depth == 1 else 1
+    nodes = 0
+    for move in board.legal_moves:
+        board.push(move)
+        nodes += perft(board, depth - 1)
+        board.pop()
+    return nodes
+
+
+def run_perft(suite: Suite, max_depth: int) -> list[dict[str, Any]]:
+    """
+    Run perft on the positions with perft counts and check the counts.
+
+    :param suite: The positions. Only the positions with perft counts are used.
+    :param max_depth: The deepest perft to run. Each position is run at its deepest count up to this depth.
+    :return: The nodes, expected nodes, time, and nodes per second of each position.
+    """
+    results = []
+    for board, operations in suite:
+        depths = [int(name[1:]) for name in operations if name[0] == "D" and name[1:].isdigit()]
+        depths = [depth for depth in depths if depth <= max_depth]
+        if not depths:
+            continue
+        depth = max(depths)
+        start = time.perf_counter()
+        nodes = perft(board.copy(), depth)
+        seconds = time.perf_counter() - start
+        results.append({"id": operations.get("id"),
+                        "depth": depth,
+                        "nodes": nodes,
+                        "expected": operations[f"D{depth}"],
+                        "correct": nodes == operations[f"D{depth}"],
+                        "seconds": seconds,
+                        "nps": nodes / seconds if seconds else 0.0})
+    return results
+
+
+def branching_factor(iterations: list[tuple[int, int, float]]) -> Optional[float]:
+    """Get the ratio of the nodes searched by the last two iterations (the effective branching factor)."""
+    if len(iterations) < 2:
+        return None
+    nodes = [0] + [iteration_nodes for _, iteration_nodes, _ in iterations]
+    last, previous = nodes[-1] - nodes[-2], nodes[-2] - nodes[-3]
+    return last / previous if previous else None
+
+
+def run_search(suite: Suite, depth: Optional[int] = None, movetime: Optional[float] = None,
+               hash_size: float = DEFAULT_HASH_SIZE, **searcher_options: Any) -> list[dict[str, Any]]:
+    """
+    Search each position with an empty transposition table.
+
+    :param suite: The positions.
+    :param depth: The depth to search to. If `None`, `movetime` decides.
+    :param movetime: The time to search each position for (in seconds), as if lichess-bot sent `Limit(time=movetime)`.
+    :param hash_size: The size of the transposition table in MB.
+    :param searcher_options: Keyword arguments for `Searcher`.
+    :return: The search statistics of each position.
+    """
+    results = []
+    for position, operations in suite:
+        board = position.copy()
+        searcher = Searcher(TranspositionTable(hash_size), **searcher_options)
+        searcher.new_search(board)
+        time_limit = chess.engine.Limit(time=movetime) if movetime is not None else None
+        start = time.perf_counter()
+        move, score, completed_depth = searcher.iterative_deepening(board, list(board.legal_moves), time_limit,
+                                                                    max_depth=depth)
+        seconds = time.perf_counter() - start
+        best_moves = operations.get("bm")
+        results.append({"id": operations.get("id"),
+                        "move": move.uci() if move else None,
+                        "solved": move in best_moves if best_moves else None,
+                        "score": score,
+                        "depth": completed_depth,
+                        "nodes": searcher.nodes,
+                        "qnodes": searcher.qnodes,
+                        "seconds": seconds,
+                        "nps": searcher.nodes / seconds if seconds else 0.0,
+                        "time_to_depth": {iteration_depth: iteration_seconds
+                                          for iteration_depth, _, iteration_seconds in searcher.iterations},
+                        "tt_hit_rate": searcher.tt.hit_rate(),
+                        "pawn_hit_rate": searcher.pawn_table.hit_rate() if searcher.pawn_table else None,
+                        "branching_factor": branching_factor(searcher.iterations)})
+    return results
+
+
+def summarize(results: list[dict[str, Any]]) -> dict[str, Any]:
+    """Add up the nodes and time of a list of search or perft results."""
+    nodes = sum(result["nodes"] for result in results)
+    seconds = sum(result["seconds"] for result in results)
+    summary = {"nodes": nodes, "seconds": seconds, "nps": nodes / seconds if seconds else 0.0}
+    factors = [result["branching_factor"] for result in results if result.get("branching_factor")]
+    if factors:
+        summary["branching_factor"] = sum(factors) / len(factors)
+    if results and "tt_hit_rate" in results[0]:
+        summary["tt_hit_rate"] = sum(result["tt_hit_rate"] for result in results) / len(results)
+    pawn_hit_rates = [result["pawn_hit_rate"] for result in results if result.get("pawn_hit_rate") is not None]
+    if pawn_hit_rates:
+        summary["pawn_hit_rate"] = sum(pawn_hit_rates) / len(pawn_hit_rates)
+    return summary
+
+
+def benchmark(suite: Suite, perft_depth: int, depth: int, movetime: float, hash_size: float) -> dict[str, Any]:
+    """
+    Run perft, the fixed-depth searches, and the fixed-time searches. Skip a part by passing 0 for its limit.
+
+    :return: The results of each part and their totals, ready for `json.dumps`.
+    """
+    report: dict[str, Any] = {"python": platform.python_version(), "machine": platform.machine()}
+    if perft_depth:
+        perft_results = run_perft(suite, perft_depth)
+        report["perft"] = {"results": perft_results, "summary": summarize(perft_results)}
+    if depth:
+        depth_results = run_search(suite, depth=depth, hash_size=hash_size)
+        report["depth_search"] = {"depth": depth, "results": depth_results, "summary": summarize(depth_results)}
+    if movetime:
+        time_results = run_search(suite, movetime=movetime, hash_size=hash_size)
+        report["time_search"] = {"movetime": movetime, "results": time_results, "summary": summarize(time_results)}
+    return report
+
+
+def main(arguments: Optional[list[str]] = None) -> int:
+    """Run the benchmark from the command line."""
+    parser = argparse.ArgumentParser(description="Measure the speed of move generation and the ChessAI search.")
+    parser.add_argument("--epd", type=Path, default=SUITE, help="The positions to use.")
+    parser.add_argument("--perft-depth", type=int, default=3, help="The deepest perft to run (0 to skip perft).")
+    parser.add_argument("--depth", type=int, default=4, help="The depth of the fixed-depth searches (0 to skip).")
+    parser.add_argument("--movetime", type=float, default=1.0,
+                        help="The seconds per position of the fixed-time searches (0 to skip).")
+    parser.add_argument("--hash", type=float, default=DEFAULT_HASH_SIZE, help="The transposition table size in MB.")
+    parser.add_argument("--output", type=Path, help="The file to write the JSON to, instead of the standard output.")
+    args = parser.parse_args(arguments)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    report = benchmark(load_suite(args.epd), args.perft_depth, args.depth, args.movetime, args.hash)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        args.output.write_text(text + "\n")
+    else:
+        sys.stdout.write(text + "\n")
+    failed = [result["id"] for result in report.get("perft", {}).get("results", []) if not result["correct"]]
+    if failed:
+        logger.error(f"Wrong perft counts: {', '.join(map(str, failed))}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
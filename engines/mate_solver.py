@@ -0,0 +1,215 @@
+"""
+A depth-first proof-number (df-pn) search for forced mates, tried before the ChessAI alpha-beta search.
+
+The attacker only plays checks and the defender plays every legal reply, so the tree is narrow and a mate a few moves
+deep is often proven in far fewer nodes than an alpha-beta search to the same depth needs. Each node keeps a proof
+number (how many more leaves must be shown to be mates to prove that the attacker mates) and a disproof number (how
+many must be shown not to be mates to prove that they don't). The search always expands the most proving node, and
+stores the numbers in a node table that is bounded and kept between moves of the same game.
+
+A mate found by the solver is always a real mate: running into the depth limit or a repeated position only counts as a
+failure to mate. So the solver can miss mates, but it never claims a mate that isn't there. A failure is stored with
+the number of plies that were left, so it isn't trusted when the position is reached again with more plies left.
+
+Select it with `MateSolver: true` in `homemade_options`.
+"""
+import time
+from collections.abc import Callable
+from typing import Optional
+import chess
+import chess.polyglot
+from .ChessAI import SearchTimeoutError
+from .transposition import push_with_key
+
+INFINITY = 10 ** 9
+# The longest mate searched for, in moves of the attacker.
+DEFAULT_MAX_MATE = 8
+# The number of positions kept in the node table.
+DEFAULT_TABLE_SIZE = 200_000
+# How often the time and the stop callback are checked (in nodes).
+CHECK_INTERVAL = 256
+
+PROOF = 0
+DISPROOF = 1
+# Once proven, the plies to the mate. Once disproven, the plies that were left to find a mate in.
+DISTANCE = 2
+
+
+class MateSolver:
+    """Prove forced mates with df-pn. The node table is kept between calls to `solve`."""
+
+    def __init__(self, table_size: int = DEFAULT_TABLE_SIZE, max_mate: int = DEFAULT_MAX_MATE) -> None:
+        """
+        Set up an empty node table.
+
+        :param table_size: The most positions kept in the node table. The oldest half is dropped when it is full.
+        :param max_mate: The longest mate searched for, in moves of the attacker.
+        """
+        self.table_size = table_size
+        self.max_ply = 2 * max_mate - 1
+        # (Zobrist key, attacker) -> [proof number, disproof number, distance]
+        self.table: dict[tuple[int, chess.Color], list[int]] = {}
+        self.attacker = chess.WHITE
+        self.nodes = 0
+        self.deadline: Optional[float] = None
+        self.should_stop: Optional[Callable[[], bool]] = None
+        # The keys of the positions on the current path, to treat repetitions as failures.
+        self.path: set[int] = set()
+
+    def solve(self, board: chess.Board, root_moves: Optional[list[chess.Move]] = None, time_limit: Optional[float] = None,
+              should_stop: Optional[Callable[[], bool]] = None) -> Optional[list[chess.Move]]:
+        """
+        Look for a forced mate by the side to move.
+
+        :param board: The position.
+        :param root_moves: If given, the only moves the first move can be.
+        :param time_limit: The most seconds to search for.
+        :param should_stop: Called during the search. The search gives up if it returns `True`.
+        :return: The moves to the mate, with the defender's longest resistance, or `None` if no mate was proven.
+        """
+        self.attacker = board.turn
+        self.nodes = 0
+        self.deadline = time.perf_counter() + time_limit if time_limit is not None else None
+        self.should_stop = should_stop
+        self.path = set()
+        key = chess.polyglot.zobrist_hash(board)
+        board = board.copy()
+        try:
+            self.search(board, key, INFINITY - 1, INFINITY - 1, 0, root_moves)
+        except SearchTimeoutError:
+            return None
+        entry = self.table.get((key, self.attacker))
+        if entry is None or entry[PROOF] != 0:
+            return None
+        return self.principal_variation(board, key, root_moves)
+
+    def check_time(self) -> None:
+        """Count a node and give up if the time is over or the search was told to stop."""
+        self.nodes += 1
+        if self.nodes % CHECK_INTERVAL == 0:
+            if self.deadline is not None and time.perf_counter() > self.deadline:
+                raise SearchTimeoutError
+            if self.should_stop is not None and self.should_stop():
+                raise SearchTimeoutError
+
+    def moves(self, board: chess.Board, ply: int, root_moves: Optional[list[chess.Move]] = None) -> list[chess.Move]:
+        """Get the attacker's checks (at even plies) or all of the defender's replies (at odd plies)."""
+        if ply % 2:
+            return list(board.legal_moves)
+        moves = root_moves if root_moves is not None else board.legal_moves
+        return [move for move in moves if board.gives_check(move)]
+
+    def store(self, key: int, proof: int, disproof: int, distance: int = 0) -> None:
+        """Store the numbers of a position, making room if the table is full."""
+        if len(self.table) >= self.table_size and (key, self.attacker) not in self.table:
+            for old_key in list(self.table)[:len(self.table) // 2]:
+                del self.table[old_key]
+        self.table[(key, self.attacker)] = [proof, disproof, distance]
+
+    def search(self, board: chess.Board, key: int, proof_limit: int, disproof_limit: int, ply: int,
+               root_moves: Optional[list[chess.Move]] = None) -> None:
+        """
+        Expand the most proving nodes below a position until its proof or disproof number reaches its limit.
+
+        :param board: The position. The attacker is to move at even plies.
+        :param key: Its Zobrist key.
+        :param proof_limit: Return when the proof number is at least this.
+        :param disproof_limit: Return when the disproof number is at least this.
+        :param ply: The distance from the root.
+        :param root_moves: At the root, the moves to choose from.
+        """
+        self.check_time()
+        attacking = ply % 2 == 0
+        moves = self.moves(board, ply, root_moves)
+        if not moves:
+            if not attacking and board.is_check():
+                self.store(key, 0, INFINITY, 0)
+            else:
+                # No checks, or stalemate, however many plies are left.
+                self.store(key, INFINITY, 0, INFINITY)
+            return
+        remaining = self.max_ply - ply
+        if remaining <= 0:
+            self.store(key, INFINITY, 0)
+            return
+
+        children = []
+        for move in moves:
+            child_key = push_with_key(board, move, key)
+            board.pop()
+            children.append((move, child_key))
+        self.path.add(key)
+        while True:
+            numbers = [self.child_entry(child_key, remaining - 1) for _, child_key in children]
+            proof, disproof = self.combine(numbers, attacking)
+            if proof >= proof_limit or disproof >= disproof_limit:
+                break
+            # Attacking, the child with the lowest proof number is the most proving. Defending, the lowest disproof.
+            index = PROOF if attacking else DISPROOF
+            order = sorted(range(len(children)), key=lambda child: numbers[child][index])
+            best = order[0]
+            second = numbers[order[1]][index] if len(order) > 1 else INFINITY
+            if attacking:
+                child_proof_limit = min(proof_limit, second + 1)
+                child_disproof_limit = disproof_limit - disproof + numbers[best][DISPROOF]
+            else:
+                child_disproof_limit = min(disproof_limit, second + 1)
+                child_proof_limit = proof_limit - proof + numbers[best][PROOF]
+            move, child_key = children[best]
+            board.push(move)
+            try:
+                self.search(board, child_key, child_proof_limit, child_disproof_limit, ply + 1)
+            finally:
+                board.pop()
+        self.path.discard(key)
+
+        if proof == 0:
+            distances = [entry[DISTANCE] for entry in numbers if entry[PROOF] == 0]
+            self.store(key, proof, disproof, 1 + (min(distances) if attacking else max(distances)))
+        else:
+            self.store(key, proof, disproof, remaining if disproof == 0 else 0)
+
+    def child_entry(self, key: int, remaining: int) -> list[int]:
+        """
+        Get the numbers of a child, which start at 1 if it hasn't been seen.
+
+        A position already on the path counts as a failure to mate. A failure found with fewer plies left than
+        `remaining` is searched again.
+        """
+        if key in self.path:
+            return [INFINITY, 0, 0]
+        entry = self.table.get((key, self.attacker))
+        if entry is None or (entry[DISPROOF] == 0 and entry[DISTANCE] < remaining):
+            return [1, 1, 0]
+        return entry
+
+    @staticmethod
+    def combine(numbers: list[list[int]], attacking: bool) -> tuple[int, int]:
+        """Get the proof and disproof numbers of a node from those of its children."""
+        if attacking:
+            return (min(entry[PROOF] for entry in numbers),
+                    min(sum(entry[DISPROOF] for entry in numbers), INFINITY))
+        return (min(sum(entry[PROOF] for entry in numbers), INFINITY),
+                min(entry[DISPROOF] for entry in numbers))
+
+    def principal_variation(self, board: chess.Board, key: int,
+                            root_moves: Optional[list[chess.Move]] = None) -> list[chess.Move]:
+        """Follow the proven moves: the quickest mate for the attacker, and the longest resistance for the defender."""
+        pv = []
+        for ply in range(self.max_ply + 1):
+            candidates = []
+            for move in self.moves(board, ply, root_moves if ply == 0 else None):
+                child_key = push_with_key(board, move, key)
+                board.pop()
+                entry = self.table.get((child_key, self.attacker))
+                if entry is not None and entry[PROOF] == 0:
+                    candidates.append((entry[DISTANCE], move, child_key))
+            if not candidates:
+                break
+            choose = min if ply % 2 == 0 else max
+            distance, move, key = choose(candidates, key=lambda candidate: candidate[0])
+            pv.append(move)
+            board.push(move)
+            if distance == 0 and board.is_checkmate():
+                break
+        return pv
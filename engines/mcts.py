@@ -0,0 +1,344 @@
+"""
+A Monte-Carlo tree search (PUCT, as in AlphaZero) with the ChessAI piece-square evaluation.
+
+The tree lives in preallocated NumPy arrays, one entry per node, instead of one Python object per node. The children of
+a node are stored next to each other, so selecting a child is one vectorized computation over a slice of the arrays.
+Leaves are selected in batches (with virtual losses, so a batch spreads over different lines), and all the children of
+all the leaves of a batch are scored by one call to `engines.batch_evaluation.score_bitboards`. The scores of the
+children give the move priors, and the best child's score gives the leaf's value.
+
+The tree is kept between moves. When the game continues from a position that is in the tree, that position becomes
+the new root and the rest of the tree is thrown away.
+
+Requires NumPy. Select it with `name: "MCTS"` in the `engine` section of the config.
+"""
+import math
+from collections.abc import Callable
+from typing import Optional
+import chess
+import numpy as np
+import numpy.typing as npt
+from .batch_evaluation import bitboards, score_bitboards
+from .transposition import encode_move, decode_move
+
+# The number of nodes allocated for the tree. A node takes about 30 bytes.
+DEFAULT_CAPACITY = 1_000_000
+# The number of leaves evaluated together.
+BATCH_SIZE = 16
+# How strongly the priors steer the search towards unvisited moves.
+C_PUCT = 1.5
+# A score (in pawns) is turned into a value in [-1, 1] by tanh(score / VALUE_SCALE).
+VALUE_SCALE = 3.0
+# The priors are softmax(child score / PRIOR_TEMPERATURE), with the child scores in pawns.
+PRIOR_TEMPERATURE = 1.0
+# An unvisited child is valued at its parent's value minus this (first play urgency).
+FPU_REDUCTION = 0.2
+# The value added to the nodes of a selected path until its leaf is evaluated.
+VIRTUAL_LOSS = 1.0
+
+UNEXPANDED = -1
+NOT_TERMINAL = 2.0  # Terminal values are in [-1, 1].
+
+
+class MCTSTree:
+    """
+    A search tree in NumPy arrays.
+
+    Every value is from the point of view of the player who made the move leading to the node, so a parent picks the
+    child with the highest value.
+    """
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY) -> None:
+        """:param capacity: The most nodes the tree can hold. The search stops adding nodes when the tree is full."""
+        self.capacity = capacity
+        self.visits = np.zeros(capacity, dtype=np.int32)
+        self.value_sum = np.zeros(capacity, dtype=np.float64)
+        self.prior = np.zeros(capacity, dtype=np.float32)
+        self.move = np.zeros(capacity, dtype=np.uint16)
+        self.first_child = np.full(capacity, UNEXPANDED, dtype=np.int32)
+        self.child_count = np.zeros(capacity, dtype=np.int16)
+        self.terminal_value = np.full(capacity, NOT_TERMINAL, dtype=np.float32)
+        self.size = 0
+        self.root_board = chess.Board()
+        self.playouts = 0
+        # The deepest leaf reached by the last search.
+        self.seldepth = 0
+        self.reset(self.root_board)
+
+    def reset(self, board: chess.Board) -> None:
+        """Throw the tree away and start a new one at `board`."""
+        self.size = 1
+        self.root_board = board.copy()
+        self.clear_node(0)
+
+    def clear_node(self, node: int) -> None:
+        """Reset the statistics of a new node."""
+        self.visits[node] = 0
+        self.value_sum[node] = 0.0
+        self.first_child[node] = UNEXPANDED
+        self.child_count[node] = 0
+        self.terminal_value[node] = NOT_TERMINAL
+
+    def set_root(self, board: chess.Board) -> bool:
+        """
+        Move the root to `board`, keeping the subtree below it if `board` follows from the current root.
+
+        :return: Whether part of the tree was kept.
+        """
+        root_stack = self.root_board.move_stack
+        if board.move_stack[:len(root_stack)] != root_stack or board.root() != self.root_board.root():
+            self.reset(board)
+            return False
+        node = 0
+        for move in board.move_stack[len(root_stack):]:
+            node = self.find_child(node, move)
+            if node < 0:
+                self.reset(board)
+                return False
+        if node != 0:
+            self.compact(node)
+        self.root_board = board.copy()
+        return True
+
+    def find_child(self, node: int, move: chess.Move) -> int:
+        """Get the child of `node` reached by `move`, or -1 if it isn't in the tree."""
+        first = self.first_child[node]
+        if first < 0:
+            return -1
+        count = self.child_count[node]
+        matches = np.flatnonzero(self.move[first:first + count] == encode_move(move))
+        return int(first + matches[0]) if len(matches) else -1
+
+    def compact(self, new_root: int) -> None:
+        """Make `new_root` the root, and move its subtree to the start of the arrays."""
+        arrays: list[npt.NDArray[np.generic]] = [self.visits, self.value_sum, self.prior, self.move, self.terminal_value]
+        old: list[npt.NDArray[np.generic]] = [array.copy() for array in arrays]
+        old_first_child = self.first_child.copy()
+        old_child_count = self.child_count.copy()
+        for array, old_array in zip(arrays, old):
+            array[0] = old_array[new_root]
+        self.first_child[0] = UNEXPANDED
+        self.child_count[0] = 0
+        self.size = 1
+        queue = [(new_root, 0)]
+        while queue:
+            old_node, new_node = queue.pop()
+            first = int(old_first_child[old_node])
+            if first < 0:
+                continue
+            count = int(old_child_count[old_node])
+            start = self.size
+            for array, old_array in zip(arrays, old):
+                array[start:start + count] = old_array[first:first + count]
+            self.first_child[start:start + count] = UNEXPANDED
+            self.child_count[start:start + count] = 0
+            self.first_child[new_node] = start
+            self.child_count[new_node] = count
+            self.size += count
+            queue.extend((first + index, start + index) for index in range(count))
+
+    def select_child(self, node: int) -> int:
+        """Pick the child of `node` with the highest PUCT score."""
+        first = self.first_child[node]
+        count = self.child_count[node]
+        visits = self.visits[first:first + count]
+        parent_visits = self.visits[node]
+        parent_value = -self.value_sum[node] / parent_visits if parent_visits else 0.0
+        q = np.where(visits > 0, self.value_sum[first:first + count] / np.maximum(visits, 1),
+                     parent_value - FPU_REDUCTION)
+        u = C_PUCT * self.prior[first:first + count] * math.sqrt(max(parent_visits, 1)) / (1 + visits)
+        return int(first + np.argmax(q + u))
+
+    def select_leaf(self, board: chess.Board) -> list[int]:
+        """
+        Walk from the root to a leaf, adding a virtual loss to each node on the way.
+
+        :param board: The root position. The moves to the leaf are pushed onto it.
+        :return: The path from the root to the leaf.
+        """
+        path = [0]
+        node = 0
+        self.visits[0] += 1
+        while self.first_child[node] >= 0 and self.child_count[node] > 0:
+            node = self.select_child(node)
+            board.push(decode_move(int(self.move[node])) or chess.Move.null())
+            self.visits[node] += 1
+            self.value_sum[node] -= VIRTUAL_LOSS
+            path.append(node)
+        return path
+
+    def backpropagate(self, path: list[int], value: float) -> None:
+        """
+        Add a leaf's value to the nodes on its path, and remove their virtual losses.
+
+        :param path: The path from the root to the leaf.
+        :param value: The value of the leaf for the side to move there.
+        """
+        for node in reversed(path):
+            # The node's value is for the player who moved into it, who isn't the side to move there.
+            value = -value
+            self.value_sum[node] += value + (VIRTUAL_LOSS if node else 0.0)
+
+    def undo_virtual_loss(self, path: list[int]) -> None:
+        """Remove the virtual losses of a path whose leaf won't be evaluated."""
+        for node in path:
+            self.visits[node] -= 1
+            if node:
+                self.value_sum[node] += VIRTUAL_LOSS
+
+    def search(self, board: chess.Board, should_stop: Callable[[int], bool],
+               root_moves: Optional[list[chess.Move]] = None) -> None:
+        """
+        Run playouts until `should_stop` returns `True`.
+
+        :param board: The position to search. The tree is re-rooted here.
+        :param should_stop: Called with the number of playouts so far before each batch.
+        :param root_moves: If given, only these moves are considered at the root.
+        """
+        if root_moves is not None:
+            self.reset(board)
+        else:
+            self.set_root(board)
+        self.playouts = 0
+        self.seldepth = 0
+        if self.first_child[0] < 0:
+            self.expand_and_evaluate([[0]], board.copy(), root_moves)
+        while not should_stop(self.playouts) and self.size < self.capacity:
+            self.playouts += self.run_batch()
+
+    def run_batch(self) -> int:
+        """Select, expand, evaluate and back up a batch of leaves. Returns the number of leaves."""
+        paths: list[list[int]] = []
+        pending: set[int] = set()
+        board = self.root_board.copy(stack=False)
+        for _ in range(BATCH_SIZE):
+            path = self.select_leaf(board)
+            leaf = path[-1]
+            for _ in path[1:]:
+                board.pop()
+            if leaf in pending:
+                # Another path of this batch already reached this leaf.
+                self.undo_virtual_loss(path)
+                break
+            if self.terminal_value[leaf] != NOT_TERMINAL:
+                self.backpropagate(path, float(self.terminal_value[leaf]))
+                continue
+            pending.add(leaf)
+            paths.append(path)
+            self.seldepth = max(self.seldepth, len(path) - 1)
+        if paths:
+            self.expand_and_evaluate(paths, board)
+        return max(len(paths), 1)
+
+    def expand_and_evaluate(self, paths: list[list[int]], board: chess.Board,
+                            root_moves: Optional[list[chess.Move]] = None) -> None:
+        """
+        Add the children of each leaf to the tree, score them all at once, and back up the leaf values.
+
+        :param paths: The paths from the root to each leaf.
+        :param board: The root position.
+        :param root_moves: If given, the only moves to add below the root.
+        """
+        leaf_moves: list[list[chess.Move]] = []
+        masks: list[list[int]] = []
+        turns: list[chess.Color] = []
+        terminal: list[Optional[float]] = []
+        for path in paths:
+            moves_to_leaf = [decode_move(int(self.move[node])) or chess.Move.null() for node in path[1:]]
+            for move in moves_to_leaf:
+                board.push(move)
+            moves, value = leaf_moves_and_value(board, root_moves if len(path) == 1 else None)
+            for move in moves:
+                board.push(move)
+                masks.append(bitboards(board))
+                board.pop()
+            leaf_moves.append(moves)
+            turns.append(board.turn)
+            terminal.append(value)
+            for _ in moves_to_leaf:
+                board.pop()
+
+        scores = score_bitboards(np.array(masks, dtype=np.uint64).reshape(-1, 12)) if masks else np.zeros(0)
+        offset = 0
+        for path, moves, turn, value in zip(paths, leaf_moves, turns, terminal):
+            if value is not None:
+                self.terminal_value[path[-1]] = value
+                self.backpropagate(path, value)
+                continue
+            # The children's scores for the side to move at the leaf.
+            child_scores = scores[offset:offset + len(moves)] * (1 if turn == chess.WHITE else -1)
+            offset += len(moves)
+            if self.size + len(moves) <= self.capacity:
+                self.add_children(path[-1], moves, child_scores)
+            self.backpropagate(path, math.tanh(float(child_scores.max()) / VALUE_SCALE))
+
+    def add_children(self, node: int, moves: list[chess.Move], child_scores: npt.NDArray[np.float64]) -> None:
+        """
+        Expand a node.
+
+        :param node: The node to expand.
+        :param moves: The moves from the node.
+        :param child_scores: The score after each move, in pawns, for the side to move at the node.
+        """
+        start = self.size
+        end = start + len(moves)
+        self.size = end
+        weights = np.exp((child_scores - child_scores.max()) / PRIOR_TEMPERATURE)
+        self.prior[start:end] = weights / weights.sum()
+        self.move[start:end] = [encode_move(move) for move in moves]
+        self.visits[start:end] = 0
+        self.value_sum[start:end] = 0.0
+        self.first_child[start:end] = UNEXPANDED
+        self.child_count[start:end] = 0
+        self.terminal_value[start:end] = NOT_TERMINAL
+        self.first_child[node] = start
+        self.child_count[node] = len(moves)
+
+    def best_move(self) -> Optional[chess.Move]:
+        """Get the most visited move at the root."""
+        first = self.first_child[0]
+        if first < 0 or not self.child_count[0]:
+            return None
+        child = int(first + np.argmax(self.visits[first:first + self.child_count[0]]))
+        return decode_move(int(self.move[child]))
+
+    def principal_variation(self) -> list[chess.Move]:
+        """Follow the most visited child from the root."""
+        pv = []
+        node = 0
+        while self.first_child[node] >= 0 and self.child_count[node] > 0:
+            first = self.first_child[node]
+            node = int(first + np.argmax(self.visits[first:first + self.child_count[node]]))
+            if not self.visits[node]:
+                break
+            pv.append(decode_move(int(self.move[node])) or chess.Move.null())
+        return pv
+
+    def root_value(self) -> float:
+        """Get the average value of the root for the side to move."""
+        return -self.value_sum[0] / self.visits[0] if self.visits[0] else 0.0
+
+
+def leaf_moves_and_value(board: chess.Board, root_moves: Optional[list[chess.Move]] = None
+                         ) -> tuple[list[chess.Move], Optional[float]]:
+    """
+    Get the moves to expand a leaf with, or its value if the game is over there.
+
+    A position that has been seen before on the way to the leaf counts as a draw.
+
+    :param board: The position at the leaf.
+    :param root_moves: If given, the moves to use instead of the legal moves.
+    :return: The moves and `None`, or no moves and the value for the side to move.
+    """
+    moves = root_moves if root_moves is not None else list(board.legal_moves)
+    if not moves:
+        return [], -1.0 if board.is_check() else 0.0
+    if board.is_insufficient_material() or board.halfmove_clock >= 100 or board.is_repetition(2):
+        return [], 0.0
+    return moves, None
+
+
+def value_to_centipawns(value: float) -> int:
+    """Convert a value in [-1, 1] back to a score in centipawns."""
+    value = max(-0.999, min(0.999, value))
+    return round(math.atanh(value) * VALUE_SCALE * 100)
@@ -0,0 +1,201 @@
+"""
+An efficiently updatable neural network (NNUE) evaluation for ChessAI.
+
+The network sees every position from both sides. Each piece on a square is a feature, numbered like the rows of
+`piece_square_values` (64 * (2 * (piece_type - 1) + color) + square) from white's side, and with the colors swapped
+and the board flipped from black's side. The first layer adds up one row of `feature_weights` per feature into an
+accumulator for each side. A move only changes a few features, so the accumulators are updated by adding and
+subtracting a few rows when a move is made, and restored from a stack when it is taken back.
+
+The accumulators are clipped to [0, 1] and put side to move first, then go through a small dense layer and the output
+layer, which gives the score in pawns for the side to move.
+
+The weights are read from an `.npz` file written by `engines/train_nnue.py`. Its arrays are memory-mapped, so the game
+processes and the Lazy SMP helpers share one copy of them. Select the network with `Evaluation: nnue` and
+`NNUEWeights: <path>` in `homemade_options`. Requires NumPy.
+"""
+import zipfile
+from pathlib import Path
+from typing import Any, Optional, Union
+import chess
+import numpy as np
+import numpy.typing as npt
+
+FEATURES = 768
+DEFAULT_WEIGHTS = Path(__file__).with_name("nnue.npz")
+WEIGHT_NAMES = ("feature_weights", "feature_bias", "hidden_weights", "hidden_bias", "output_weights", "output_bias")
+
+
+def feature(piece_type: chess.PieceType, color: chess.Color, square: chess.Square) -> int:
+    """Get the feature of a piece on a square, from white's side."""
+    return 64 * (2 * (piece_type - 1) + color) + square
+
+
+# The feature from black's side of each feature from white's side. Mirroring twice gives the same feature back.
+MIRROR = np.array([feature(piece_type, not color, chess.square_mirror(square))
+                   for piece_type in chess.PIECE_TYPES for color in chess.COLORS for square in chess.SQUARES],
+                  dtype=np.intp)
+
+
+def board_features(board: chess.Board) -> list[int]:
+    """Get the features of all the pieces on the board, from white's side."""
+    return [feature(piece.piece_type, piece.color, square) for square, piece in board.piece_map().items()]
+
+
+def changed_features(board: chess.Board, move: chess.Move) -> Optional[tuple[list[int], list[int]]]:
+    """
+    Get the features, from white's side, that a move adds and removes.
+
+    :param board: The position before the move.
+    :param move: The move to make.
+    :return: The added and removed features, or `None` for moves that are easier to handle by recomputing the
+        accumulators (castling, drops, and variants).
+    """
+    if board.is_castling(move) or move.drop or board.uci_variant != "chess":
+        return None
+    if not move:
+        return [], []
+    color = board.turn
+    moving_piece = board.piece_type_at(move.from_square) or chess.PAWN
+    added = [feature(move.promotion or moving_piece, color, move.to_square)]
+    removed = [feature(moving_piece, color, move.from_square)]
+    if board.is_en_passant(move):
+        captured_square = move.to_square - 8 if color == chess.WHITE else move.to_square + 8
+        removed.append(feature(chess.PAWN, not color, captured_square))
+    else:
+        captured_piece = board.piece_type_at(move.to_square)
+        if captured_piece:
+            removed.append(feature(captured_piece, not color, move.to_square))
+    return added, removed
+
+
+def load_weights(path: Union[str, Path]) -> dict[str, npt.NDArray[np.float32]]:
+    """
+    Memory-map the arrays of an uncompressed `.npz` file (as written by `numpy.savez`).
+
+    `numpy.load` reads the arrays of an `.npz` file into memory. The members of an uncompressed zip file are stored
+    as they are, so each one can be memory-mapped at its offset in the file instead. Compressed members are read into
+    memory.
+    """
+    weights = {}
+    with zipfile.ZipFile(path) as archive, open(path, "rb") as file:
+        for info in archive.infolist():
+            name = info.filename.removesuffix(".npy")
+            if info.compress_type != zipfile.ZIP_STORED:
+                with archive.open(info) as member:
+                    weights[name] = np.lib.format.read_array(member)
+                continue
+            # The local file header is 30 bytes plus the file name and an extra field.
+            file.seek(info.header_offset + 26)
+            name_length, extra_length = np.frombuffer(file.read(4), dtype="<u2")
+            file.seek(info.header_offset + 30 + int(name_length) + int(extra_length))
+            version = np.lib.format.read_magic(file)
+            read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+            shape, fortran_order, dtype = read_header(file)
+            weights[name] = np.memmap(file, dtype=dtype, mode="r", offset=file.tell(), shape=shape,
+                                      order="F" if fortran_order else "C")
+    missing = [name for name in WEIGHT_NAMES if name not in weights]
+    if missing:
+        raise ValueError(f"{path} is missing the NNUE weights {', '.join(missing)}")
+    return weights
+
+
+def save_weights(path: Union[str, Path], weights: dict[str, npt.NDArray[np.float32]]) -> None:
+    """Write the weights uncompressed, so `load_weights` can memory-map them."""
+    arrays: dict[str, Any] = {name: np.asarray(weights[name], dtype=np.float32) for name in WEIGHT_NAMES}
+    np.savez(path, **arrays)
+
+
+def random_weights(hidden_size: int = 128, dense_size: int = 32, seed: int = 0) -> dict[str, npt.NDArray[np.float32]]:
+    """Get the starting weights for training a network with `hidden_size` accumulator values per side."""
+    rng = np.random.default_rng(seed)
+    return {"feature_weights": rng.normal(0, 0.05, (FEATURES, hidden_size)).astype(np.float32),
+            "feature_bias": np.full(hidden_size, 0.5, dtype=np.float32),
+            "hidden_weights": rng.normal(0, (2 * hidden_size) ** -0.5, (2 * hidden_size, dense_size)).astype(np.float32),
+            "hidden_bias": np.full(dense_size, 0.5, dtype=np.float32),
+            "output_weights": rng.normal(0, dense_size ** -0.5, dense_size).astype(np.float32),
+            "output_bias": np.zeros((), dtype=np.float32)}
+
+
+class NNUEEvaluator:
+    """
+    Keep the accumulators of the searched position up to date, and score it with the network.
+
+    Call `reset` at the root of a search, `push` before making each move, and `pop` after taking it back.
+    """
+
+    def __init__(self, path: Union[str, Path] = DEFAULT_WEIGHTS) -> None:
+        """:param path: The `.npz` file with the weights."""
+        self.path = Path(path)
+        weights = load_weights(self.path)
+        # A plain array view of the memory map, which is faster to index.
+        self.feature_weights = np.asarray(weights["feature_weights"])
+        self.feature_bias = np.asarray(weights["feature_bias"])
+        self.hidden_weights = np.asarray(weights["hidden_weights"])
+        self.hidden_bias = np.asarray(weights["hidden_bias"])
+        self.output_weights = np.asarray(weights["output_weights"])
+        self.output_bias = float(weights["output_bias"])
+        # The accumulators from white's side (row 0) and black's side (row 1) of each position on the search path.
+        # `None` stands for accumulators that haven't been computed yet.
+        self.stack: list[Optional[npt.NDArray[np.float32]]] = []
+
+    def __getstate__(self) -> dict[str, Any]:
+        """Send only the path to other processes. They memory-map the same file."""
+        return {"path": self.path}
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        """Load the weights in another process."""
+        self.__init__(state["path"])  # type: ignore[misc]
+
+    def refresh(self, board: chess.Board) -> npt.NDArray[np.float32]:
+        """Compute the accumulators of a position from scratch."""
+        features = board_features(board)
+        return np.stack([self.feature_bias + self.feature_weights[features].sum(axis=0),
+                         self.feature_bias + self.feature_weights[MIRROR[features]].sum(axis=0)])
+
+    def reset(self, board: chess.Board) -> None:
+        """Start a search at `board`."""
+        self.stack = [self.refresh(board)]
+
+    def push(self, board: chess.Board, move: chess.Move) -> None:
+        """
+        Update the accumulators for a move.
+
+        :param board: The position before the move. The caller makes the move afterwards.
+        :param move: The move to make.
+        """
+        accumulators = self.accumulators(board)
+        changes = changed_features(board, move)
+        if changes is None:
+            # Computed from the position after the move when it's needed.
+            self.stack.append(None)
+            return
+        added, removed = changes
+        accumulators = accumulators.copy()
+        for index in added:
+            accumulators[0] += self.feature_weights[index]
+            accumulators[1] += self.feature_weights[MIRROR[index]]
+        for index in removed:
+            accumulators[0] -= self.feature_weights[index]
+            accumulators[1] -= self.feature_weights[MIRROR[index]]
+        self.stack.append(accumulators)
+
+    def accumulators(self, board: chess.Board) -> npt.NDArray[np.float32]:
+        """Get the accumulators of the current position, which is `board`."""
+        accumulators = self.stack[-1]
+        if accumulators is None:
+            accumulators = self.stack[-1] = self.refresh(board)
+        return accumulators
+
+    def pop(self) -> None:
+        """Restore the accumulators of the position before the last move."""
+        self.stack.pop()
+
+    def evaluate(self, board: chess.Board) -> float:
+        """Score the current position in pawns. A positive score is good for white, a negative score is good for black."""
+        accumulators = self.accumulators(board)
+        side_to_move = 0 if board.turn == chess.WHITE else 1
+        inputs = np.clip(np.concatenate((accumulators[side_to_move], accumulators[1 - side_to_move])), 0, 1)
+        hidden = np.clip(inputs @ self.hidden_weights + self.hidden_bias, 0, 1)
+        score = float(hidden @ self.output_weights) + self.output_bias
+        return score if board.turn == chess.WHITE else -score
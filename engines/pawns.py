@@ -0,0 +1,163 @@
+"""
+Pawn-structure evaluation for ChessAI, cached in a pawn hash table.
+
+Doubled, isolated, and passed pawns only depend on where the pawns are, and most moves don't move a pawn, so the
+score of a pawn structure is stored in a table indexed by a Zobrist key of the pawns alone. The key is updated move by
+move like the position's key (see `update_pawn_key`). The pawn shield in front of each king also depends on the king,
+so it is counted on every evaluation, which takes two bit counts.
+"""
+from typing import Optional
+import chess
+from .transposition import piece_key
+
+DOUBLED_PAWN = -0.1  # For each pawn behind another pawn of the same color on its file.
+ISOLATED_PAWN = -0.15  # For each pawn with no pawns of the same color on the files next to it.
+# For a passed pawn, by its rank counted from its own side (index 1 is its starting rank).
+PASSED_PAWN = [0.0, 0.0, 0.05, 0.1, 0.2, 0.35, 0.5, 0.0]
+SHIELD_PAWN = 0.1  # For each pawn in front of its castled king.
+# The number of entries in the pawn hash table.
+DEFAULT_PAWN_TABLE_SIZE = 1 << 14
+
+
+def adjacent_files(file: int) -> chess.Bitboard:
+    """Get the squares on the files next to `file`."""
+    return (chess.BB_FILES[file - 1] if file > 0 else 0) | (chess.BB_FILES[file + 1] if file < 7 else 0)
+
+
+def forward_ranks(color: chess.Color, square: chess.Square) -> chess.Bitboard:
+    """Get the squares on the ranks in front of `square`, from `color`'s side."""
+    rank = chess.square_rank(square)
+    ranks = range(rank + 1, 8) if color == chess.WHITE else range(rank)
+    mask = 0
+    for forward_rank in ranks:
+        mask |= chess.BB_RANKS[forward_rank]
+    return mask
+
+
+ADJACENT_FILES = [adjacent_files(file) for file in range(8)]
+# PASSED_MASKS[color][square]: the squares where an enemy pawn stops a pawn on `square` from being passed.
+PASSED_MASKS = [[forward_ranks(color, square) & (chess.BB_FILES[chess.square_file(square)]
+                                                 | ADJACENT_FILES[chess.square_file(square)])
+                 for square in chess.SQUARES] for color in (chess.BLACK, chess.WHITE)]
+
+
+def shield_mask(color: chess.Color, square: chess.Square) -> chess.Bitboard:
+    """
+    Get the squares of the pawn shield of a king: the two ranks in front of it, on its file and the files next to it.
+
+    Only a king on its first rank, away from the center files, has a shield.
+    """
+    file = chess.square_file(square)
+    if chess.square_rank(square) != (0 if color == chess.WHITE else 7) or file in (3, 4):
+        return 0
+    ranks = chess.BB_RANK_2 | chess.BB_RANK_3 if color == chess.WHITE else chess.BB_RANK_7 | chess.BB_RANK_6
+    return (chess.BB_FILES[file] | ADJACENT_FILES[file]) & ranks
+
+
+SHIELD_MASKS = [[shield_mask(color, square) for square in chess.SQUARES] for color in (chess.BLACK, chess.WHITE)]
+
+
+def pawn_key(board: chess.Board) -> int:
+    """Get the Zobrist key of the pawns on the board."""
+    key = 0
+    for color in chess.COLORS:
+        for square in chess.scan_forward(board.pawns & board.occupied_co[color]):
+            key ^= piece_key(chess.PAWN, color, square)
+    return key
+
+
+def update_pawn_key(board: chess.Board, move: chess.Move, key: int) -> Optional[int]:
+    """
+    Get the pawn key after a move.
+
+    :param board: The position before the move.
+    :param move: The move to make.
+    :param key: The pawn key of `board`.
+    :return: The new key, or `None` for moves that are easier to handle by recomputing the key (drops and variants).
+    """
+    if move.drop or board.uci_variant != "chess":
+        return None
+    if not move or not board.pawns & (chess.BB_SQUARES[move.from_square] | chess.BB_SQUARES[move.to_square]):
+        return key
+    color = board.turn
+    if board.pawns & chess.BB_SQUARES[move.from_square]:
+        key ^= piece_key(chess.PAWN, color, move.from_square)
+        if move.promotion is None:
+            key ^= piece_key(chess.PAWN, color, move.to_square)
+        if board.is_en_passant(move):
+            captured_square = move.to_square - 8 if color == chess.WHITE else move.to_square + 8
+            key ^= piece_key(chess.PAWN, not color, captured_square)
+    if board.pawns & chess.BB_SQUARES[move.to_square] and board.color_at(move.to_square) != color:
+        key ^= piece_key(chess.PAWN, not color, move.to_square)
+    return key
+
+
+def pawn_structure(white_pawns: chess.Bitboard, black_pawns: chess.Bitboard) -> float:
+    """
+    Score doubled, isolated, and passed pawns.
+
+    :return: The score in pawns. A positive score is good for white, a negative score is good for black.
+    """
+    score = 0.0
+    for color, pawns, enemy_pawns, sign in ((chess.WHITE, white_pawns, black_pawns, 1),
+                                            (chess.BLACK, black_pawns, white_pawns, -1)):
+        for file_mask in chess.BB_FILES:
+            count = chess.popcount(pawns & file_mask)
+            if count > 1:
+                score += sign * DOUBLED_PAWN * (count - 1)
+        for square in chess.scan_forward(pawns):
+            if not pawns & ADJACENT_FILES[chess.square_file(square)]:
+                score += sign * ISOLATED_PAWN
+            if not enemy_pawns & PASSED_MASKS[color][square]:
+                rank = chess.square_rank(square)
+                score += sign * PASSED_PAWN[rank if color == chess.WHITE else 7 - rank]
+    return score
+
+
+def king_shield(board: chess.Board) -> float:
+    """Score the pawns in front of each king. A positive score is good for white, a negative score is good for black."""
+    score = 0
+    for color, sign in ((chess.WHITE, 1), (chess.BLACK, -1)):
+        king = board.king(color)
+        if king is not None:
+            score += sign * chess.popcount(SHIELD_MASKS[color][king] & board.pawns & board.occupied_co[color])
+    return SHIELD_PAWN * score
+
+
+class PawnHashTable:
+    """A fixed-size table of pawn-structure scores, indexed by the pawn key. Each entry is replaced by the next one."""
+
+    def __init__(self, size: int = DEFAULT_PAWN_TABLE_SIZE) -> None:
+        """:param size: The number of entries."""
+        self.size = max(1, size)
+        self.keys: list[Optional[int]] = [None] * self.size
+        self.scores = [0.0] * self.size
+        self.probes = 0
+        self.hits = 0
+
+    def new_search(self) -> None:
+        """Start counting probes and hits for a new search. The entries are kept."""
+        self.probes = 0
+        self.hits = 0
+
+    def score(self, board: chess.Board, key: int) -> float:
+        """
+        Get the pawn-structure score of a position, computing and storing it if it isn't in the table.
+
+        :param board: The position.
+        :param key: The pawn key of the position.
+        :return: The score in pawns. A positive score is good for white, a negative score is good for black.
+        """
+        self.probes += 1
+        index = key % self.size
+        if self.keys[index] == key:
+            self.hits += 1
+            return self.scores[index]
+        score = pawn_structure(board.pawns & board.occupied_co[chess.WHITE], board.pawns & board.occupied_co[chess.BLACK])
+        self.keys[index] = key
+        self.scores[index] = score
+        return score
+
+    def hit_rate(self) -> float:
+        """Get the share of probes that found their entry during the current search."""
+        return self.hits / self.probes if self.probes else 0.0
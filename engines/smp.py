@@ -0,0 +1,338 @@
+"""
+Lazy SMP: search the same position in several processes that share one transposition table.
+
+The helper processes search the root at staggered depths and fill the shared table, which makes the main search
+faster. The table lives in `multiprocessing.shared_memory`. Its entries are written without locks, and each one is
+verified by XOR-ing its key with its data, so an entry torn by two processes writing at once is ignored.
+
+Games are played in the daemonic processes of a `multiprocessing` pool, which can't start `multiprocessing` processes.
+So the helpers are started like UCI engines: each one is a Python program (`python -m engines.smp`) that reads its
+jobs from its stdin and writes its results to its stdout. A helper exits when its stdin is closed, which also happens
+when the game's process dies.
+
+Select the number of processes with `Threads` in `homemade_options`. When several games search at the same time, each
+game uses fewer helpers so the games together don't use more processes than there are CPU cores.
+"""
+import logging
+import os
+import pickle
+import queue
+import subprocess
+import sys
+import tempfile
+import threading
+import weakref
+from multiprocessing import resource_tracker, shared_memory
+from pathlib import Path
+from typing import IO, Any, Optional
+import chess
+import chess.engine
+from .ChessAI import Searcher
+from .transposition import BYTES_PER_BUCKET, TranspositionTable
+
+if sys.platform == "win32":
+    import msvcrt
+
+    def lock_file(file: IO[bytes]) -> bool:
+        """Try to lock a file without waiting. The lock is held until the file is closed."""
+        file.seek(0)
+        try:
+            msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            return False
+        return True
+
+    def unlock_file(file: IO[bytes]) -> None:
+        """Release a lock taken by `lock_file`."""
+        file.seek(0)
+        msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+else:
+    import fcntl
+
+    def lock_file(file: IO[bytes]) -> bool:
+        """Try to lock a file without waiting. The lock is held until the file is closed."""
+        try:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return False
+        return True
+
+    def unlock_file(file: IO[bytes]) -> None:
+        """Release a lock taken by `lock_file`."""
+        fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+
+logger = logging.getLogger(__name__)
+
+# Each game that uses Lazy SMP keeps a locked file here, so other games know how many CPU cores they have to share.
+REGISTRY = Path(tempfile.gettempdir()) / "lichess-bot-smp"
+# How long to wait for the helpers to report their results after the main search finishes (in seconds).
+RESULT_TIMEOUT = 1
+# The directory that contains the `engines` package, where the helpers are started.
+PACKAGE_ROOT = Path(__file__).resolve().parent.parent
+
+HelperJob = tuple[int, chess.Board, list[chess.Move], Optional[chess.engine.Limit], int, int, Optional[int]]
+HelperResult = tuple[int, Optional[chess.Move], float, int, int]
+
+
+def table_bytes(size_mb: float) -> int:
+    """Get the number of bytes used by a `TranspositionTable` of `size_mb` megabytes."""
+    return max(1, int(size_mb * 1024 * 1024) // BYTES_PER_BUCKET) * BYTES_PER_BUCKET
+
+
+class GameRecord:
+    """
+    A file in `REGISTRY` that a game keeps locked while it uses Lazy SMP.
+
+    The operating system releases the lock when the game's process exits, however it exits, so a file that can be
+    locked was left by a game that has ended.
+    """
+
+    def __init__(self) -> None:
+        """Create and lock the file."""
+        REGISTRY.mkdir(exist_ok=True)
+        descriptor, path = tempfile.mkstemp(suffix=".lock", prefix=f"{os.getpid()}-", dir=REGISTRY)
+        self.path = Path(path)
+        self.file = os.fdopen(descriptor, "r+b")
+        self.file.write(b"\0")
+        self.file.flush()
+        lock_file(self.file)
+
+    def close(self) -> None:
+        """Unlock and remove the file."""
+        if self.file.closed:
+            return
+        unlock_file(self.file)
+        self.file.close()
+        self.path.unlink(missing_ok=True)
+
+
+def active_games() -> int:
+    """Count the games that use Lazy SMP, removing the records of games that have ended."""
+    count = 0
+    for path in REGISTRY.glob("*.lock"):
+        try:
+            with open(path, "r+b") as file:
+                if not lock_file(file):
+                    count += 1
+                    continue
+                unlock_file(file)
+            path.unlink(missing_ok=True)
+        except OSError:
+            # The game removed its record, or another process is removing it.
+            continue
+    return max(count, 1)
+
+
+def memory_buffer(memory: shared_memory.SharedMemory) -> memoryview:
+    """Get the buffer of open shared memory."""
+    buffer = memory.buf
+    assert buffer is not None
+    return buffer
+
+
+def attach_memory(name: str) -> shared_memory.SharedMemory:
+    """Open shared memory created by another process, which stays in charge of freeing it."""
+    memory = shared_memory.SharedMemory(name=name)
+    if os.name == "posix":
+        # Opening the memory registers it with this process's resource tracker, which would free it when this
+        # process exits.
+        resource_tracker.unregister(f"/{memory.name}", "shared_memory")
+    return memory
+
+
+def run_helper(jobs: IO[bytes], results: IO[bytes]) -> None:
+    """
+    Search the positions sent by the game process until it sends `None` or closes `jobs`.
+
+    The first message on `jobs` is the name of the shared memory holding the transposition table, the size of the
+    table in MB, and the keyword arguments for `Searcher`. The byte after the table is set by the game process when
+    the search should stop.
+
+    :param jobs: The pipe the jobs are read from.
+    :param results: The pipe the result of each search is written to.
+    """
+    memory_name, hash_size, searcher_options = pickle.load(jobs)  # noqa: S301 Sent by the game process that started this helper.
+    memory = attach_memory(memory_name)
+    buffer = memory_buffer(memory)
+    transposition_table = TranspositionTable(hash_size, buffer)
+    stop_flag = table_bytes(hash_size)
+    try:
+        while True:
+            try:
+                job: Optional[HelperJob] = pickle.load(jobs)  # noqa: S301
+            except EOFError:
+                break
+            if job is None:
+                break
+
+            job_id, board, valid_moves, time_limit, generation, start_depth, max_depth = job
+            transposition_table.generation = generation
+            searcher = Searcher(transposition_table, **searcher_options)
+            searcher.should_stop = lambda: buffer[stop_flag] != 0
+            move, score, depth = searcher.iterative_deepening(board, valid_moves, time_limit, start_depth, max_depth)
+            result: HelperResult = (job_id, move, score, depth, searcher.nodes)
+            pickle.dump(result, results)
+            results.flush()
+    finally:
+        transposition_table.release()
+        memory.close()
+
+
+class Helper:
+    """A helper process, and a thread that passes on its results."""
+
+    def __init__(self, memory_name: str, hash_size: float, searcher_options: dict[str, Any],
+                 results: "queue.Queue[HelperResult]") -> None:
+        """
+        Start the helper.
+
+        :param memory_name: The name of the shared memory holding the transposition table.
+        :param hash_size: The size of the transposition table in MB.
+        :param searcher_options: Keyword arguments for `Searcher`.
+        :param results: Where to put the result of each search.
+        """
+        self.process = subprocess.Popen([sys.executable, "-m", "engines.smp"], cwd=PACKAGE_ROOT,
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        assert self.process.stdin is not None
+        assert self.process.stdout is not None
+        self.jobs = self.process.stdin
+        self.send((memory_name, hash_size, searcher_options))
+        self.reader = threading.Thread(target=read_results, args=(self.process.stdout, results), daemon=True)
+        self.reader.start()
+
+    def send(self, message: Any) -> None:
+        """Send a message to the helper."""
+        pickle.dump(message, self.jobs)
+        self.jobs.flush()
+
+    def stop(self) -> None:
+        """Tell the helper to exit, and kill it if it doesn't."""
+        try:
+            self.send(None)
+            self.jobs.close()
+        except OSError:
+            pass  # The helper has already exited.
+        try:
+            self.process.wait(RESULT_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+def read_results(pipe: IO[bytes], results: "queue.Queue[HelperResult]") -> None:
+    """Pass the results a helper writes to `pipe` on to `results`, until the helper exits."""
+    with pipe:
+        while True:
+            try:
+                results.put(pickle.load(pipe))  # noqa: S301 Sent by a helper that this process started.
+            except (EOFError, OSError, pickle.UnpicklingError):
+                break
+
+
+class LazySMP:
+    """Helper processes that search alongside the main search and share its transposition table."""
+
+    def __init__(self, threads: int, hash_size: float, searcher_options: dict[str, Any]) -> None:
+        """
+        Create the shared transposition table. The helper processes are started by the first search.
+
+        :param threads: The number of processes to search with, including the main process.
+        :param hash_size: The size of the shared transposition table in MB.
+        :param searcher_options: Keyword arguments for `Searcher` in the helper processes.
+        """
+        self.threads = threads
+        self.hash_size = hash_size
+        self.searcher_options = searcher_options
+        # The table, followed by the flag that stops the helpers' searches.
+        self.stop_flag = table_bytes(hash_size)
+        self.memory = shared_memory.SharedMemory(create=True, size=self.stop_flag + 1)
+        self.buffer = memory_buffer(self.memory)
+        self.transposition_table = TranspositionTable(hash_size, self.buffer)
+        self.transposition_table.clear()
+        self.results: queue.Queue[HelperResult] = queue.Queue()
+        self.helpers: list[Helper] = []
+        self.job_id = 0
+        self.helper_nodes = 0
+        self.record = GameRecord()
+        self.finalizer = weakref.finalize(self, shut_down, self.helpers, self.transposition_table, self.memory,
+                                          self.record)
+
+    def helper_count(self) -> int:
+        """Get how many helpers to use, sharing the CPU cores with the other games that use Lazy SMP."""
+        cores_per_game = (os.cpu_count() or 1) // active_games()
+        return max(0, min(self.threads, cores_per_game) - 1)
+
+    def start_helpers(self, count: int) -> None:
+        """Start helper processes until there are at least `count`."""
+        while len(self.helpers) < count:
+            self.helpers.append(Helper(self.memory.name, self.hash_size, self.searcher_options, self.results))
+
+    def search(self, searcher: Searcher, board: chess.Board, valid_moves: list[chess.Move],
+               time_limit: Optional[chess.engine.Limit],
+               max_depth: Optional[int] = None) -> tuple[Optional[chess.Move], float, int]:
+        """
+        Search with the main searcher while the helpers search the same position.
+
+        :param searcher: The main searcher. It must use `self.transposition_table`.
+        :param max_depth: The depth of the last iteration, for the main searcher and the helpers. The helpers stop when
+            the main searcher finishes.
+        :return: The best move, its score, and its depth, from whichever process completed the deepest iteration.
+            If there is a tie, the main searcher's move is used.
+        """
+        helper_count = self.helper_count()
+        self.start_helpers(helper_count)
+        self.job_id += 1
+        self.buffer[self.stop_flag] = 0
+        generation = self.transposition_table.generation
+        sent = 0
+        for index, helper in enumerate(self.helpers[:helper_count]):
+            # Half of the helpers start one ply deeper, so the processes don't all search the same depth.
+            job: HelperJob = (self.job_id, board, list(valid_moves), time_limit, generation, 1 + (index + 1) % 2,
+                              max_depth)
+            try:
+                helper.send(job)
+                sent += 1
+            except OSError:
+                logger.warning("A Lazy SMP helper has exited.")
+
+        best_move, best_score, best_depth = searcher.iterative_deepening(board, valid_moves, time_limit,
+                                                                         max_depth=max_depth)
+        self.buffer[self.stop_flag] = 1
+
+        self.helper_nodes = 0
+        remaining = sent
+        while remaining:
+            try:
+                job_id, move, score, depth, nodes = self.results.get(timeout=RESULT_TIMEOUT)
+            except queue.Empty:
+                logger.warning("A Lazy SMP helper did not report its result.")
+                break
+            if job_id != self.job_id:
+                continue  # A late result from an earlier search.
+            remaining -= 1
+            self.helper_nodes += nodes
+            if move is not None and move in valid_moves and depth > best_depth:
+                best_move, best_score, best_depth = move, score, depth
+        return best_move, best_score, best_depth
+
+    def quit(self) -> None:
+        """Stop the helpers and free the shared memory."""
+        self.finalizer()
+
+
+def shut_down(helpers: list[Helper], transposition_table: TranspositionTable, memory: shared_memory.SharedMemory,
+              record: GameRecord) -> None:
+    """Stop the helper processes, free the shared memory, and remove the game's record."""
+    for helper in helpers:
+        helper.stop()
+    transposition_table.release()
+    memory.close()
+    memory.unlink()
+    record.close()
+
+
+if __name__ == "__main__":
+    # Keep stdout for the results, in case anything in the search prints.
+    result_pipe = sys.stdout.buffer
+    sys.stdout = sys.stderr
+    run_helper(sys.stdin.buffer, result_pipe)
@@ -0,0 +1,206 @@
+"""
+Train the NNUE evaluation (see `engines/nnue.py`) on the games in PGN files.
+
+Run `python -m engines.train_nnue games/ --output engines/nnue.npz`, where `games/` is the `pgn_directory` of the config
+or any other PGN files. Quiet positions are sampled from the games, and each one is labeled with a mix of the game's
+result and the material and position score of `scoreBoard`, as a winning chance for the side to move. The network's
+score is turned into a winning chance with `sigmoid(score / SCORE_SCALE)` and fitted to the labels with Adam.
+"""
+import argparse
+import logging
+import random
+import sys
+from collections.abc import Iterable, Iterator
+from pathlib import Path
+from typing import Optional
+import chess
+import chess.pgn
+import numpy as np
+import numpy.typing as npt
+from .ChessAI import scoreBoard
+from .nnue import FEATURES, MIRROR, WEIGHT_NAMES, board_features, random_weights, save_weights
+
+logger = logging.getLogger(__name__)
+
+# A score of SCORE_SCALE pawns is a winning chance of 73%.
+SCORE_SCALE = 4.0
+RESULTS = {"1-0": 1.0, "0-1": 0.0, "1/2-1/2": 0.5}
+
+# (features from white's side, white to move, winning chance for white)
+Sample = tuple[list[int], bool, float]
+Weights = dict[str, npt.NDArray[np.float32]]
+
+
+def sigmoid(x: npt.NDArray[np.float32]) -> npt.NDArray[np.float32]:
+    """Turn scores into winning chances."""
+    return np.float32(1) / (np.exp(-x) + np.float32(1))
+
+
+def pgn_files(paths: Iterable[Path]) -> Iterator[Path]:
+    """Get the PGN files among `paths` and in the directories among them."""
+    for path in paths:
+        if path.is_dir():
+            yield from sorted(path.rglob("*.pgn"))
+        else:
+            yield path
+
+
+def read_samples(paths: Iterable[Path], result_weight: float, skip_plies: int = 8) -> list[Sample]:
+    """
+    Get the quiet positions of the games in PGN files, with their labels.
+
+    :param paths: The PGN files or directories of PGN files.
+    :param result_weight: How much the game's result counts in the label. The rest is the score of `scoreBoard`.
+    :param skip_plies: The number of opening plies to skip in each game.
+    :return: The samples. Games without a result are skipped.
+    """
+    samples = []
+    for path in pgn_files(paths):
+        with open(path, encoding="utf-8", errors="replace") as pgn:
+            while (game := chess.pgn.read_game(pgn)) is not None:
+                result = RESULTS.get(game.headers.get("Result", "*"))
+                if result is None:
+                    continue
+                board = game.board()
+                for ply, move in enumerate(game.mainline_moves()):
+                    if ply >= skip_plies and not board.is_check() and not board.is_capture(move):
+                        score = float(sigmoid(np.array(scoreBoard(board) / SCORE_SCALE, dtype=np.float32)))
+                        label = result_weight * result + (1 - result_weight) * score
+                        samples.append((board_features(board), board.turn == chess.WHITE, label))
+                    board.push(move)
+    return samples
+
+
+def forward(weights: Weights, white_inputs: npt.NDArray[np.float32], black_inputs: npt.NDArray[np.float32],
+            white_to_move: npt.NDArray[np.bool_]) -> dict[str, npt.NDArray[np.float32]]:
+    """
+    Run the network on a batch of positions, keeping what `backward` needs.
+
+    :param white_inputs: The features from white's side, one row of zeros and ones per position.
+    :param black_inputs: The features from black's side.
+    :param white_to_move: Whether white is to move in each position.
+    :return: The layers' values. `score` is the score in pawns for the side to move.
+    """
+    white = white_inputs @ weights["feature_weights"] + weights["feature_bias"]
+    black = black_inputs @ weights["feature_weights"] + weights["feature_bias"]
+    side = white_to_move[:, None]
+    accumulators = np.concatenate((np.where(side, white, black), np.where(side, black, white)), axis=1)
+    inputs = np.clip(accumulators, 0, 1)
+    hidden_sums = inputs @ weights["hidden_weights"] + weights["hidden_bias"]
+    hidden = np.clip(hidden_sums, 0, 1)
+    score = hidden @ weights["output_weights"] + weights["output_bias"]
+    return {"accumulators": accumulators, "inputs": inputs, "hidden_sums": hidden_sums, "hidden": hidden,
+            "score": score}
+
+
+def backward(weights: Weights, layers: dict[str, npt.NDArray[np.float32]], white_inputs: npt.NDArray[np.float32],
+             black_inputs: npt.NDArray[np.float32], white_to_move: npt.NDArray[np.bool_],
+             labels: npt.NDArray[np.float32]) -> tuple[float, Weights]:
+    """
+    Get the mean squared error of the winning chances and its gradient.
+
+    :param layers: The output of `forward`.
+    :param labels: The winning chance for the side to move in each position.
+    :return: The loss and the gradient of each weight.
+    """
+    chance = sigmoid(layers["score"] / SCORE_SCALE)
+    loss = float(np.mean((chance - labels) ** 2))
+    d_score = 2 * (chance - labels) / len(labels) * chance * (1 - chance) / SCORE_SCALE
+    d_hidden = np.outer(d_score, weights["output_weights"]) * ((layers["hidden_sums"] > 0) & (layers["hidden_sums"] < 1))
+    d_inputs = d_hidden @ weights["hidden_weights"].T
+    d_accumulators = d_inputs * ((layers["accumulators"] > 0) & (layers["accumulators"] < 1))
+    size = weights["feature_bias"].shape[0]
+    side = white_to_move[:, None]
+    own, other = d_accumulators[:, :size], d_accumulators[:, size:]
+    d_white = np.where(side, own, other)
+    d_black = np.where(side, other, own)
+    gradient = {"feature_weights": white_inputs.T @ d_white + black_inputs.T @ d_black,
+                "feature_bias": (d_white + d_black).sum(axis=0),
+                "hidden_weights": layers["inputs"].T @ d_hidden,
+                "hidden_bias": d_hidden.sum(axis=0),
+                "output_weights": layers["hidden"].T @ d_score,
+                "output_bias": d_score.sum()}
+    return loss, gradient
+
+
+def batch_arrays(samples: list[Sample]) -> tuple[npt.NDArray[np.float32], npt.NDArray[np.float32],
+                                                 npt.NDArray[np.bool_], npt.NDArray[np.float32]]:
+    """Get the network inputs from both sides, the side to move, and the labels for the side to move of a batch."""
+    white_inputs = np.zeros((len(samples), FEATURES), dtype=np.float32)
+    for row, (features, _, _) in enumerate(samples):
+        white_inputs[row, features] = 1
+    black_inputs = np.zeros_like(white_inputs)
+    black_inputs[:, MIRROR] = white_inputs
+    white_to_move = np.array([turn for _, turn, _ in samples])
+    labels = np.array([label for _, _, label in samples], dtype=np.float32)
+    return white_inputs, black_inputs, white_to_move, np.where(white_to_move, labels, 1 - labels)
+
+
+def train(samples: list[Sample], *, epochs: int = 10, batch_size: int = 256, learning_rate: float = 0.001,
+          hidden_size: int = 128, dense_size: int = 32, seed: int = 0,
+          weights: Optional[Weights] = None) -> tuple[Weights, list[float]]:
+    """
+    Fit the network to the samples with Adam.
+
+    :param weights: The weights to start from. If `None`, random weights are used.
+    :return: The weights and the mean loss of each epoch.
+    """
+    rng = random.Random(seed)
+    weights = {name: np.array(value, dtype=np.float32) for name, value in
+               (weights or random_weights(hidden_size, dense_size, seed)).items()}
+    first_moments = {name: np.zeros_like(value) for name, value in weights.items()}
+    second_moments = {name: np.zeros_like(value) for name, value in weights.items()}
+    beta1, beta2, epsilon = 0.9, 0.999, 1e-8
+    step = 0
+    losses = []
+    samples = samples[:]
+    for epoch in range(epochs):
+        rng.shuffle(samples)
+        epoch_losses = []
+        for start in range(0, len(samples), batch_size):
+            white_inputs, black_inputs, white_to_move, labels = batch_arrays(samples[start:start + batch_size])
+            layers = forward(weights, white_inputs, black_inputs, white_to_move)
+            loss, gradient = backward(weights, layers, white_inputs, black_inputs, white_to_move, labels)
+            epoch_losses.append(loss)
+            step += 1
+            for name in WEIGHT_NAMES:
+                first_moments[name] = beta1 * first_moments[name] + (1 - beta1) * gradient[name]
+                second_moments[name] = beta2 * second_moments[name] + (1 - beta2) * gradient[name] ** 2
+                corrected_first = first_moments[name] / (1 - beta1 ** step)
+                corrected_second = second_moments[name] / (1 - beta2 ** step)
+                weights[name] = (weights[name] - learning_rate * corrected_first
+                                 / (np.sqrt(corrected_second) + epsilon)).astype(np.float32)
+        losses.append(float(np.mean(epoch_losses)) if epoch_losses else 0.0)
+        logger.info(f"Epoch {epoch + 1}: loss {losses[-1]:.5f}")
+    return weights, losses
+
+
+def main(arguments: Optional[list[str]] = None) -> int:
+    """Train the network from the command line."""
+    parser = argparse.ArgumentParser(description="Train the NNUE evaluation of ChessAI on PGN files.")
+    parser.add_argument("pgn", type=Path, nargs="+", help="PGN files, or directories to search for PGN files.")
+    parser.add_argument("--output", type=Path, default=Path("engines/nnue.npz"), help="The file to write the weights to.")
+    parser.add_argument("--epochs", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--learning-rate", type=float, default=0.001)
+    parser.add_argument("--hidden-size", type=int, default=128, help="The number of accumulator values per side.")
+    parser.add_argument("--result-weight", type=float, default=0.7,
+                        help="How much the game result counts in the labels (the rest is the material score).")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(arguments)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    samples = read_samples(args.pgn, args.result_weight)
+    if not samples:
+        logger.error("No positions found in the PGN files.")
+        return 1
+    logger.info(f"Training on {len(samples)} positions")
+    weights, _ = train(samples, epochs=args.epochs, batch_size=args.batch_size, learning_rate=args.learning_rate,
+                       hidden_size=args.hidden_size, seed=args.seed)
+    save_weights(args.output, weights)
+    logger.info(f"Wrote {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,225 @@
+"""
+A fixed-size transposition table for the ChessAI search, and the Zobrist keys it is indexed by.
+
+The keys are the same as `chess.polyglot.zobrist_hash`, but they are updated move by move instead of recomputed
+from the whole board.
+"""
+import math
+import chess
+import chess.polyglot
+from typing import NamedTuple, Optional
+
+ZOBRIST = chess.polyglot.POLYGLOT_RANDOM_ARRAY
+ZOBRIST_TURN = ZOBRIST[780]
+polyglot_hasher = chess.polyglot.ZobristHasher(ZOBRIST)
+
+# Bound types.
+EXACT = 1
+LOWER = 2  # The score is at least this high (the search failed high).
+UPPER = 3  # The score is at most this high (the search failed low).
+
+ENTRIES_PER_BUCKET = 2  # The first slot prefers deep entries. The second is always replaced.
+WORDS_PER_ENTRY = 2  # key ^ data, data
+BYTES_PER_BUCKET = ENTRIES_PER_BUCKET * WORDS_PER_ENTRY * 8
+GENERATIONS = 64
+SCORE_OFFSET = 1 << 31
+# Scores within this many centipawns of a whole centipawn are taken to be on it, to ignore floating-point noise.
+ROUNDING_TOLERANCE = 1e-6
+# The first entries of the table are sampled to estimate how full it is.
+HASHFULL_SAMPLE = 1000
+
+
+def piece_key(piece_type: chess.PieceType, color: chess.Color, square: chess.Square) -> int:
+    """Get the Zobrist key of a piece on a square."""
+    return ZOBRIST[64 * ((piece_type - 1) * 2 + color) + square]
+
+
+def castling_key(board: chess.Board) -> int:
+    """Get the Zobrist key of the castling rights."""
+    if board.chess960:
+        return polyglot_hasher.hash_castling(board)
+    key = 0
+    rights = board.castling_rights
+    if rights & chess.BB_H1:
+        key ^= ZOBRIST[768]
+    if rights & chess.BB_A1:
+        key ^= ZOBRIST[769]
+    if rights & chess.BB_H8:
+        key ^= ZOBRIST[770]
+    if rights & chess.BB_A8:
+        key ^= ZOBRIST[771]
+    return key
+
+
+def en_passant_key(board: chess.Board) -> int:
+    """Get the Zobrist key of the en passant square (only if a pawn is ready to capture there)."""
+    return polyglot_hasher.hash_ep_square(board) if board.ep_square else 0
+
+
+def push_with_key(board: chess.Board, move: chess.Move, key: int) -> int:
+    """
+    Make a move and update the Zobrist key of the position.
+
+    :param board: The position before the move. The move is pushed onto it.
+    :param move: The move to make.
+    :param key: The Zobrist key of `board` before the move.
+    :return: The Zobrist key after the move.
+    """
+    if board.is_castling(move) or move.drop or board.uci_variant != "chess":
+        # Rare enough that rehashing the whole board is fine.
+        board.push(move)
+        return chess.polyglot.zobrist_hash(board)
+
+    color = board.turn
+    key ^= castling_key(board) ^ en_passant_key(board)
+    if move:
+        moving_piece = board.piece_type_at(move.from_square) or chess.PAWN
+        key ^= piece_key(moving_piece, color, move.from_square)
+        key ^= piece_key(move.promotion or moving_piece, color, move.to_square)
+        if board.is_en_passant(move):
+            captured_square = move.to_square - 8 if color == chess.WHITE else move.to_square + 8
+            key ^= piece_key(chess.PAWN, not color, captured_square)
+        else:
+            captured_piece = board.piece_type_at(move.to_square)
+            if captured_piece:
+                key ^= piece_key(captured_piece, not color, move.to_square)
+
+    board.push(move)
+    return key ^ castling_key(board) ^ en_passant_key(board) ^ ZOBRIST_TURN
+
+
+def score_to_centipawns(score: float, bound: int) -> int:
+    """
+    Round a score (in pawns) to the centipawns it is stored as.
+
+    Lower bounds are rounded down and upper bounds up, so a stored bound is never tighter than the searched one.
+    """
+    centipawns = score * 100
+    if bound == LOWER:
+        return math.floor(centipawns + ROUNDING_TOLERANCE)
+    if bound == UPPER:
+        return math.ceil(centipawns - ROUNDING_TOLERANCE)
+    return round(centipawns)
+
+
+class TTEntry(NamedTuple):
+    """An entry of the transposition table."""
+
+    depth: int
+    bound: int
+    score: float
+    move: Optional[chess.Move]
+
+
+def encode_move(move: Optional[chess.Move]) -> int:
+    """Pack a move into 15 bits. 0 means no move."""
+    if not move:
+        return 0
+    return move.from_square | move.to_square << 6 | (move.promotion or 0) << 12
+
+
+def decode_move(code: int) -> Optional[chess.Move]:
+    """Unpack a move made by `encode_move`."""
+    if not code:
+        return None
+    return chess.Move(code & 63, (code >> 6) & 63, (code >> 12) or None)
+
+
+class TranspositionTable:
+    """
+    A fixed-size hash table of search results.
+
+    Each bucket holds two entries. The first keeps the deepest result (unless it is from an older search), and the
+    second takes everything else. An entry is two 64-bit words, `key ^ data` and `data`, so a torn write is detected as
+    a key mismatch instead of returning another position's data.
+    """
+
+    def __init__(self, size_mb: float, buffer: Optional[memoryview] = None) -> None:
+        """
+        Allocate the table.
+
+        :param size_mb: The size of the table in megabytes.
+        :param buffer: Memory to store the table in. If `None`, the table allocates its own memory.
+        """
+        self.bucket_count = max(1, int(size_mb * 1024 * 1024) // BYTES_PER_BUCKET)
+        size = self.bucket_count * BYTES_PER_BUCKET
+        self.table = (buffer if buffer is not None else memoryview(bytearray(size)))[:size].cast("Q")
+        self.generation = 0
+        self.probes = 0
+        self.hits = 0
+
+    def new_search(self) -> None:
+        """Start a new search. Entries from older searches are replaced first."""
+        self.generation = (self.generation + 1) % GENERATIONS
+        self.probes = 0
+        self.hits = 0
+
+    def clear(self) -> None:
+        """Remove all entries."""
+        raw = self.table.cast("B")
+        raw[:] = bytes(len(raw))
+
+    def release(self) -> None:
+        """Release the table's memory. The table can't be used afterwards."""
+        self.table.release()
+
+    def probe(self, key: int) -> Optional[TTEntry]:
+        """Get the entry for the position with Zobrist key `key`."""
+        self.probes += 1
+        table = self.table
+        index = (key % self.bucket_count) * ENTRIES_PER_BUCKET * WORDS_PER_ENTRY
+        for slot in (index, index + WORDS_PER_ENTRY):
+            data = table[slot + 1]
+            if data and table[slot] ^ data == key:
+                self.hits += 1
+                return TTEntry((data >> 16) & 0xFF,
+                               (data >> 24) & 3,
+                               ((data >> 32) - SCORE_OFFSET) / 100,
+                               decode_move(data & 0xFFFF))
+        return None
+
+    def store(self, key: int, depth: int, bound: int, score: float, move: Optional[chess.Move]) -> None:
+        """
+        Store a search result.
+
+        :param key: The Zobrist key of the position.
+        :param depth: The depth the position was searched to.
+        :param bound: Whether `score` is exact (`EXACT`), a lower bound (`LOWER`), or an upper bound (`UPPER`).
+        :param score: The score of the position in pawns.
+        :param move: The best move found.
+        """
+        table = self.table
+        index = (key % self.bucket_count) * ENTRIES_PER_BUCKET * WORDS_PER_ENTRY
+        deep_data = table[index + 1]
+        deep_key = table[index] ^ deep_data
+        if move is None and deep_key == key:
+            # Keep the best move from an earlier search of this position.
+            move = decode_move(deep_data & 0xFFFF)
+        # An exact score replaces a deeper bound for the same position. Otherwise, a shallower result goes to the
+        # always-replace slot, even for the same position.
+        replace_deep = (not deep_data
+                        or (deep_key == key and bound == EXACT)
+                        or (deep_data >> 26) & (GENERATIONS - 1) != self.generation
+                        or depth >= (deep_data >> 16) & 0xFF)
+        slot = index if replace_deep else index + WORDS_PER_ENTRY
+        data = (encode_move(move)
+                | min(max(depth, 0), 0xFF) << 16
+                | bound << 24
+                | self.generation << 26
+                | (score_to_centipawns(score, bound) + SCORE_OFFSET) << 32)
+        table[slot] = key ^ data
+        table[slot + 1] = data
+
+    def hashfull(self) -> int:
+        """Get how full the table is with entries from the current search, in permille."""
+        sample_size = min(HASHFULL_SAMPLE, self.bucket_count * ENTRIES_PER_BUCKET)
+        used = 0
+        for entry in range(sample_size):
+            data = self.table[entry * WORDS_PER_ENTRY + 1]
+            if data and (data >> 26) & (GENERATIONS - 1) == self.generation:
+                used += 1
+        return used * 1000 // sample_size
+
+    def hit_rate(self) -> float:
+        """Get the fraction of probes that found an entry during the current search."""
+        return self.hits / self.probes if self.probes else 0.0
@@ -4,13 +4,20 @@ Some example classes for people who want to create a homemade bot.
 With these classes, bot makers will not have to implement the UCI or XBoard interfaces themselves.
 """
 import chess
-import chess.polyglot
 from chess.engine import PlayResult, Limit
 import random 
 from lib.engine_wrapper import MinimalEngine 
+from lib.opening_book import get_book
 from lib.lichess_types import MOVE, HOMEMADE_ARGS_TYPE
+from engines.ChessAIWrapper import ChessAIEngine, number_option
+from engines.ChessAI import search_time_limits
+from lib.lichess_types import COMMANDS_TYPE, OPTIONS_GO_EGTB_TYPE
+from lib.config import Configuration
+from lib import model
+from typing import Optional
 import logging
-from queue import Queue
+import os
+import time
 
 logger = logging.getLogger(__name__)
 
@@ -25,237 +32,86 @@ class RandomMove(ExampleEngine):
         return PlayResult(random.choice(list(board.legal_moves)), None)
 
 
-piece_score = {"K": 0, "Q": 9, "R": 5, "B": 3, "N": 3, "P": 1}
-
-knight_scores = [[0.0, 0.1, 0.2, 0.2, 0.2, 0.2, 0.1, 0.0],
-                 [0.1, 0.3, 0.5, 0.5, 0.5, 0.5, 0.3, 0.1],
-                 [0.2, 0.5, 0.6, 0.65, 0.65, 0.6, 0.5, 0.2],
-                 [0.2, 0.55, 0.65, 0.7, 0.7, 0.65, 0.55, 0.2],
-                 [0.2, 0.5, 0.65, 0.7, 0.7, 0.65, 0.5, 0.2],
-                 [0.2, 0.55, 0.6, 0.65, 0.65, 0.6, 0.55, 0.2],
-                 [0.1, 0.3, 0.5, 0.55, 0.55, 0.5, 0.3, 0.1],
-                 [0.0, 0.1, 0.2, 0.2, 0.2, 0.2, 0.1, 0.0]]
-
-bishop_scores = [[0.0, 0.2, 0.2, 0.2, 0.2, 0.2, 0.2, 0.0],
-                 [0.2, 0.4, 0.4, 0.4, 0.4, 0.4, 0.4, 0.2],
-                 [0.2, 0.4, 0.5, 0.6, 0.6, 0.5, 0.4, 0.2],
-                 [0.2, 0.5, 0.5, 0.6, 0.6, 0.5, 0.5, 0.2],
-                 [0.2, 0.4, 0.6, 0.6, 0.6, 0.6, 0.4, 0.2],
-                 [0.2, 0.6, 0.6, 0.6, 0.6, 0.6, 0.6, 0.2],
-                 [0.2, 0.5, 0.4, 0.4, 0.4, 0.4, 0.5, 0.2],
-                 [0.0, 0.2, 0.2, 0.2, 0.2, 0.2, 0.2, 0.0]]
-
-rook_scores = [[0.25, 0.25, 0.25, 0.25, 0.25, 0.25, 0.25, 0.25],
-               [0.5, 0.75, 0.75, 0.75, 0.75, 0.75, 0.75, 0.5],
-               [0.0, 0.25, 0.25, 0.25, 0.25, 0.25, 0.25, 0.0],
-               [0.0, 0.25, 0.25, 0.25, 0.25, 0.25, 0.25, 0.0],
-               [0.0, 0.25, 0.25, 0.25, 0.25, 0.25, 0.25, 0.0],
-               [0.0, 0.25, 0.25, 0.25, 0.25, 0.25, 0.25, 0.0],
-               [0.0, 0.25, 0.25, 0.25, 0.25, 0.25, 0.25, 0.0],
-               [0.25, 0.25, 0.25, 0.5, 0.5, 0.25, 0.25, 0.25]]
-
-queen_scores = [[0.0, 0.2, 0.2, 0.3, 0.3, 0.2, 0.2, 0.0],
-                [0.2, 0.4, 0.4, 0.4, 0.4, 0.4, 0.4, 0.2],
-                [0.2, 0.4, 0.5, 0.5, 0.5, 0.5, 0.4, 0.2],
-                [0.3, 0.4, 0.5, 0.5, 0.5, 0.5, 0.4, 0.3],
-                [0.4, 0.4, 0.5, 0.5, 0.5, 0.5, 0.4, 0.3],
-                [0.2, 0.5, 0.5, 0.5, 0.5, 0.5, 0.4, 0.2],
-                [0.2, 0.4, 0.5, 0.4, 0.4, 0.4, 0.4, 0.2],
-                [0.0, 0.2, 0.2, 0.3, 0.3, 0.2, 0.2, 0.0]]
-
-pawn_scores = [[0.8, 0.8, 0.8, 0.8, 0.8, 0.8, 0.8, 0.8],
-               [0.7, 0.7, 0.7, 0.7, 0.7, 0.7, 0.7, 0.7],
-               [0.3, 0.3, 0.4, 0.5, 0.5, 0.4, 0.3, 0.3],
-               [0.25, 0.25, 0.3, 0.45, 0.45, 0.3, 0.25, 0.25],
-               [0.2, 0.2, 0.2, 0.4, 0.4, 0.2, 0.2, 0.2],
-               [0.25, 0.15, 0.1, 0.2, 0.2, 0.1, 0.15, 0.25],
-               [0.25, 0.3, 0.3, 0.0, 0.0, 0.3, 0.3, 0.25],
-               [0.2, 0.2, 0.2, 0.2, 0.2, 0.2, 0.2, 0.2]]
-
-piece_position_scores = {"N": knight_scores,
-                        "B": bishop_scores,
-                        "Q": queen_scores,
-                        "R": rook_scores,
-                        "P": pawn_scores}
-
-CHECKMATE = 1000
-STALEMATE = 0
-DEPTH = 3
-
-# Constants for move scoring (added for move ordering)
-CAPTURE_BONUS = 1000
-PROMOTION_BONUS = 900
-CHECK_BONUS = 50
-
-def score_move(board: chess.Board, move: chess.Move) -> int:
-    """
-    Assign a score to a move based on heuristics.
-    Higher score means better move.
-    """
-    score = 0
-
-    # 1. Captures (MVV-LVA: Most Valuable Victim - Least Valuable Aggressor)
-    if board.is_capture(move):
-        # Get the piece being captured (victim)
-        captured_piece_type = board.piece_type_at(move.to_square)
-        captured_value = piece_score.get(chess.Piece(captured_piece_type, not board.turn).symbol().upper(), 0)
-
-        # Get the piece making the capture (aggressor)
-        moving_piece_type = board.piece_type_at(move.from_square)
-        moving_value = piece_score.get(chess.Piece(moving_piece_type, board.turn).symbol().upper(), 0)
-
-        # Calculate a score based on MVV-LVA. Higher value for captured piece, lower for moving piece.
-        score += CAPTURE_BONUS + (captured_value * 10) - moving_value
-
-    # 2. Promotions
-    if move.promotion is not None:
-        # Give a big bonus for promotion, especially to a queen
-        promoted_value = piece_score.get(chess.Piece(move.promotion, board.turn).symbol().upper(), 0)
-        score += PROMOTION_BONUS + promoted_value
-
-    # 3. Checks
-    # Temporarily make the move to see if it results in a check
-    board.push(move)
-    if board.is_check():
-        score += CHECK_BONUS
-    board.pop() # Undo the move
-
-    return score
-
-
-def findBestMove(board, valid_moves, return_queue):
-    global next_move
-    next_move = None
-
-    # --- Start of Move Ordering ---
-    # Create a list of (score, move) tuples
-    scored_moves = []
-    for move in valid_moves:
-        score = score_move(board, move)
-        scored_moves.append((score, move))
-
-    # Sort moves in descending order of score
-    # The 'key=lambda x: x[0]' tells sorted() to sort based on the first element of each tuple (the score)
-    # 'reverse=True' ensures descending order (highest score first)
-    scored_moves.sort(key=lambda x: x[0], reverse=True)
-
-    # Extract only the moves in the new sorted order
-    ordered_moves = [move for score, move in scored_moves]
-    # --- End of Move Ordering ---
-
-    findMoveNegaMaxAlphaBeta(board, ordered_moves, DEPTH, -CHECKMATE, CHECKMATE,
-                             1 if board.turn == chess.WHITE else -1)
-    return_queue.put(next_move)
-
-def findMoveNegaMaxAlphaBeta(board, valid_moves, depth, alpha, beta, turn_multiplier):
-    global next_move
-    if depth == 0:
-        return turn_multiplier * scoreBoard(board)
-    
-    max_score = -CHECKMATE
-    for move in valid_moves: # Now iterates through ordered moves
-        board.push(move)
-        next_moves = list(board.legal_moves) # Legal moves are generated fresh for each new position
-        # Recurse with the newly generated legal moves for the child node
-        score = -findMoveNegaMaxAlphaBeta(board, next_moves, depth - 1, -beta, -alpha, -turn_multiplier)
-        if score > max_score:
-            max_score = score
-            if depth == DEPTH: # Only update next_move at the root depth
-                next_move = move
-        board.pop() # Undo the move
-        if max_score > alpha:
-            alpha = max_score
-        if alpha >= beta: # Alpha-beta cutoff
-            break
-    return max_score
-
-def scoreBoard(board):
-    """
-    Score the board. A positive score is good for white, a negative score is good for black.
-    """
-    if board.is_checkmate():
-        if board.turn == chess.WHITE:
-            return -CHECKMATE  # black wins
-        else:
-            return CHECKMATE  # white wins
-    elif board.is_stalemate():
-        return STALEMATE
-    
-    score = 0
-    for square in chess.SQUARES:
-        piece = board.piece_at(square)
-        if piece is not None:
-            piece_type = piece.symbol().upper()
-            
-            # Convert square to row/col for position scoring
-            row = 7 - (square // 8)  # chess.py uses 0-63, we need 0-7 rows
-            col = square % 8
-            
-            piece_position_score = 0
-            if piece_type != "K" and piece_type in piece_position_scores:
-                position_table = piece_position_scores[piece_type]
-                # For black pieces, flip the position table
-                if piece.color == chess.BLACK:
-                    position_table = position_table[::-1]
-                piece_position_score = position_table[row][col]
-            
-            piece_value = piece_score.get(piece_type, 0)
-            
-            if piece.color == chess.WHITE:
-                score += piece_value + piece_position_score
-            else:
-                score -= piece_value + piece_position_score
-
-    return score
-
-class ChessAI(MinimalEngine):
+class ChessAI(ChessAIEngine):
+    """The ChessAI search (see `engines/ChessAI.py`) with its own opening book."""
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.queue = Queue()
         self.book_path = "engines/books/Performance.bin" # Make sure this path is correct
-        logger.info("ChessAI engine initialized")
 
     def search(self, board: chess.Board, time_limit: Limit, ponder: bool, draw_offered: bool, root_moves: MOVE) -> PlayResult:
         """
         Search for the best move in the current position.
         """
         # First try to get a move from the opening book
-        try:
-            with chess.polyglot.open_reader(self.book_path) as reader:
-                entry = reader.get_weighted_choice(board)
-                if entry is not None:
-                    logger.info(f"Book move found: {entry.move}")
-                    return PlayResult(entry.move, None, draw_offered=draw_offered)
-        except Exception as e:
-            logger.warning(f"Error reading opening book: {e}")
+        if os.path.exists(self.book_path):
+            entry = get_book(self.book_path).lookup(board).weighted_choice()
+            if entry is not None and (not isinstance(root_moves, list) or entry.move in root_moves):
+                logger.info(f"Book move found: {entry.move}")
+                return PlayResult(entry.move, None, {"string": "lichess-bot-source:Opening Book"},
+                                  draw_offered=draw_offered)
 
         # If no book move is found, use the engine
-        # root_moves typically passed from the UCI/XBoard interface
-        valid_moves = root_moves if isinstance(root_moves, list) else list(board.legal_moves)
-        
-        logger.debug(f"Searching for best move among {len(valid_moves)} moves")
-        
-        # Call the engine's findBestMove function
-        # This will now use the sorted moves internally
-        findBestMove(board, valid_moves, self.queue)
-        best_move = self.queue.get()
+        if not (root_moves if isinstance(root_moves, list) else any(board.legal_moves)):
+            # This state implies no legal moves, e.g., checkmate or stalemate
+            logger.error("No legal moves available. Board is likely terminal.")
+            return PlayResult(None, None, resigned=True)
 
-        # If no move is found (shouldn't happen with legal_moves unless board is terminal),
-        # make a random move as a fallback.
-        if best_move is None:
-            logger.warning("No best move found, selecting random move")
-            # Ensure valid_moves is not empty before random.choice
-            if valid_moves:
-                best_move = random.choice(valid_moves)
-            else:
-                # This state implies no legal moves, e.g., checkmate or stalemate
-                # In a real engine, you'd handle this by returning a resignation or draw
-                logger.error("No legal moves available. Board is likely terminal.")
-                return PlayResult(None, None, resign=True) # Or handle as a draw
+        return super().search(board, time_limit, ponder, draw_offered, root_moves)
 
-        logger.info(f"Selected move: {best_move}")
-        return PlayResult(best_move, None, draw_offered=draw_offered)
 
-    def name(self) -> str:
-        return "ChessAI"
\ No newline at end of file
+class MCTS(ExampleEngine):
+    """
+    A Monte-Carlo tree search with the ChessAI evaluation (see `engines/mcts.py`). Requires NumPy.
+
+    The tree is kept between moves, so the playouts spent on the expected line are reused.
+    """
+
+    # The number of playouts when the limit has no time or node limit.
+    DEFAULT_PLAYOUTS = 20000
+
+    def __init__(self, commands: COMMANDS_TYPE, options: OPTIONS_GO_EGTB_TYPE, stderr: Optional[int],
+                 draw_or_resign: Configuration, game: Optional[model.Game] = None, name: Optional[str] = None,
+                 **popen_args: str) -> None:
+        super().__init__(commands, options, stderr, draw_or_resign, game, name, **popen_args)
+        from engines.mcts import MCTSTree, DEFAULT_CAPACITY
+        self.tree = MCTSTree(int(number_option(options, "TreeSize", DEFAULT_CAPACITY)))
+
+    def search(self, board: chess.Board, time_limit: Limit, ponder: bool, draw_offered: bool, root_moves: MOVE) -> PlayResult:
+        """Run playouts until the time, node, or depth limit is reached, and play the most visited move."""
+        from engines.mcts import value_to_centipawns
+        time_limit = self.add_go_commands(time_limit)
+        controller = self.search_controller
+        # There are no iterations to finish, so a clock search stops at the soft budget and a movetime search uses it all.
+        soft_limit, hard_limit = search_time_limits(board, time_limit)
+        on_clock = time_limit.white_clock is not None or time_limit.black_clock is not None
+        budget = soft_limit if on_clock else hard_limit
+        controller.start(time_limit, budget)
+        max_depth = controller.max_depth()
+        max_playouts = self.DEFAULT_PLAYOUTS if budget is None and time_limit.nodes is None else None
+
+        def should_stop(playouts: int) -> bool:
+            return (controller.should_stop(playouts)
+                    or (max_playouts is not None and playouts >= max_playouts)
+                    or (max_depth is not None and len(self.tree.principal_variation()) >= max_depth))
+
+        start = time.perf_counter()
+        self.tree.search(board, should_stop, root_moves if isinstance(root_moves, list) else None)
+        elapsed = time.perf_counter() - start
+
+        move = self.tree.best_move()
+        if move is None:
+            return PlayResult(None, None, resigned=True)
+        pv = self.tree.principal_variation()
+        playouts = self.tree.playouts
+        info: chess.engine.InfoDict = {"depth": len(pv),
+                                       "seldepth": self.tree.seldepth,
+                                       "nodes": playouts,
+                                       "nps": round(playouts / elapsed) if elapsed else 0,
+                                       "time": elapsed,
+                                       "pv": pv,
+                                       "score": chess.engine.PovScore(chess.engine.Cp(
+                                           value_to_centipawns(self.tree.root_value())), board.turn),
+                                       "string": f"tree {self.tree.size}/{self.tree.capacity} nodes"}
+        result = PlayResult(move, pv[1] if len(pv) > 1 else None, info, draw_offered=draw_offered)
+        return self.record_score(result, board)
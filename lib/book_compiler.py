@@ -0,0 +1,130 @@
+"""
+Merge the polyglot books configured for each variant into one book.
+
+`get_book_move` tries the books of a variant one after the other until one of them has a move, so with several books
+a position that is missing from the first ones costs one lookup per book. This tool merges them ahead of time:
+
+    python -m lib.book_compiler --config config.yml
+
+For each position, the merged book has the entries of the first book (in the order of the config) that
+`get_book_move` would have taken a move from, given the `selection`, `min_weight`, and `normalization` settings. So
+the bot picks its moves the same way, with one lookup. The entries are copied in book order, repeated moves included,
+since `best_move` and `uniform_random` weigh each entry on its own. With `uniform_random` or `best_move`, the entries
+below `min_weight` are left out, since they are never picked. The merged books are written to `merged_book_directory`,
+each one as a sorted polyglot file (`<variant>.bin`) with a small JSON header (`<variant>.json`) that records the books
+and settings it was made from.
+The bot uses a merged book only while its header matches the config and the books haven't changed.
+"""
+import argparse
+import heapq
+import itertools
+import json
+import logging
+import os
+import sys
+from collections.abc import Iterator
+from typing import Optional
+from lib.config import Configuration, load_config
+from lib.opening_book import ENTRY_STRUCT, Normalization, book_sources, merge_settings, merged_book_paths, write_book
+
+logger = logging.getLogger(__name__)
+
+# The key, raw move, weight, and learn value of an entry.
+RawEntry = tuple[int, int, int, int]
+
+
+def read_entries(path: str) -> Iterator[RawEntry]:
+    """Read the entries of a polyglot book in file order, which is sorted by key."""
+    with open(path, "rb") as book_file:
+        while chunk := book_file.read(ENTRY_STRUCT.size * 4096):
+            yield from ENTRY_STRUCT.iter_unpack(chunk[:len(chunk) - len(chunk) % ENTRY_STRUCT.size])
+
+
+def playable_entries(entries: list[RawEntry], selection: str, min_weight: float,
+                     normalization: Normalization) -> list[RawEntry]:
+    """
+    Get the entries of one book for one position that `get_book_move` could pick from.
+
+    :param entries: The entries, in book order.
+    :return: The entries that can be picked, in book order, or an empty list if the bot would go on to the next book.
+    """
+    # As in `BookPosition.scaled_weight`, only counting entries with a weight of at least 1.
+    counted = [weight for _, _, weight, _ in entries if weight >= 1]
+    scalar = (sum(counted) if normalization == "sum" and counted else
+              max(counted) if normalization == "max" and counted else 100)
+    threshold = min_weight * scalar / 100
+    if selection == "weighted_random":
+        return entries if counted else []
+    return [entry for entry in entries if entry[2] >= threshold]
+
+
+def merge_books(books: list[str], selection: str, min_weight: float, normalization: Normalization) -> Iterator[RawEntry]:
+    """
+    Merge books, sorted by key.
+
+    :param books: The books, first in precedence first.
+    :return: For each position, the playable entries of the first book that has any.
+    """
+    sources = [zip(read_entries(book), itertools.repeat(index)) for index, book in enumerate(books)]
+    merged = heapq.merge(*sources, key=lambda item: (item[0][0], item[1]))
+    for _, position in itertools.groupby(merged, key=lambda item: item[0][0]):
+        for _, book_entries in itertools.groupby(position, key=lambda item: item[1]):
+            entries = playable_entries([entry for entry, _ in book_entries], selection, min_weight, normalization)
+            if entries:
+                yield from entries
+                break
+
+
+def compile_book(books: list[str], directory: str, variant: str, selection: str, min_weight: float,
+                 normalization: Normalization) -> tuple[str, int]:
+    """
+    Merge the books of a variant and write the merged book with its header.
+
+    :return: The path of the merged book and the number of entries in it.
+    """
+    os.makedirs(directory, exist_ok=True)
+    book_path, header_path = merged_book_paths(directory, variant)
+    sources = book_sources(books)
+    count = write_book(book_path, merge_books(books, selection, min_weight, normalization))
+    header = {"variant": variant,
+              "sources": sources,
+              "settings": merge_settings(selection, min_weight, normalization),
+              "entries": count}
+    with open(header_path, "w") as header_file:
+        json.dump(header, header_file, indent=2)
+    return book_path, count
+
+
+def compile_books(polyglot_cfg: Configuration) -> list[tuple[str, int]]:
+    """Merge the books of every variant with more than one book in the `polyglot` section of the config."""
+    compiled = []
+    directory = polyglot_cfg.merged_book_directory
+    for variant, variant_books in polyglot_cfg.book.items():
+        books = [variant_books] if isinstance(variant_books, str) else list(variant_books or [])
+        if len(books) < 2:
+            continue
+        book_path, count = compile_book(books, directory, variant, polyglot_cfg.selection, polyglot_cfg.min_weight,
+                                        polyglot_cfg.normalization)
+        logger.info(f"Merged {len(books)} books for {variant} into {book_path} ({count} entries)")
+        compiled.append((book_path, count))
+    return compiled
+
+
+def main(arguments: Optional[list[str]] = None) -> int:
+    """Merge the books of a config from the command line."""
+    parser = argparse.ArgumentParser(description="Merge the polyglot books of each variant into one book.")
+    parser.add_argument("--config", default="./config.yml", help="The config file (defaults to ./config.yml).")
+    args = parser.parse_args(arguments)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    polyglot_cfg = load_config(args.config).engine.polyglot
+    if not polyglot_cfg.merged_book_directory:
+        logger.error("Set `engine:polyglot:merged_book_directory` in the config to merge the books.")
+        return 1
+    if not compile_books(polyglot_cfg):
+        logger.warning("No variant has more than one book to merge.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,200 @@
+"""
+Search the likely openings ahead of time, and store the engine's moves in a polyglot book.
+
+In fast games there is no time for a deep search, but the first moves of most games follow a small tree of openings.
+This tool grows that tree from the start position and lets the configured engine (UCI, XBoard, or homemade) search
+every position in it for a long time, in several processes at once:
+
+    python -m lib.book_precompute --config config.yml --depth 8 --time 30 --output engines/books/precomputed.bin
+
+The tree is grown one ply at a time. The moves from each position are the engine's own move, the moves with the
+highest weights in the books of `engine:polyglot:book`, and the moves played most often in the games in
+`pgn_directory` (or the PGN files given on the command line), which include the opponents' usual replies. The book
+has one entry per position: the engine's move, with a weight of 1 and the engine's score (in centipawns, for the side
+to move, see `opening_book.learn_to_score`) in the learn field. Put it first in `engine:polyglot:book` so the bot plays
+these moves without thinking.
+"""
+from __future__ import annotations
+import argparse
+import dataclasses
+import logging
+import multiprocessing
+import multiprocessing.pool
+import sys
+from typing import Optional
+import chess
+import chess.engine
+import chess.polyglot
+import chess.variant
+from lib.config import Configuration, change_value_to_list, load_config
+from lib.engine_wrapper import create_engine
+from lib.opening_book import decode_move, encode_move, get_book, score_to_learn, write_book
+from lib.pgn_book import GAMES, MoveStatistics, collect_statistics
+
+logger = logging.getLogger(__name__)
+
+MATE_SCORE = 100_000
+
+# The engine's move and score (in centipawns, for the side to move) in a position.
+Analysis = tuple[Optional[chess.Move], Optional[int]]
+
+
+def start_board(variant: str) -> chess.Board:
+    """Get the start position of a variant, named as in the `book` section of the config."""
+    if variant == "chess960":
+        raise ValueError("Chess960 has too many start positions to search ahead of time.")
+    return chess.variant.find_variant("chess" if variant == "standard" else variant)()
+
+
+def analyse_positions(arguments: tuple[Configuration, list[chess.Board], chess.engine.Limit]) -> list[Analysis]:
+    """
+    Search positions with the configured engine, in a process of the pool.
+
+    :param arguments: The config, the positions, and the limit of each search.
+    :return: The engine's move and score in each position.
+    """
+    config, boards, limit = arguments
+    analyses: list[Analysis] = []
+    # Like lichess-bot when it has no book move to suggest, so every legal move is searched.
+    all_moves = chess.engine.PlayResult(None, None)
+    with create_engine(config) as engine:
+        for board in boards:
+            result = engine.search(board, dataclasses.replace(limit), False, False, all_moves)
+            score = result.info.get("score")
+            analyses.append((result.move, score.relative.score(mate_score=MATE_SCORE) if score is not None else None))
+    return analyses
+
+
+def analyse_level(pool: multiprocessing.pool.Pool, processes: int, config: Configuration, boards: list[chess.Board],
+                  limit: chess.engine.Limit) -> list[Analysis]:
+    """Split the positions of one ply among the processes, each of which starts the engine once."""
+    slices = [boards[index::processes] for index in range(processes)]
+    results = pool.map(analyse_positions, [(config, positions, limit) for positions in slices if positions])
+    analyses: list[Analysis] = [(None, None)] * len(boards)
+    for index, slice_analyses in enumerate(results):
+        analyses[index::processes] = slice_analyses
+    return analyses
+
+
+def history_moves(statistics: MoveStatistics) -> dict[int, list[tuple[int, int]]]:
+    """Group the move statistics by position: the number of games and the encoded move of each move, most played first."""
+    moves: dict[int, list[tuple[int, int]]] = {}
+    for (key, raw_move), move_statistics in statistics.items():
+        moves.setdefault(key, []).append((int(move_statistics[GAMES]), raw_move))
+    for position_moves in moves.values():
+        position_moves.sort(reverse=True)
+    return moves
+
+
+def candidate_moves(board: chess.Board, engine_move: Optional[chess.Move], books: list[str],
+                    history: dict[int, list[tuple[int, int]]], book_moves: int, history_move_count: int) -> list[chess.Move]:
+    """
+    Get the moves that lead to the next ply of the tree.
+
+    :param engine_move: The engine's move in the position.
+    :param books: The books to take the moves with the highest weights from.
+    :param history: The moves of past games, from `history_moves`.
+    :param book_moves: How many moves to take from each book.
+    :param history_move_count: How many of the most played moves of past games to take.
+    """
+    moves = [engine_move] if engine_move is not None else []
+    for book in books:
+        entries = sorted((entry for entry in get_book(book).lookup(board).entries if entry.weight >= 1),
+                         key=lambda entry: -entry.weight)
+        moves.extend(entry.move for entry in entries[:book_moves])
+    for _, raw_move in history.get(chess.polyglot.zobrist_hash(board), [])[:history_move_count]:
+        move = decode_move(board, raw_move)
+        if board.is_legal(move):
+            moves.append(move)
+    return list(dict.fromkeys(moves))
+
+
+def precompute(config: Configuration, *, variant: str = "standard", depth: int = 6, search_time: float = 10.0,
+               processes: Optional[int] = None, book_moves: int = 3,
+               history_move_count: int = 3, max_positions: int = 5000,
+               statistics: Optional[MoveStatistics] = None) -> dict[int, tuple[int, int]]:
+    """
+    Grow the opening tree and search every position in it.
+
+    :param config: The bot's config. Its engine does the searching, and its books add moves to the tree.
+    :param variant: The variant, named as in the `book` section of the config.
+    :param depth: The number of plies to grow the tree to.
+    :param search_time: The seconds to search each position for. The engine's `go_commands` also apply.
+    :param processes: The number of processes, each running the engine. If `None`, one per CPU.
+    :param book_moves: How many moves to take from each book in each position.
+    :param history_move_count: How many of the most played moves of past games to take in each position.
+    :param max_positions: The most positions to search.
+    :param statistics: The moves of past games, from `pgn_book.collect_statistics`.
+    :return: The encoded engine move and score of each position, by Zobrist key.
+    """
+    limit = chess.engine.Limit(time=search_time)
+    processes = processes or multiprocessing.cpu_count()
+    polyglot_cfg = config.engine.polyglot
+    change_value_to_list(polyglot_cfg.config, "book", key=variant)
+    books = polyglot_cfg.book.lookup(variant)
+    history = history_moves(statistics or {})
+
+    board = start_board(variant)
+    seen = {chess.polyglot.zobrist_hash(board)}
+    level = [board]
+    results: dict[int, tuple[int, int]] = {}
+    with multiprocessing.Pool(processes) as pool:
+        for ply in range(depth + 1):
+            if not level:
+                break
+            logger.info(f"Searching {len(level)} positions at ply {ply}")
+            next_level = []
+            for board, (move, score) in zip(level, analyse_level(pool, processes, config, level, limit)):
+                if move is None:
+                    continue
+                results[chess.polyglot.zobrist_hash(board)] = (encode_move(board, move), score or 0)
+                if ply == depth:
+                    continue
+                for candidate in candidate_moves(board, move, books, history, book_moves, history_move_count):
+                    child = board.copy(stack=False)
+                    child.push(candidate)
+                    key = chess.polyglot.zobrist_hash(child)
+                    if key not in seen and len(seen) < max_positions and not child.is_game_over():
+                        seen.add(key)
+                        next_level.append(child)
+            level = next_level
+    return results
+
+
+def write_precomputed_book(path: str, results: dict[int, tuple[int, int]]) -> int:
+    """Write the engine's moves as a polyglot book, with the scores in the learn field."""
+    return write_book(path, ((key, raw_move, 1, score_to_learn(score))
+                             for key, (raw_move, score) in sorted(results.items())))
+
+
+def main(arguments: Optional[list[str]] = None) -> int:
+    """Search the opening tree from the command line."""
+    parser = argparse.ArgumentParser(description="Search the likely openings ahead of time and write a polyglot book.")
+    parser.add_argument("pgn", nargs="*",
+                        help="PGN files or directories of past games. Defaults to the `pgn_directory` of the config.")
+    parser.add_argument("--config", default="./config.yml", help="The config file (defaults to ./config.yml).")
+    parser.add_argument("--output", default="engines/books/precomputed.bin", help="The book file to write.")
+    parser.add_argument("--variant", default="standard", help="The variant to search.")
+    parser.add_argument("--depth", type=int, default=6, help="The number of plies to grow the tree to.")
+    parser.add_argument("--time", type=float, default=10.0, help="The seconds to search each position for.")
+    parser.add_argument("--processes", type=int, help="The number of engines to run at once (defaults to one per CPU).")
+    parser.add_argument("--book-moves", type=int, default=3, help="How many moves to take from each book.")
+    parser.add_argument("--history-moves", type=int, default=3, help="How many of the most played moves of past games "
+                                                                     "to take.")
+    parser.add_argument("--max-positions", type=int, default=5000, help="The most positions to search.")
+    args = parser.parse_args(arguments)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    config = load_config(args.config)
+    pgn_paths = args.pgn or ([config.pgn_directory] if config.pgn_directory else [])
+    statistics = collect_statistics(pgn_paths, args.variant, args.depth, processes=args.processes) if pgn_paths else {}
+    results = precompute(config, variant=args.variant, depth=args.depth, search_time=args.time, processes=args.processes,
+                         book_moves=args.book_moves, history_move_count=args.history_moves,
+                         max_positions=args.max_positions, statistics=statistics)
+    count = write_precomputed_book(args.output, results)
+    logger.info(f"Wrote {count} positions to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,9 +2,6 @@
 from __future__ import annotations
 import os
 import chess.engine
-import chess.polyglot
-import chess.syzygy
-import chess.gaviota
 import chess
 import subprocess
 import logging
@@ -13,10 +10,14 @@ import time
 import random
 import math
 import contextlib
+import dataclasses
+import threading
 from collections import Counter
 from collections.abc import Callable
 from lib import model, lichess
 from lib.config import Configuration, change_value_to_list
+from lib.opening_book import get_book, merged_book
+from lib.tablebase import GaviotaTablebase, SyzygyTablebase, get_gaviota_tablebase, get_syzygy_tablebase
 from lib.timer import Timer, msec, seconds, msec_str, sec_str, to_seconds
 from lib.lichess_types import (ReadableType, ChessDBMoveType, LichessEGTBMoveType, OPTIONS_GO_EGTB_TYPE, OPTIONS_TYPE,
                        COMMANDS_TYPE, MOVE, InfoStrDict, InfoDictKeys, InfoDictValue, GO_COMMANDS_TYPE, EGTPATH_TYPE,
@@ -158,6 +159,8 @@ class EngineWrapper:
         draw_or_resign_cfg = engine_cfg.draw_or_resign
         lichess_bot_tbs = engine_cfg.lichess_bot_tbs
 
+        ponder_result = self.stop_pondering(board)
+
         best_move: MOVE
         best_move = get_book_move(board, game, polyglot_cfg)
 
@@ -182,7 +185,12 @@ class EngineWrapper:
                                                is_correspondence, correspondence_move_time)
 
             try:
-                best_move = self.search(board, time_limit, can_ponder, draw_offered, best_move)
+                if (ponder_result is not None and (not isinstance(best_move, list) or ponder_result.move in best_move)
+                        and self.ponder_hit_is_enough(ponder_result, board, time_limit)):
+                    logger.info("Ponder hit")
+                    best_move = self.record_score(ponder_result, board)
+                else:
+                    best_move = self.search(board, time_limit, can_ponder, draw_offered, best_move)
             except chess.engine.EngineError as error:
                 BadMove = (chess.IllegalMoveError, chess.InvalidMoveError)
                 if not any(isinstance(e, BadMove) for e in error.args):
@@ -198,12 +206,70 @@ class EngineWrapper:
         if elapsed < min_time:
             time.sleep(to_seconds(min_time - elapsed))
 
-        self.add_comment(best_move, board)
+        self.send_move(board, game, li, best_move, can_ponder)
+
+    def send_move(self, board: chess.Board, game: model.Game, li: lichess.Lichess, result: chess.engine.PlayResult,
+                  can_ponder: bool) -> None:
+        """
+        Play the engine's move (or resign) on lichess.org, and start pondering if allowed.
+
+        :param board: The current position.
+        :param game: The game that the bot is playing.
+        :param li: Provides communication with lichess.org.
+        :param result: The engine's move.
+        :param can_ponder: Whether the engine is allowed to ponder.
+        """
+        if game.state.get("status", "started") != "started":
+            # The game ended while a homemade engine was thinking in the background.
+            logger.info("The game ended before the move could be played.")
+            return
+
+        self.add_comment(result, board)
         self.print_stats()
-        if best_move.resigned and len(board.move_stack) >= 2:
+        if result.resigned and len(board.move_stack) >= 2:
             li.resign(game.id)
         else:
-            li.make_move(game.id, best_move)
+            li.make_move(game.id, result)
+            if can_ponder:
+                self.start_pondering(board, result)
+
+    def start_pondering(self, board: chess.Board, result: chess.engine.PlayResult) -> None:
+        """
+        Think about the position after the expected reply while the opponent thinks.
+
+        python-chess does this for UCI and XBoard engines, so only homemade engines need to implement this.
+
+        :param board: The position before the bot's move.
+        :param result: The bot's move. `result.ponder` is the expected reply.
+        """
+
+    def stop_pondering(self, board: Optional[chess.Board] = None) -> Optional[chess.engine.PlayResult]:  # noqa: ARG002
+        """
+        Stop thinking on the opponent's time.
+
+        :param board: The current position.
+        :return: The result of pondering, if it was about `board`.
+        """
+        return None
+
+    def ponder_hit_is_enough(self, result: chess.engine.PlayResult, board: chess.Board,  # noqa: ARG002
+                             time_limit: chess.engine.Limit) -> bool:
+        """
+        Check whether the search done while pondering went as far as a search of the current move would.
+
+        Otherwise, the engine searches the move again, starting from what it learned while pondering. An engine that
+        budgets its time from the clock should override this to compare with its own budget.
+
+        :param result: The result of pondering.
+        :param board: The current position.
+        :param time_limit: The limits of the search of the current move.
+        :return: Whether pondering searched at least `time_limit.time` seconds or to at least `time_limit.depth`.
+        """
+        time_limit = self.add_go_commands(dataclasses.replace(time_limit))
+        depth = result.info.get("depth", 0)
+        elapsed = result.info.get("time", 0.0)
+        return ((time_limit.depth is not None and depth >= time_limit.depth)
+                or (time_limit.time is not None and elapsed >= time_limit.time))
 
     def add_go_commands(self, time_limit: chess.engine.Limit) -> chess.engine.Limit:
         """Add extra commands to send to the engine. For example, to search for 1000 nodes or up to depth 10."""
@@ -266,6 +332,16 @@ class EngineWrapper:
                                   ponder=ponder,
                                   draw_offered=draw_offered,
                                   root_moves=root_moves if isinstance(root_moves, list) else None)
+        return self.record_score(result, board)
+
+    def record_score(self, result: chess.engine.PlayResult, board: chess.Board) -> chess.engine.PlayResult:
+        """
+        Remember the engine's score for later draw/resign decisions, and offer a draw or resign if the scores call for it.
+
+        :param result: The engine's move. Its score is read from `result.info`.
+        :param board: The position the engine searched.
+        :return: The move with `draw_offered` and `resigned` set.
+        """
         # Use null_score to have no effect on draw/resign decisions
         null_score = chess.engine.PovScore(chess.engine.Mate(1), board.turn)
         self.scores.append(result.info.get("score", null_score))
@@ -526,6 +602,62 @@ class XBoardEngine(EngineWrapper):
         self.configure(options, game)
 
 
+class SearchController:
+    """
+    Decide when a homemade engine's search must stop, following the `chess.engine.Limit` it was given.
+
+    Call `start` before each search, and `should_stop` with the node count every few thousand nodes. When it returns
+    `True`, the search should unwind right away and play the best move it has found so far. An iterative deepening search
+    should not start an iteration deeper than `max_depth`. If anything reads `stop_event` before `start` (e.g. a quick
+    check before the main search), call `reset` as soon as the engine starts working on a move.
+    """
+
+    def __init__(self) -> None:
+        """Set up a controller with no limits."""
+        self.stop_event = threading.Event()
+        self.limit = chess.engine.Limit()
+        self.deadline: Optional[float] = None
+
+    def reset(self) -> None:
+        """Forget the limits and any stop request left over from the last search."""
+        self.limit = chess.engine.Limit()
+        self.deadline = None
+        self.stop_event.clear()
+
+    def start(self, limit: Optional[chess.engine.Limit] = None, hard_limit: Optional[float] = None) -> None:
+        """
+        Start a new search.
+
+        :param limit: The limits of the search (`nodes`, `depth`, `mate`, and `time`).
+        :param hard_limit: The most seconds the search may take. If `None`, `limit.time` is used. An engine that
+            budgets its time from the clock fields of `limit` should pass the hard limit it worked out.
+        """
+        self.reset()
+        self.limit = limit or chess.engine.Limit()
+        if hard_limit is None:
+            hard_limit = self.limit.time
+        self.deadline = time.perf_counter() + hard_limit if hard_limit is not None else None
+
+    def stop(self) -> None:
+        """Tell the search to stop. This can be called from another thread."""
+        self.stop_event.set()
+
+    def should_stop(self, nodes: int = 0) -> bool:
+        """
+        Check whether the search must stop now.
+
+        :param nodes: The nodes (or playouts) searched so far.
+        """
+        return (self.stop_event.is_set()
+                or (self.deadline is not None and time.perf_counter() >= self.deadline)
+                or (self.limit.nodes is not None and nodes >= self.limit.nodes))
+
+    def max_depth(self) -> Optional[int]:
+        """Get the deepest iteration to search: `limit.depth`, or enough plies to find a mate in `limit.mate` moves."""
+        depths = [self.limit.depth, 2 * self.limit.mate - 1 if self.limit.mate is not None else None]
+        return min((depth for depth in depths if depth is not None), default=None)
+
+
 class MinimalEngine(EngineWrapper):
     """
     Subclass this to prevent a few random errors.
@@ -553,6 +685,14 @@ class MinimalEngine(EngineWrapper):
 
         self.engine = FillerEngine(self, name=self.engine_name)
 
+        # Use this in `search` so the search can be stopped by a hard deadline or by `stop_search`.
+        self.search_controller = SearchController()
+
+        self.ponder_thread: Optional[threading.Thread] = None
+        self.ponder_board: Optional[chess.Board] = None
+        self.ponder_stop = threading.Event()
+        self.ponder_result: Optional[chess.engine.PlayResult] = None
+
     def get_pid(self) -> str:
         """Homemade engines don't have a pid, so we return a question mark."""
         return "?"
@@ -567,6 +707,68 @@ class MinimalEngine(EngineWrapper):
         """
         raise NotImplementedError("The search method is not implemented")
 
+    def stop_search(self) -> None:
+        """Tell a search that uses `self.search_controller` to stop and return its best move so far."""
+        self.search_controller.stop()
+
+    def quit(self) -> None:
+        """Stop searching and pondering, and tell the engine to shut down."""
+        self.stop_search()
+        self.stop_pondering()
+        super().quit()
+
+    def ponder(self, board: chess.Board, stop: threading.Event) -> Optional[chess.engine.PlayResult]:  # noqa: ARG002
+        """
+        Search while the opponent thinks.
+
+        Implement this in your homemade engine to ponder. It runs in a background thread. `search` must return the
+        expected reply as `PlayResult.ponder`. Search without a time limit: pondering lasts until the opponent moves.
+
+        :param board: The position after the expected reply.
+        :param stop: Set when the opponent has moved or the game is over. The search must return soon after.
+        :return: The move to play if the opponent plays the expected reply, or `None` if there isn't one yet.
+        """
+        return None
+
+    def start_pondering(self, board: chess.Board, result: chess.engine.PlayResult) -> None:
+        """Start `ponder` in a background thread, if `result` has an expected reply."""
+        self.stop_pondering()
+        if result.move is None or result.ponder is None:
+            return
+        ponder_board = board.copy()
+        ponder_board.push(result.move)
+        if not ponder_board.is_legal(result.ponder):
+            return
+        ponder_board.push(result.ponder)
+
+        def ponder_in_background() -> None:
+            self.ponder_result = self.ponder(ponder_board.copy(), self.ponder_stop)
+
+        self.ponder_board = ponder_board
+        self.ponder_result = None
+        self.ponder_stop.clear()
+        self.ponder_thread = threading.Thread(target=ponder_in_background, name="ponder", daemon=True)
+        self.ponder_thread.start()
+
+    def stop_pondering(self, board: Optional[chess.Board] = None) -> Optional[chess.engine.PlayResult]:
+        """
+        Stop the background search.
+
+        :param board: The current position.
+        :return: The result of pondering if `board` is the position that was pondered (a ponder hit).
+        """
+        if self.ponder_thread is None:
+            return None
+        self.ponder_stop.set()
+        self.ponder_thread.join()
+        self.ponder_thread = None
+        ponder_hit = (board is not None and self.ponder_board is not None
+                      and board.move_stack == self.ponder_board.move_stack)
+        result = self.ponder_result if ponder_hit else None
+        self.ponder_board = None
+        self.ponder_result = None
+        return result
+
     def notify(self, method_name: str, *args: ENGINE_INPUT_ARGS_TYPE, **kwargs: ENGINE_INPUT_KWARGS_TYPE
                ) -> Any:
         """
@@ -748,27 +950,22 @@ def get_book_move(board: chess.Board, game: model.Game,
 
     change_value_to_list(polyglot_cfg.config, "book", key=variant)
     books = polyglot_cfg.book.lookup(variant)
+    selection = polyglot_cfg.selection
+    merged = merged_book(polyglot_cfg.merged_book_directory, variant, books, selection, polyglot_cfg.min_weight,
+                         polyglot_cfg.normalization)
+    if merged:
+        books = [merged]
 
     for book in books:
-        with chess.polyglot.open_reader(book) as reader:
-            try:
-                selection = polyglot_cfg.selection
-                min_weight = polyglot_cfg.min_weight
-                normalization = polyglot_cfg.normalization
-                weights = [entry.weight for entry in reader.find_all(board)]
-                scalar = (sum(weights) if normalization == "sum" and weights else
-                          max(weights) if normalization == "max" and weights else 100)
-                min_weight = min_weight * scalar / 100
-
-                if selection == "weighted_random":
-                    move = reader.weighted_choice(board).move
-                elif selection == "uniform_random":
-                    move = reader.choice(board, minimum_weight=min_weight).move
-                elif selection == "best_move":
-                    move = reader.find(board, minimum_weight=min_weight).move
-            except IndexError:
-                # python-chess raises "IndexError" if no entries found.
-                move = None
+        position = get_book(book).lookup(board)
+        min_weight = position.scaled_weight(polyglot_cfg.min_weight, polyglot_cfg.normalization)
+        if selection == "weighted_random":
+            entry = position.weighted_choice()
+        elif selection == "uniform_random":
+            entry = position.uniform_choice(min_weight)
+        elif selection == "best_move":
+            entry = position.best(min_weight)
+        move = entry.move if entry is not None else None
 
         if move is not None:
             logger.info(f"Got move {move} from book {book} for game {game.id}")
@@ -1155,45 +1352,42 @@ def get_syzygy(board: chess.Board, game: model.Game,
     move: Union[chess.Move, list[chess.Move]]
     move_quality = syzygy_cfg.move_quality
 
-    with chess.syzygy.open_tablebase(syzygy_cfg.paths[0]) as tablebase:
-        for path in syzygy_cfg.paths[1:]:
-            tablebase.add_directory(path)
+    tablebase = get_syzygy_tablebase(syzygy_cfg.paths)
+    try:
+        moves = score_syzygy_moves(board, dtz_scorer, tablebase)
 
+        best_wdl = max(map(dtz_to_wdl, moves.values()))
+        good_moves = [(move, dtz) for move, dtz in moves.items() if dtz_to_wdl(dtz) == best_wdl]
+        if move_quality == "suggest" and len(good_moves) > 1:
+            move = [chess_move for chess_move, dtz in good_moves]
+            logger.info(f"Suggesting moves from syzygy (wdl: {best_wdl}) for game {game.id}")
+            return move, best_wdl
+        # There can be multiple moves with the same dtz.
+        best_dtz = min(good_moves, key=itemgetter(1))[1]
+        best_moves = [chess_move for chess_move, dtz in good_moves if dtz == best_dtz]
+        move = random.choice(best_moves)
+        logger.info(f"Got move {move.uci()} from syzygy (wdl: {best_wdl}, dtz: {best_dtz}) for game {game.id}")
+        return move, best_wdl
+    except KeyError:
+        # Attempt to only get the WDL score. It returns moves of quality="suggest", even if quality is set to "best".
         try:
-            moves = score_syzygy_moves(board, dtz_scorer, tablebase)
-
-            best_wdl = max(map(dtz_to_wdl, moves.values()))
-            good_moves = [(move, dtz) for move, dtz in moves.items() if dtz_to_wdl(dtz) == best_wdl]
-            if move_quality == "suggest" and len(good_moves) > 1:
-                move = [chess_move for chess_move, dtz in good_moves]
+            moves = score_syzygy_moves(board, lambda tablebase, b: -tablebase.probe_wdl(b), tablebase)
+            best_wdl = int(max(moves.values()))  # int is there only for mypy.
+            good_chess_moves = [chess_move for chess_move, wdl in moves.items() if wdl == best_wdl]
+            logger.debug("Found moves using 'move_quality'='suggest'. We didn't find an '.rtbz' file for this endgame."
+                         if move_quality == "best" else "")
+            if len(good_chess_moves) > 1:
+                move = good_chess_moves
                 logger.info(f"Suggesting moves from syzygy (wdl: {best_wdl}) for game {game.id}")
-                return move, best_wdl
-            # There can be multiple moves with the same dtz.
-            best_dtz = min(good_moves, key=itemgetter(1))[1]
-            best_moves = [chess_move for chess_move, dtz in good_moves if dtz == best_dtz]
-            move = random.choice(best_moves)
-            logger.info(f"Got move {move.uci()} from syzygy (wdl: {best_wdl}, dtz: {best_dtz}) for game {game.id}")
+            else:
+                move = good_chess_moves[0]
+                logger.info(f"Got move {move.uci()} from syzygy (wdl: {best_wdl}) for game {game.id}")
             return move, best_wdl
         except KeyError:
-            # Attempt to only get the WDL score. It returns moves of quality="suggest", even if quality is set to "best".
-            try:
-                moves = score_syzygy_moves(board, lambda tablebase, b: -tablebase.probe_wdl(b), tablebase)
-                best_wdl = int(max(moves.values()))  # int is there only for mypy.
-                good_chess_moves = [chess_move for chess_move, wdl in moves.items() if wdl == best_wdl]
-                logger.debug("Found moves using 'move_quality'='suggest'. We didn't find an '.rtbz' file for this endgame."
-                             if move_quality == "best" else "")
-                if len(good_chess_moves) > 1:
-                    move = good_chess_moves
-                    logger.info(f"Suggesting moves from syzygy (wdl: {best_wdl}) for game {game.id}")
-                else:
-                    move = good_chess_moves[0]
-                    logger.info(f"Got move {move.uci()} from syzygy (wdl: {best_wdl}) for game {game.id}")
-                return move, best_wdl
-            except KeyError:
-                return None, -3
+            return None, -3
 
 
-def dtz_scorer(tablebase: chess.syzygy.Tablebase, board: chess.Board) -> Union[int, float]:
+def dtz_scorer(tablebase: SyzygyTablebase, board: chess.Board) -> Union[int, float]:
     """
     Score a position based on a syzygy DTZ egtb.
 
@@ -1237,38 +1431,35 @@ def get_gaviota(board: chess.Board, game: model.Game,
     # because dtm >= dtz, so if abs(dtm) < 100 => abs(dtz) < 100, so wdl=2/-2.
     min_dtm_to_consider_as_wdl_1 = gaviota_cfg.min_dtm_to_consider_as_wdl_1
 
-    with chess.gaviota.open_tablebase(gaviota_cfg.paths[0]) as tablebase:
-        for path in gaviota_cfg.paths[1:]:
-            tablebase.add_directory(path)
+    tablebase = get_gaviota_tablebase(gaviota_cfg.paths)
+    try:
+        moves = score_gaviota_moves(board, dtm_scorer, tablebase)
 
-        try:
-            moves = score_gaviota_moves(board, dtm_scorer, tablebase)
-
-            best_wdl = max(map(dtm_to_gaviota_wdl, moves.values()))
-            good_moves = [(move, dtm) for move, dtm in moves.items() if dtm_to_gaviota_wdl(dtm) == best_wdl]
-            best_dtm = min(good_moves, key=itemgetter(1))[1]
-
-            pseudo_wdl = dtm_to_wdl(best_dtm, min_dtm_to_consider_as_wdl_1)
-            if move_quality == "suggest":
-                best_moves = good_enough_gaviota_moves(good_moves, best_dtm, min_dtm_to_consider_as_wdl_1)
-                if len(best_moves) > 1:
-                    move = [chess_move for chess_move, dtm in best_moves]
-                    logger.info(f"Suggesting moves from gaviota (pseudo wdl: {pseudo_wdl}) for game {game.id}")
-                else:
-                    move, dtm = best_moves[0]
-                    logger.info(f"Got move {move.uci()} from gaviota (pseudo wdl: {pseudo_wdl}, dtm: {dtm})"
-                                f" for game {game.id}")
+        best_wdl = max(map(dtm_to_gaviota_wdl, moves.values()))
+        good_moves = [(move, dtm) for move, dtm in moves.items() if dtm_to_gaviota_wdl(dtm) == best_wdl]
+        best_dtm = min(good_moves, key=itemgetter(1))[1]
+
+        pseudo_wdl = dtm_to_wdl(best_dtm, min_dtm_to_consider_as_wdl_1)
+        if move_quality == "suggest":
+            best_moves = good_enough_gaviota_moves(good_moves, best_dtm, min_dtm_to_consider_as_wdl_1)
+            if len(best_moves) > 1:
+                move = [chess_move for chess_move, dtm in best_moves]
+                logger.info(f"Suggesting moves from gaviota (pseudo wdl: {pseudo_wdl}) for game {game.id}")
             else:
-                # There can be multiple moves with the same dtm.
-                best_moves = [(move, dtm) for move, dtm in good_moves if dtm == best_dtm]
-                move, dtm = random.choice(best_moves)
-                logger.info(f"Got move {move.uci()} from gaviota (pseudo wdl: {pseudo_wdl}, dtm: {dtm}) for game {game.id}")
-            return move, pseudo_wdl
-        except KeyError:
-            return None, -3
+                move, dtm = best_moves[0]
+                logger.info(f"Got move {move.uci()} from gaviota (pseudo wdl: {pseudo_wdl}, dtm: {dtm})"
+                            f" for game {game.id}")
+        else:
+            # There can be multiple moves with the same dtm.
+            best_moves = [(move, dtm) for move, dtm in good_moves if dtm == best_dtm]
+            move, dtm = random.choice(best_moves)
+            logger.info(f"Got move {move.uci()} from gaviota (pseudo wdl: {pseudo_wdl}, dtm: {dtm}) for game {game.id}")
+        return move, pseudo_wdl
+    except KeyError:
+        return None, -3
 
 
-def dtm_scorer(tablebase: Union[chess.gaviota.NativeTablebase, chess.gaviota.PythonTablebase], board: chess.Board) -> int:
+def dtm_scorer(tablebase: GaviotaTablebase, board: chess.Board) -> int:
     """Score a position based on a gaviota DTM egtb."""
     dtm = -tablebase.probe_dtm(board)
     return dtm + int(math.copysign(board.halfmove_clock, dtm) if dtm else 0)
@@ -1365,9 +1556,9 @@ def piecewise_function(range_definitions: list[tuple[float, Literal["e", "i"], i
 
 
 def score_syzygy_moves(board: chess.Board,
-                       scorer: Union[Callable[[chess.syzygy.Tablebase, chess.Board], int],
-                                     Callable[[chess.syzygy.Tablebase, chess.Board], Union[int, float]]],
-                       tablebase: chess.syzygy.Tablebase) -> dict[chess.Move, Union[int, float]]:
+                       scorer: Union[Callable[[SyzygyTablebase, chess.Board], int],
+                                     Callable[[SyzygyTablebase, chess.Board], Union[int, float]]],
+                       tablebase: SyzygyTablebase) -> dict[chess.Move, Union[int, float]]:
     """Score all the moves using syzygy egtbs."""
     moves = {}
     for move in board.legal_moves:
@@ -1378,10 +1569,8 @@ def score_syzygy_moves(board: chess.Board,
 
 
 def score_gaviota_moves(board: chess.Board,
-                        scorer: Callable[[Union[chess.gaviota.NativeTablebase, chess.gaviota.PythonTablebase],
-                                          chess.Board], int],
-                        tablebase: Union[chess.gaviota.NativeTablebase, chess.gaviota.PythonTablebase]
-                        ) -> dict[chess.Move, int]:
+                        scorer: Callable[[GaviotaTablebase, chess.Board], int],
+                        tablebase: GaviotaTablebase) -> dict[chess.Move, int]:
     """Score all the moves using gaviota egtbs."""
     moves = {}
     for move in board.legal_moves:
@@ -24,6 +24,7 @@ import glob
 import platform
 import importlib.metadata
 import contextlib
+import threading
 from lib.config import load_config, Configuration, log_config
 from lib.conversation import Conversation, ChatLine
 from lib.timer import Timer, seconds, msec, hours, to_seconds
@@ -34,7 +35,7 @@ from requests.exceptions import (ChunkedEncodingError, ConnectionError as Reques
                                  RequestException)
 from rich.logging import RichHandler
 from collections import defaultdict
-from collections.abc import Iterator, MutableSequence
+from collections.abc import Callable, Iterator, MutableSequence
 from http.client import RemoteDisconnected
 from queue import Empty
 from multiprocessing.pool import Pool
@@ -70,6 +71,9 @@ class VersioningType(TypedDict):
 
 logger = logging.getLogger(__name__)
 
+# How often to tell a homemade engine to stop until its search ends, when a game ends while it thinks (in seconds).
+CANCEL_CHECK_INTERVAL = 0.1
+
 with open("lib/versioning.yml") as version_file:
     versioning_info: VersioningType = yaml.safe_load(version_file)
 
@@ -688,10 +692,12 @@ def play_game(li: lichess.Lichess,
         board = chess.Board()
         game_stream = itertools.chain([json.dumps(game.state).encode("utf-8")], lines)
         quit_after_all_games_finish = config.quit_after_all_games_finish
+        engine_moves = EngineMoves(engine)
         stay_in_game = True
         while stay_in_game and (not stop.terminated or quit_after_all_games_finish) and not stop.force_quit:
-            move_attempted = False
+            move_attempted = engine_moves.has_finished()
             try:
+                engine_moves.finish(wait=False)
                 upd = next_update(game_stream)
                 u_type = upd["type"] if upd else "ping"
                 if u_type == "chatLine":
@@ -707,18 +713,24 @@ def play_game(li: lichess.Lichess,
                         setup_timer = Timer()
                         print_move_number(board)
                         move_attempted = True
-                        engine.play_move(board,
-                                         game,
-                                         li,
-                                         setup_timer,
-                                         move_overhead,
-                                         can_ponder,
-                                         is_correspondence,
-                                         correspondence_move_time,
-                                         engine_cfg,
-                                         fake_think_time(config, board, game))
-                        time.sleep(to_seconds(delay))
+
+                        def play_move(board: chess.Board = board, setup_timer: Timer = setup_timer) -> None:
+                            engine.play_move(board,
+                                             game,
+                                             li,
+                                             setup_timer,
+                                             move_overhead,
+                                             can_ponder,
+                                             is_correspondence,
+                                             correspondence_move_time,
+                                             engine_cfg,
+                                             fake_think_time(config, board, game))
+                            time.sleep(to_seconds(delay))
+
+                        engine_moves.play(play_move)
                     elif is_game_over(game):
+                        # The game may have ended (e.g. the opponent resigned) while the engine was thinking.
+                        engine_moves.cancel()
                         tell_user_game_result(game, board)
                         engine.send_game_result(game, board)
                         conversation.send_message("player", goodbye)
@@ -742,11 +754,89 @@ def play_game(li: lichess.Lichess,
                 stopped = isinstance(e, StopIteration)
                 stay_in_game = not stopped and (move_attempted or game_is_active(li, game.id))
 
+        engine_moves.cancel()
         pgn_record = try_get_pgn_game_record(li, config, game, board, engine)
     final_queue_entries(control_queue, correspondence_queue, game, is_correspondence, pgn_record, pgn_queue)
     delete_takeback_record(game)
 
 
+class BackgroundMove:
+    """Play a move in a background thread, so the game stream can be read while a homemade engine thinks."""
+
+    def __init__(self, play_move: Callable[[], None]) -> None:
+        """:param play_move: Searches for a move and sends it to lichess.org."""
+        self.error: Optional[Exception] = None
+        self.thread = threading.Thread(target=self.run, args=(play_move,), name="move", daemon=True)
+        self.thread.start()
+
+    def run(self, play_move: Callable[[], None]) -> None:
+        """Play the move, and keep any error so `finish` can raise it in the game's thread."""
+        try:
+            play_move()
+        except Exception as error:
+            self.error = error
+
+    def is_alive(self) -> bool:
+        """Check whether the engine is still thinking or sending its move."""
+        return self.thread.is_alive()
+
+    def finish(self) -> None:
+        """Wait for the move to be played, and raise the error that playing it caused, if any."""
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def cancel(self, engine: engine_wrapper.EngineWrapper) -> None:
+        """Stop the engine's search and wait for the thread to end. The move isn't sent if the game is over."""
+        if isinstance(engine, engine_wrapper.MinimalEngine):
+            # Keep asking, in case the search hadn't started when it was first told to stop.
+            while self.thread.is_alive():
+                engine.stop_search()
+                self.thread.join(CANCEL_CHECK_INTERVAL)
+        self.thread.join()
+        if self.error is not None:
+            logger.debug(f"Error from the canceled move: {self.error}")
+
+
+class EngineMoves:
+    """Play the engine's moves. Homemade engines think in another thread, so the game stream is read while they search."""
+
+    def __init__(self, engine: engine_wrapper.EngineWrapper) -> None:
+        """:param engine: The engine playing the game."""
+        self.engine = engine
+        self.background_move: Optional[BackgroundMove] = None
+
+    def play(self, play_move: Callable[[], None]) -> None:
+        """Play a move, after the previous move has been sent."""
+        self.finish()
+        if isinstance(self.engine, engine_wrapper.MinimalEngine):
+            self.background_move = BackgroundMove(play_move)
+        else:
+            play_move()
+
+    def has_finished(self) -> bool:
+        """Check whether a move played in the background has been sent (or failed) and is waiting for `finish`."""
+        return self.background_move is not None and not self.background_move.is_alive()
+
+    def finish(self, wait: bool = True) -> None:
+        """
+        Wait for the move being played in the background, if any, and raise the error that playing it caused.
+
+        :param wait: Whether to wait for a move that is still being played. If `False`, such a move is left alone.
+        """
+        background_move = self.background_move
+        if background_move is None or (background_move.is_alive() and not wait):
+            return
+        self.background_move = None
+        background_move.finish()
+
+    def cancel(self) -> None:
+        """Stop the move being played in the background, if any, without sending it."""
+        if self.background_move is not None:
+            self.background_move.cancel(self.engine)
+            self.background_move = None
+
+
 def read_takeback_record(game: model.Game) -> int:
     """Read the number of move takeback requests accepeted in a game."""
     try:
@@ -0,0 +1,279 @@
+"""
+Polyglot opening books that stay open for the life of the process.
+
+`get_book` opens each book the first time it is asked for and keeps it, so the game processes of the bot open every
+book once instead of once per move. The books are memory-mapped, so the processes share one copy of them through the
+page cache. A position is looked up with one binary search over the book's sorted keys, which gives all of its entries
+together with their cumulative weights, so every way of choosing a book move costs a single lookup.
+
+When several books are configured for a variant, `lib/book_compiler.py` can merge them into one book ahead of time.
+`merged_book` finds it, so that a position missing from the first books costs one lookup instead of one per book. A
+book that is merged again while the bot runs is picked up at the next lookup.
+"""
+from __future__ import annotations
+import bisect
+import itertools
+import json
+import logging
+import os
+import random
+import struct
+import threading
+import chess
+import chess.polyglot
+from collections.abc import Iterable
+from typing import Any, Literal, Optional
+
+logger = logging.getLogger(__name__)
+
+Normalization = Literal["none", "sum", "max"]
+# A polyglot entry: the key, the move, the weight, and the learn field, all big-endian.
+ENTRY_STRUCT = struct.Struct(">QHHI")
+
+
+class BookPosition:
+    """The entries of a position in a book, with their cumulative weights."""
+
+    def __init__(self, entries: list[chess.polyglot.Entry]) -> None:
+        """:param entries: The entries of the position with a legal move, in book order."""
+        self.entries = entries
+        self.cumulative_weights = list(itertools.accumulate(entry.weight for entry in entries))
+
+    def __bool__(self) -> bool:
+        """Whether the book has any entries for the position."""
+        return bool(self.entries)
+
+    def total_weight(self) -> int:
+        """Get the sum of the weights of the entries."""
+        return self.cumulative_weights[-1] if self.cumulative_weights else 0
+
+    def max_weight(self) -> int:
+        """Get the highest weight of the entries."""
+        return max((entry.weight for entry in self.entries), default=0)
+
+    def scaled_weight(self, min_weight: float, normalization: Normalization) -> float:
+        """
+        Turn a minimum weight given in percent into a minimum weight for the entries of this position.
+
+        :param min_weight: The minimum weight. With `normalization` set to "none", it is used as it is.
+        :param normalization: "sum" makes `min_weight` a percentage of the total weight and "max" a percentage of the
+            highest weight.
+        """
+        # Entries with a weight of 0 don't count, so a position with only those is scaled by 100.
+        weighted = self.total_weight() > 0
+        scalar = (self.total_weight() if normalization == "sum" and weighted else
+                  self.max_weight() if normalization == "max" and weighted else 100)
+        return min_weight * scalar / 100
+
+    def weighted_choice(self, rng: Optional[random.Random] = None) -> Optional[chess.polyglot.Entry]:
+        """Choose an entry at random, with a chance in proportion to its weight."""
+        total = self.total_weight()
+        if total <= 0:
+            return None
+        choice = (rng or random).randint(0, total - 1)
+        return self.entries[bisect.bisect_right(self.cumulative_weights, choice)]
+
+    def uniform_choice(self, min_weight: float = 1, rng: Optional[random.Random] = None) -> Optional[chess.polyglot.Entry]:
+        """Choose an entry at random, among the ones with a weight of at least `min_weight`."""
+        entries = [entry for entry in self.entries if entry.weight >= min_weight]
+        return (rng or random).choice(entries) if entries else None
+
+    def best(self, min_weight: float = 1) -> Optional[chess.polyglot.Entry]:
+        """Get the first entry with the highest weight, if it is at least `min_weight`."""
+        entries = [entry for entry in self.entries if entry.weight >= min_weight]
+        return max(entries, key=lambda entry: entry.weight) if entries else None
+
+
+class OpeningBook:
+    """A memory-mapped polyglot book."""
+
+    def __init__(self, path: str) -> None:
+        """:param path: The book file."""
+        self.path = path
+        self.reader = chess.polyglot.MemoryMappedReader(path)
+
+    def lookup(self, board: chess.Board) -> BookPosition:
+        """Get the entries of a position, including the ones with a weight of 0."""
+        return BookPosition(list(self.reader.find_all(board, minimum_weight=0)))
+
+    def close(self) -> None:
+        """Close the book file."""
+        self.reader.close()
+
+
+_books: dict[str, OpeningBook] = {}
+_books_lock = threading.Lock()
+
+
+def get_book(path: str) -> OpeningBook:
+    """
+    Get a book, opening it if this process hasn't opened it yet.
+
+    :param path: The book file.
+    :return: The book, which is shared by every caller in the process. Don't close it.
+    """
+    key = os.path.abspath(path)
+    book = _books.get(key)
+    if book is None:
+        with _books_lock:
+            book = _books.get(key)
+            if book is None:
+                book = _books[key] = OpeningBook(path)
+    return book
+
+
+def close_books() -> None:
+    """Close all the books opened by `get_book`, and forget the merged books found by `merged_book`."""
+    with _books_lock:
+        for book in _books.values():
+            book.close()
+        _books.clear()
+        _merged_books.clear()
+
+
+def encode_move(board: chess.Board, move: chess.Move) -> int:
+    """
+    Get the polyglot encoding of a move.
+
+    :param board: The position before the move.
+    :param move: The move. Castling is stored as the king taking its own rook.
+    """
+    to_square = move.to_square
+    if not board.chess960 and board.is_castling(move):
+        rook_file = 7 if chess.square_file(to_square) > chess.square_file(move.from_square) else 0
+        to_square = chess.square(rook_file, chess.square_rank(move.from_square))
+    promotion = move.promotion - 1 if move.promotion else 0
+    return to_square | move.from_square << 6 | promotion << 12
+
+
+def decode_move(board: chess.Board, raw_move: int) -> chess.Move:
+    """
+    Get a move from its polyglot encoding.
+
+    :param board: The position before the move.
+    :param raw_move: The encoded move, as written by `encode_move`.
+    """
+    from_square = raw_move >> 6 & 0o77
+    to_square = raw_move & 0o77
+    promotion = raw_move >> 12 & 0x7
+    if (not board.chess960 and board.kings & chess.BB_SQUARES[from_square]
+            and board.rooks & board.occupied_co[board.turn] & chess.BB_SQUARES[to_square]):
+        king_file = 6 if chess.square_file(to_square) > chess.square_file(from_square) else 2
+        to_square = chess.square(king_file, chess.square_rank(from_square))
+    return chess.Move(from_square, to_square, promotion + 1 if promotion else None)
+
+
+def score_to_learn(score: int) -> int:
+    """Store a score (in centipawns) in the 32-bit learn field of an entry."""
+    return score & 0xFFFFFFFF
+
+
+def learn_to_score(learn: int) -> int:
+    """Get a score stored by `score_to_learn`."""
+    return learn - (1 << 32) if learn & (1 << 31) else learn
+
+
+def write_book(path: str, entries: Iterable[tuple[int, int, int, int]]) -> int:
+    """
+    Write a polyglot book.
+
+    The book is written to a temporary file that replaces `path` at the end, so a process reading the old book
+    never sees a half-written one.
+
+    :param path: The book file.
+    :param entries: The key, raw move, weight, and learn value of each entry, sorted by key.
+    :return: The number of entries written.
+    """
+    count = 0
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "wb") as book_file:
+        for entry in entries:
+            book_file.write(ENTRY_STRUCT.pack(*entry))
+            count += 1
+    os.replace(temporary_path, path)
+    return count
+
+
+def merged_book_paths(directory: str, variant: str) -> tuple[str, str]:
+    """Get the merged book of a variant and its header."""
+    return os.path.join(directory, f"{variant}.bin"), os.path.join(directory, f"{variant}.json")
+
+
+def book_sources(books: list[str]) -> list[dict[str, Any]]:
+    """Describe the books merged into a merged book, to tell when one of them has changed."""
+    sources = []
+    for book in books:
+        status = os.stat(book)
+        sources.append({"path": book, "size": status.st_size, "mtime_ns": status.st_mtime_ns})
+    return sources
+
+
+def merge_settings(selection: str, min_weight: float, normalization: Normalization) -> dict[str, Any]:
+    """Get the book settings that decide what goes into a merged book."""
+    return {"selection": selection, "min_weight": min_weight, "normalization": normalization}
+
+
+def file_signature(path: str) -> Optional[tuple[int, int]]:
+    """Get the size and modification time of a file, or `None` if it doesn't exist."""
+    try:
+        status = os.stat(path)
+    except OSError:
+        return None
+    return status.st_size, status.st_mtime_ns
+
+
+def forget_books(paths: Iterable[str]) -> None:
+    """Make `get_book` open these books again, e.g. after they were replaced. Readers of the old files keep them."""
+    with _books_lock:
+        for path in paths:
+            _books.pop(os.path.abspath(path), None)
+
+
+# The answer of `merged_book` for each set of arguments, with the signatures of the files it was worked out from.
+_merged_books: dict[tuple[Any, ...], tuple[tuple[Optional[tuple[int, int]], ...], Optional[str]]] = {}
+
+
+def merged_book(directory: Optional[str], variant: str, books: list[str], selection: str, min_weight: float,
+                normalization: Normalization) -> Optional[str]:
+    """
+    Find the merged book of a variant.
+
+    The merged book is only used if its header shows that it was made from the same books, unchanged since, with
+    the same settings. The answer is kept until the books, the merged book, or its header change on disk, which is
+    checked with a few `os.stat` calls per lookup.
+
+    :param directory: Where `lib/book_compiler.py` writes the merged books.
+    :param variant: The variant, named as in the `book` section of the config.
+    :param books: The books configured for the variant.
+    :return: The path of the merged book, or `None` if there is no usable one.
+    """
+    if not directory or len(books) < 2:
+        return None
+    cache_key = (directory, variant, tuple(books), selection, min_weight, normalization)
+    book_path, header_path = merged_book_paths(directory, variant)
+    files = [*books, book_path, header_path]
+    signature = tuple(file_signature(file) for file in files)
+    cached = _merged_books.get(cache_key)
+    if cached is not None:
+        cached_signature, cached_path = cached
+        if cached_signature == signature:
+            return cached_path
+        # The files were replaced, so the books opened before hold the old contents.
+        forget_books(files)
+
+    path = None
+    try:
+        with open(header_path) as header_file:
+            header = json.load(header_file)
+        if header.get("settings") != merge_settings(selection, min_weight, normalization):
+            logger.info(f"Not using {book_path}: it was merged with different book settings.")
+        elif header.get("sources") != book_sources(books):
+            logger.info(f"Not using {book_path}: the books it was merged from have changed.")
+        elif os.path.getsize(book_path) != header.get("entries", -1) * ENTRY_STRUCT.size:
+            logger.info(f"Not using {book_path}: its size doesn't match its header.")
+        else:
+            path = book_path
+    except (OSError, ValueError):
+        pass
+    _merged_books[cache_key] = signature, path
+    return path
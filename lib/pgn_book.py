@@ -0,0 +1,254 @@
+"""
+Make a polyglot opening book out of the bot's own games.
+
+The games that lichess-bot writes to `pgn_directory` have the result of each game and the bot's score after each of
+its moves. This tool goes through them with a pool of processes and collects, for each position and move, how often
+the move was played, how it scored, and what the bot's search thought of it:
+
+    python -m lib.pgn_book --config config.yml --output engines/books/own_games.bin
+
+Add the book to `engine:polyglot:book` so the bot plays the moves of its past games without searching them again.
+The weight of a move is `WEIGHT_SCALE` times the number of games times its quality. The quality is the share of
+points the move scored (counting one extra draw, so a move played once doesn't look perfect), mixed with the winning
+chance of the bot's average score after the move, if the games have scores. Moves whose quality is below
+`--min-score` are left out.
+
+Large PGN files (with `pgn_file_grouping` set to "opponent" or "all") are split into pieces at the start of a game
+(an `[Event` tag), so they are read in parallel too.
+"""
+from __future__ import annotations
+import argparse
+import io
+import logging
+import multiprocessing
+import os
+import sys
+from collections.abc import Iterator
+from typing import BinaryIO, Optional
+import chess
+import chess.engine
+import chess.pgn
+import chess.polyglot
+from lib.config import load_config
+from lib.opening_book import encode_move, write_book
+
+logger = logging.getLogger(__name__)
+
+# (file, start offset, end offset) of a piece of a PGN file.
+Chunk = tuple[str, int, int]
+# The number of games, the points scored, and the sum and number of the bot's scores (in centipawns, for the side that
+# moved) for a (position key, polyglot move).
+MoveStatistics = dict[tuple[int, int], list[float]]
+
+GAMES = 0
+POINTS = 1
+SCORE_SUM = 2
+SCORE_COUNT = 3
+
+GAME_START = b"\n[Event "
+CHUNK_SIZE = 1 << 22
+BLOCK_SIZE = 1 << 16
+WEIGHT_SCALE = 100
+RESULT_POINTS = {"1-0": (1.0, 0.0), "0-1": (0.0, 1.0), "1/2-1/2": (0.5, 0.5)}
+
+
+def variant_name(board: chess.Board) -> str:
+    """Get the name of the board's variant, as in the `book` section of the config."""
+    if board.chess960:
+        return "chess960"
+    return "standard" if board.uci_variant == "chess" else str(board.uci_variant)
+
+
+def pgn_files(paths: list[str]) -> Iterator[str]:
+    """Get the PGN files among `paths` and in the directories among them."""
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, _, file_names in sorted(os.walk(path)):
+                yield from (os.path.join(directory, name) for name in sorted(file_names) if name.endswith(".pgn"))
+        else:
+            yield path
+
+
+def next_game_offset(pgn_file: BinaryIO, position: int) -> int:
+    """
+    Find where the first game at or after `position` starts.
+
+    :param pgn_file: The PGN file, opened in binary mode.
+    :param position: An offset in the file.
+    :return: The offset of the start of the game, or the size of the file if no game starts after `position`.
+    """
+    if position <= 0:
+        return 0
+    pgn_file.seek(position - 1)
+    base = position - 1
+    data = b""
+    while block := pgn_file.read(BLOCK_SIZE):
+        data += block
+        index = data.find(GAME_START)
+        if index >= 0:
+            return base + index + 1
+        # Keep the end of the data, in case a game start is split between blocks.
+        kept = len(GAME_START) - 1
+        base += len(data) - kept
+        data = data[-kept:]
+    return base + len(data)
+
+
+def file_chunks(paths: list[str], chunk_size: int = CHUNK_SIZE) -> list[Chunk]:
+    """Split the PGN files into pieces of about `chunk_size` bytes that start at the start of a game."""
+    chunks: list[Chunk] = []
+    for path in pgn_files(paths):
+        size = os.path.getsize(path)
+        with open(path, "rb") as pgn_file:
+            starts = sorted({next_game_offset(pgn_file, position) for position in range(0, size, chunk_size)} | {size})
+        chunks.extend((path, start, end) for start, end in zip(starts, starts[1:]))
+    return chunks
+
+
+def move_score(node: chess.pgn.ChildNode) -> Optional[chess.engine.PovScore]:
+    """
+    Get the bot's score after a move of a game.
+
+    lichess-bot writes the score on the move itself, or at the end of the principal variation, which is a side line
+    that starts with the move.
+    """
+    score = node.eval()
+    if score is not None:
+        return score
+    for variation in node.parent.variations[1:]:
+        if variation.move == node.move:
+            return variation.end().eval()
+    return None
+
+
+def read_statistics(chunk: Chunk, variant: str = "standard", max_ply: int = 40,
+                    player: Optional[str] = None) -> MoveStatistics:
+    """
+    Collect the move statistics of the games in a piece of a PGN file.
+
+    :param chunk: The file and the offsets of the piece.
+    :param variant: Only games of this variant are read.
+    :param max_ply: Only the moves up to this ply are counted.
+    :param player: If given, only the moves of the player with this name are counted.
+    :return: The statistics of each position and move. Games without a result are skipped.
+    """
+    path, start, end = chunk
+    with open(path, "rb") as pgn_file:
+        pgn_file.seek(start)
+        text = pgn_file.read(end - start).decode("utf-8", errors="replace")
+
+    statistics: MoveStatistics = {}
+    pgn = io.StringIO(text)
+    while (game := chess.pgn.read_game(pgn)) is not None:
+        points = RESULT_POINTS.get(game.headers.get("Result", "*"))
+        board = game.board()
+        if points is None or variant_name(board) != variant:
+            continue
+        names = {chess.WHITE: game.headers.get("White"), chess.BLACK: game.headers.get("Black")}
+        for node in game.mainline():
+            if board.ply() >= max_ply:
+                break
+            if player is None or names[board.turn] == player:
+                entry = statistics.setdefault((chess.polyglot.zobrist_hash(board), encode_move(board, node.move)),
+                                              [0, 0.0, 0.0, 0])
+                entry[GAMES] += 1
+                entry[POINTS] += points[0 if board.turn == chess.WHITE else 1]
+                score = move_score(node)
+                if score is not None:
+                    entry[SCORE_SUM] += score.pov(board.turn).score(mate_score=10_000)
+                    entry[SCORE_COUNT] += 1
+            board.push(node.move)
+    return statistics
+
+
+def read_chunk(arguments: tuple[Chunk, str, int, Optional[str]]) -> MoveStatistics:
+    """Call `read_statistics` in a process of the pool."""
+    return read_statistics(*arguments)
+
+
+def move_quality(statistics: list[float], score_weight: float) -> float:
+    """
+    Rate a move from 0 to 1.
+
+    :param statistics: The statistics of the move.
+    :param score_weight: How much the bot's scores count, if there are any. The rest is the points the move scored.
+    """
+    quality = (statistics[POINTS] + 1) / (statistics[GAMES] + 2)
+    if statistics[SCORE_COUNT]:
+        average_score = statistics[SCORE_SUM] / statistics[SCORE_COUNT]
+        winning_chance = 1 / (1 + 10 ** (-average_score / 400))
+        quality = (1 - score_weight) * quality + score_weight * winning_chance
+    return quality
+
+
+def book_entries(statistics: MoveStatistics, min_games: int = 1, min_score: float = 0.0,
+                 score_weight: float = 0.5) -> list[tuple[int, int, int, int]]:
+    """
+    Turn the move statistics into polyglot entries, sorted by key and then from the highest weight down.
+
+    :param min_games: Leave out moves played in fewer games.
+    :param min_score: Leave out moves with a lower quality (see `move_quality`).
+    :param score_weight: How much the bot's scores count in the quality.
+    """
+    entries = []
+    for (key, raw_move), move_statistics in statistics.items():
+        if move_statistics[GAMES] < min_games:
+            continue
+        quality = move_quality(move_statistics, score_weight)
+        weight = min(round(WEIGHT_SCALE * move_statistics[GAMES] * quality), 0xFFFF)
+        if quality >= min_score and weight > 0:
+            entries.append((key, raw_move, weight, 0))
+    return sorted(entries, key=lambda entry: (entry[0], -entry[2], entry[1]))
+
+
+def collect_statistics(paths: list[str], variant: str = "standard", max_ply: int = 40, player: Optional[str] = None,
+                       processes: Optional[int] = None) -> MoveStatistics:
+    """
+    Collect the move statistics of all the games in the PGN files with a pool of processes.
+
+    :param paths: The PGN files, or directories of PGN files.
+    :param processes: The number of processes. If `None`, one per CPU.
+    """
+    tasks = [(chunk, variant, max_ply, player) for chunk in file_chunks(paths)]
+    statistics: MoveStatistics = {}
+    with multiprocessing.Pool(processes) as pool:
+        for chunk_statistics in pool.imap_unordered(read_chunk, tasks):
+            for move, chunk_entry in chunk_statistics.items():
+                entry = statistics.get(move)
+                if entry is None:
+                    statistics[move] = chunk_entry
+                else:
+                    for index, value in enumerate(chunk_entry):
+                        entry[index] += value
+    return statistics
+
+
+def main(arguments: Optional[list[str]] = None) -> int:
+    """Make a book from the bot's games from the command line."""
+    parser = argparse.ArgumentParser(description="Make a polyglot opening book out of the bot's PGN game records.")
+    parser.add_argument("pgn", nargs="*", help="PGN files or directories. Defaults to the `pgn_directory` of the config.")
+    parser.add_argument("--config", default="./config.yml", help="The config file (defaults to ./config.yml).")
+    parser.add_argument("--output", default="engines/books/own_games.bin", help="The book file to write.")
+    parser.add_argument("--variant", default="standard", help="The variant to make the book for.")
+    parser.add_argument("--player", help="Only count the moves of the player with this name (e.g., the bot).")
+    parser.add_argument("--max-ply", type=int, default=40, help="Only count the moves up to this ply.")
+    parser.add_argument("--min-games", type=int, default=2, help="Leave out moves played in fewer games.")
+    parser.add_argument("--min-score", type=float, default=0.4, help="Leave out moves with a lower quality (0 to 1).")
+    parser.add_argument("--score-weight", type=float, default=0.5,
+                        help="How much the bot's scores count in the quality of a move (0 to 1).")
+    parser.add_argument("--processes", type=int, help="The number of processes (defaults to one per CPU).")
+    args = parser.parse_args(arguments)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    paths = args.pgn or [load_config(args.config).pgn_directory]
+    if not all(paths):
+        logger.error("Give the PGN files or set `pgn_directory` in the config.")
+        return 1
+    statistics = collect_statistics(paths, args.variant, args.max_ply, args.player, args.processes)
+    count = write_book(args.output, book_entries(statistics, args.min_games, args.min_score, args.score_weight))
+    logger.info(f"Wrote {count} moves of {len(statistics)} to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
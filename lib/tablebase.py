@@ -0,0 +1,180 @@
+"""
+Endgame tablebases that stay open for the life of the process.
+
+`get_syzygy_tablebase` and `get_gaviota_tablebase` open the tablebases of a list of directories the first time they
+are asked for, and keep them, so the game processes of the bot scan the directories once instead of on every move of
+an endgame. The tablebase files that python-chess opens stay open (and memory-mapped, for Syzygy) between moves.
+
+Each tablebase also keeps the results of its latest probes in an LRU cache, indexed by the position's Zobrist key and
+the kind of probe (WDL, DTZ, or DTM). Choosing a move probes the position after every legal move, and the same
+positions come back move after move in a long endgame, so most of those probes are answered from the cache.
+"""
+from __future__ import annotations
+import os
+import threading
+from collections import OrderedDict
+from collections.abc import Callable
+from typing import Literal, Optional, TypeVar, Union
+import chess
+import chess.gaviota
+import chess.polyglot
+import chess.syzygy
+
+ProbeType = Literal["wdl", "dtz", "dtm"]
+# The number of probe results kept by each tablebase.
+DEFAULT_PROBE_CACHE_SIZE = 1 << 16
+
+
+class ProbeCache:
+    """An LRU cache of tablebase probe results. A missing table is cached too."""
+
+    def __init__(self, size: int = DEFAULT_PROBE_CACHE_SIZE) -> None:
+        """:param size: The most results kept."""
+        self.size = max(1, size)
+        # (variant, Zobrist key, probe type) -> result, or `None` for a position whose table is missing.
+        self.results: OrderedDict[tuple[Optional[str], int, ProbeType], Optional[int]] = OrderedDict()
+        self.lock = threading.Lock()
+        self.probes = 0
+        self.hits = 0
+
+    def probe(self, board: chess.Board, probe_type: ProbeType, probe: Callable[[chess.Board], int]) -> int:
+        """
+        Get the result of a probe, from the cache if it's there.
+
+        :param board: The position.
+        :param probe_type: The kind of probe, which is part of the cache key.
+        :param probe: Probes the tablebase if the result isn't in the cache.
+        :return: The result of the probe.
+        :raises KeyError: If the tablebase doesn't have the position's table.
+        """
+        key = (board.uci_variant, chess.polyglot.zobrist_hash(board), probe_type)
+        result: Optional[int] = None
+        with self.lock:
+            self.probes += 1
+            cached = key in self.results
+            if cached:
+                self.hits += 1
+                self.results.move_to_end(key)
+                result = self.results[key]
+        if not cached:
+            try:
+                result = probe(board)
+            except KeyError:
+                result = None
+            with self.lock:
+                self.results[key] = result
+                if len(self.results) > self.size:
+                    self.results.popitem(last=False)
+        if result is None:
+            raise KeyError(f"No {probe_type} table for {board.fen()}")
+        return result
+
+    def hit_rate(self) -> float:
+        """Get the share of probes that were answered from the cache."""
+        return self.hits / self.probes if self.probes else 0.0
+
+
+class SyzygyTablebase:
+    """Syzygy tablebases that are opened once, with cached WDL and DTZ probes."""
+
+    def __init__(self, paths: list[str], cache_size: int = DEFAULT_PROBE_CACHE_SIZE) -> None:
+        """
+        Open the tablebases.
+
+        :param paths: The directories of the tablebase files.
+        :param cache_size: The number of probe results to keep.
+        """
+        self.tablebase = chess.syzygy.open_tablebase(paths[0])
+        for path in paths[1:]:
+            self.tablebase.add_directory(path)
+        self.cache = ProbeCache(cache_size)
+
+    def probe_wdl(self, board: chess.Board) -> int:
+        """Get the WDL of a position, as `chess.syzygy.Tablebase.probe_wdl` does."""
+        return self.cache.probe(board, "wdl", self.tablebase.probe_wdl)
+
+    def probe_dtz(self, board: chess.Board) -> int:
+        """Get the DTZ of a position, as `chess.syzygy.Tablebase.probe_dtz` does."""
+        return self.cache.probe(board, "dtz", self.tablebase.probe_dtz)
+
+    def close(self) -> None:
+        """Close the tablebase files."""
+        self.tablebase.close()
+
+
+class GaviotaTablebase:
+    """Gaviota tablebases that are opened once, with cached WDL and DTM probes."""
+
+    def __init__(self, paths: list[str], cache_size: int = DEFAULT_PROBE_CACHE_SIZE) -> None:
+        """
+        Open the tablebases.
+
+        :param paths: The directories of the tablebase files.
+        :param cache_size: The number of probe results to keep.
+        """
+        self.tablebase: Union[chess.gaviota.NativeTablebase, chess.gaviota.PythonTablebase]
+        self.tablebase = chess.gaviota.open_tablebase(paths[0])
+        for path in paths[1:]:
+            self.tablebase.add_directory(path)
+        self.cache = ProbeCache(cache_size)
+
+    def probe_wdl(self, board: chess.Board) -> int:
+        """Get the WDL of a position, as `chess.gaviota.PythonTablebase.probe_wdl` does."""
+        return self.cache.probe(board, "wdl", self.tablebase.probe_wdl)
+
+    def probe_dtm(self, board: chess.Board) -> int:
+        """Get the DTM of a position, as `chess.gaviota.PythonTablebase.probe_dtm` does."""
+        return self.cache.probe(board, "dtm", self.tablebase.probe_dtm)
+
+    def close(self) -> None:
+        """Close the tablebase files."""
+        self.tablebase.close()
+
+
+Tablebase = TypeVar("Tablebase", SyzygyTablebase, GaviotaTablebase)
+
+_syzygy_tablebases: dict[tuple[str, ...], SyzygyTablebase] = {}
+_gaviota_tablebases: dict[tuple[str, ...], GaviotaTablebase] = {}
+_tablebases_lock = threading.Lock()
+
+
+def get_syzygy_tablebase(paths: list[str]) -> SyzygyTablebase:
+    """
+    Get the Syzygy tablebases in some directories, opening them if this process hasn't opened them yet.
+
+    :param paths: The directories of the tablebase files.
+    :return: The tablebases, which are shared by every caller in the process. Don't close them.
+    """
+    return _get_tablebase(_syzygy_tablebases, paths, SyzygyTablebase)
+
+
+def get_gaviota_tablebase(paths: list[str]) -> GaviotaTablebase:
+    """
+    Get the Gaviota tablebases in some directories, opening them if this process hasn't opened them yet.
+
+    :param paths: The directories of the tablebase files.
+    :return: The tablebases, which are shared by every caller in the process. Don't close them.
+    """
+    return _get_tablebase(_gaviota_tablebases, paths, GaviotaTablebase)
+
+
+def _get_tablebase(tablebases: dict[tuple[str, ...], Tablebase], paths: list[str],
+                   open_tablebase: Callable[[list[str]], Tablebase]) -> Tablebase:
+    """Get the tablebases in some directories from `tablebases`, opening them the first time."""
+    key = tuple(os.path.abspath(path) for path in paths)
+    tablebase = tablebases.get(key)
+    if tablebase is None:
+        with _tablebases_lock:
+            tablebase = tablebases.get(key)
+            if tablebase is None:
+                tablebase = tablebases[key] = open_tablebase(paths)
+    return tablebase
+
+
+def close_tablebases() -> None:
+    """Close all the tablebases opened by `get_syzygy_tablebase` and `get_gaviota_tablebase`."""
+    with _tablebases_lock:
+        for tablebases in (_syzygy_tablebases, _gaviota_tablebases):
+            for tablebase in tablebases.values():
+                tablebase.close()
+            tablebases.clear()
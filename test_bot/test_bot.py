@@ -24,6 +24,7 @@ from lib.lichess_types import CONFIG_DICT_TYPE
 if "pytest" not in sys.modules:
     sys.exit(f"The script {os.path.basename(__file__)} should only be run by pytest.")
 from lib import lichess_bot
+from engines.ChessAIWrapper import ChessAIEngine
 
 platform = sys.platform
 archive_ext = "zip" if platform == "win32" else "tar"
@@ -350,3 +351,37 @@ def test_buggy_engine() -> None:
     assert win
     assert os.path.isfile(os.path.join(CONFIG["pgn_directory"],
                                        "bo vs b - zzzzzzzz.pgn"))
+
+
+def test_background_move() -> None:
+    """Test thinking in the background while the game stream is read, and stopping when the game ends."""
+    def fail() -> None:
+        raise requests.exceptions.HTTPError("Move rejected")
+
+    background_move = lichess_bot.BackgroundMove(fail)
+    with pytest.raises(requests.exceptions.HTTPError):
+        background_move.finish()
+
+    engine = ChessAIEngine([], {}, None, config.Configuration({}))
+    board = chess.Board()
+    results: list[chess.engine.PlayResult] = []
+    background_move = lichess_bot.BackgroundMove(
+        lambda: results.append(engine.run_search(board, list(board.legal_moves), chess.engine.Limit(time=600))))
+    assert background_move.is_alive()
+    start = Timer()
+    background_move.cancel(engine)
+    assert start.time_since_reset() < seconds(2)
+    assert not background_move.is_alive()
+    move = results[0].move
+    assert move is not None
+    assert move in board.legal_moves
+
+    engine_moves = lichess_bot.EngineMoves(engine)
+    engine_moves.play(fail)
+    engine_moves.cancel()
+    assert not engine_moves.has_finished()
+    engine_moves.play(fail)
+    with pytest.raises(requests.exceptions.HTTPError):
+        engine_moves.finish()
+    assert engine_moves.background_move is None
+    engine.quit()
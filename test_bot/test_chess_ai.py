@@ -0,0 +1,660 @@
+"""Test the ChessAI homemade engine search."""
+import multiprocessing
+import os
+import pickle
+import random
+import threading
+import time
+from pathlib import Path
+from typing import Any
+import chess
+import chess.engine
+import chess.pgn
+import chess.polyglot
+import pytest
+from engines import ChessAI
+from engines import benchmark, mate_solver, pawns, smp, transposition
+from engines.ChessAIWrapper import ChessAIEngine, number_option, remaining_time
+from engines.mate_solver import MateSolver
+from homemade import MCTS
+from lib.config import Configuration
+from lib.engine_wrapper import SearchController
+
+# The root moves argument of `search` when every legal move may be played, as lichess-bot passes it.
+ALL_MOVES = chess.engine.PlayResult(None, None)
+# The draw and resign settings that lib/config.py fills in when they aren't in the config file.
+DRAW_OR_RESIGN = {"offer_draw_enabled": False, "offer_draw_moves": 5, "offer_draw_score": 0, "offer_draw_pieces": 10,
+                  "resign_enabled": False, "resign_moves": 3, "resign_score": -1000}
+
+
+def test_search_time_limits() -> None:
+    """Test splitting the clock into a soft and a hard budget."""
+    board = chess.Board()
+    assert ChessAI.search_time_limits(board, chess.engine.Limit()) == (None, None)
+
+    soft, hard = ChessAI.search_time_limits(board, chess.engine.Limit(time=2))
+    assert soft == 1
+    assert hard == 2
+
+    soft, hard = ChessAI.search_time_limits(board, chess.engine.Limit(white_clock=60, black_clock=1,
+                                                                      white_inc=2, black_inc=0))
+    assert soft is not None
+    assert hard is not None
+    assert 0 < soft <= hard < 60 * ChessAI.MAX_CLOCK_FRACTION + 2
+    assert soft > 60 / ChessAI.MOVES_TO_GO
+
+    # Black is almost out of time.
+    board.push_uci("e2e4")
+    soft, hard = ChessAI.search_time_limits(board, chess.engine.Limit(white_clock=60, black_clock=1,
+                                                                      white_inc=2, black_inc=0))
+    assert soft is not None
+    assert hard is not None
+    assert hard < 1
+
+
+def test_finds_mate_in_one() -> None:
+    """Test that the search finds a mate in one and stops deepening."""
+    board = chess.Board("r1bqkbnr/pppp1ppp/2n5/4p3/2B1P3/5Q2/PPPP1PPP/RNB1K1NR w KQkq - 2 3")
+    move, score, _ = ChessAI.Searcher().iterative_deepening(board, list(board.legal_moves),
+                                                            chess.engine.Limit(time=10))
+    assert move == chess.Move.from_uci("f3f7")
+    assert score >= ChessAI.MATE_THRESHOLD
+
+
+def test_search_honors_hard_deadline() -> None:
+    """Test that the search returns a completed move before the hard deadline."""
+    board = chess.Board("r1bq1rk1/pp2bppp/2n1pn2/3p4/2PP4/2N2N2/PP2BPPP/R2QKB1R w KQ - 0 9")
+    time_limit = chess.engine.Limit(white_clock=2, black_clock=2)
+    _, hard = ChessAI.search_time_limits(board, time_limit)
+    assert hard is not None
+    start = time.perf_counter()
+    move, _, depth = ChessAI.Searcher().iterative_deepening(board, list(board.legal_moves), time_limit)
+    assert time.perf_counter() - start < hard + 0.25
+    assert move is not None
+    assert move in board.legal_moves
+    assert depth >= 1
+
+    # Told to stop during the first iteration, the search still plays a move.
+    board = chess.Board("r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1")
+    searcher = ChessAI.Searcher()
+    searcher.should_stop = lambda: True
+    move, _, depth = searcher.iterative_deepening(board, list(board.legal_moves))
+    assert depth == 0
+    assert move is not None
+    assert move in board.legal_moves
+
+
+def test_root_moves() -> None:
+    """Test that the search only plays moves from the given list."""
+    board = chess.Board()
+    root_moves = [chess.Move.from_uci("a2a3"), chess.Move.from_uci("h2h3")]
+    move, _, _ = ChessAI.Searcher().iterative_deepening(board, root_moves, chess.engine.Limit(time=0.5))
+    assert move in root_moves
+
+
+def test_incremental_zobrist_key() -> None:
+    """Test that updating the key move by move matches hashing the whole board."""
+    random.seed(0)
+    for _ in range(20):
+        board = chess.Board()
+        key = chess.polyglot.zobrist_hash(board)
+        while not board.is_game_over() and board.ply() < 120:
+            move = random.choice(list(board.legal_moves))
+            key = transposition.push_with_key(board, move, key)
+            assert key == chess.polyglot.zobrist_hash(board)
+
+
+def test_transposition_table() -> None:
+    """Test storing, probing and replacing transposition table entries."""
+    tt = transposition.TranspositionTable(1 / 1024)  # 32 buckets
+    tt.new_search()
+    key = chess.polyglot.zobrist_hash(chess.Board())
+    move = chess.Move.from_uci("e7e8q")
+    tt.store(key, 5, transposition.LOWER, -12.34, move)
+    assert tt.probe(key) == transposition.TTEntry(5, transposition.LOWER, -12.34, move)
+    assert tt.probe(key + 1) is None
+
+    # A shallower result for another position in the same bucket goes to the always-replace slot.
+    other_key = key + tt.bucket_count
+    tt.store(other_key, 1, transposition.EXACT, 0.5, None)
+    assert tt.probe(key) is not None
+    assert tt.probe(other_key) == transposition.TTEntry(1, transposition.EXACT, 0.5, None)
+
+    # Entries from older searches are replaced first.
+    tt.new_search()
+    third_key = key + 2 * tt.bucket_count
+    tt.store(third_key, 1, transposition.UPPER, 1, None)
+    assert tt.probe(key) is None
+    assert tt.probe(third_key) is not None
+    assert tt.hashfull() > 0
+
+    tt.clear()
+    assert tt.probe(third_key) is None
+
+    # Bounds are rounded outwards to whole centipawns, so a stored bound never cuts off more than the search did.
+    for bound, score, stored in [(transposition.LOWER, 0.375, 0.37), (transposition.UPPER, 0.375, 0.38),
+                                 (transposition.EXACT, 0.375, 0.38), (transposition.LOWER, -0.375, -0.38),
+                                 (transposition.UPPER, -0.375, -0.37), (transposition.LOWER, 0.29, 0.29)]:
+        tt.store(key, 1, bound, score, None)
+        entry = tt.probe(key)
+        assert entry is not None
+        assert entry.score == stored
+
+    tt.clear()
+    # A shallower result for the same position (like a quiescence search) doesn't replace a deeper one, unless it is exact.
+    tt.store(key, 5, transposition.LOWER, 1, move)
+    tt.store(key, 0, transposition.UPPER, 2, None)
+    assert tt.probe(key) == transposition.TTEntry(5, transposition.LOWER, 1, move)
+    tt.store(key, 2, transposition.EXACT, 3, None)
+    assert tt.probe(key) == transposition.TTEntry(2, transposition.EXACT, 3, move)
+
+
+def test_number_option() -> None:
+    """Test reading numbers from `homemade_options`, which YAML may give as strings."""
+    assert number_option({"Hash": "2.5"}, "Hash", 16) == 2.5
+    assert number_option({}, "Hash", 16) == 16
+    with pytest.raises(ValueError, match="Hash"):
+        number_option({"Hash": None}, "Hash", 16)
+
+
+def test_remaining_time() -> None:
+    """Test that the time the mate solver used is taken from the movetime and the clock of the side to move only."""
+    limit = chess.engine.Limit(time=1, depth=9, white_clock=60, black_clock=30, white_inc=2, black_inc=1, remaining_moves=20)
+    assert remaining_time(limit, chess.BLACK, 0.5) == chess.engine.Limit(time=0.5, depth=9, white_clock=60, black_clock=29.5,
+                                                                         white_inc=2, black_inc=1, remaining_moves=20)
+    assert remaining_time(chess.engine.Limit(white_clock=1), chess.WHITE, 2) == chess.engine.Limit(white_clock=0)
+
+
+def test_transposition_table_reused_between_searches() -> None:
+    """Test that a second search of the same position is helped by the first search's table."""
+    board = chess.Board("r1bq1rk1/pp2bppp/2n1pn2/3p4/2PP4/2N2N2/PP2BPPP/R2QKB1R w KQ - 0 9")
+    tt = transposition.TranspositionTable(16)
+    first = ChessAI.Searcher(tt)
+    first_move, _, _ = first.iterative_deepening(board, list(board.legal_moves))
+    second = ChessAI.Searcher(tt)
+    second_move, _, _ = second.iterative_deepening(board, list(board.legal_moves))
+    assert second.nodes < first.nodes
+    assert tt.hit_rate() > 0
+    assert second_move == first_move
+
+
+def test_incremental_score() -> None:
+    """Test that updating the score move by move matches scoring the whole board."""
+    random.seed(1)
+    searcher = ChessAI.Searcher()
+    for _ in range(20):
+        board = chess.Board()
+        searcher.score = ChessAI.scoreBoard(board)
+        while not board.is_game_over() and board.ply() < 120:
+            searcher.make(board, random.choice(list(board.legal_moves)))
+            assert abs(searcher.score - ChessAI.scoreBoard(board)) < 1e-9
+        while board.move_stack:
+            searcher.unmake(board)
+        assert searcher.score == ChessAI.scoreBoard(board)
+
+
+def test_batch_evaluation() -> None:
+    """Test that the NumPy evaluator scores positions the same way as scoreBoard."""
+    batch_evaluation = pytest.importorskip("engines.batch_evaluation")
+    random.seed(2)
+    board = chess.Board()
+    while not board.is_game_over() and board.ply() < 100:
+        moves = list(board.legal_moves)
+        for move, score in zip(moves, batch_evaluation.evaluate_children(board, moves)):
+            board.push(move)
+            assert abs(score - ChessAI.scoreBoard(board)) < 1e-9
+            board.pop()
+        board.push(random.choice(moves))
+    assert abs(batch_evaluation.evaluate_batch([board])[0] - ChessAI.scoreBoard(board)) < 1e-9
+
+    position = chess.Board("r1bq1rk1/pp2bppp/2n1pn2/3p4/2PP4/2N2N2/PP2BPPP/R2QKB1R w KQ - 0 9")
+    _, expected_score, expected_depth = ChessAI.Searcher().iterative_deepening(position, list(position.legal_moves))
+    numpy_searcher = ChessAI.Searcher(evaluate_children=batch_evaluation.evaluate_children)
+    numpy_move, score, depth = numpy_searcher.iterative_deepening(position, list(position.legal_moves))
+    # Equal scores may be summed in a different order, so the chosen move can differ between equally good moves.
+    assert numpy_move is not None
+    assert numpy_move in position.legal_moves
+    assert abs(score - expected_score) < 1e-6
+    assert depth == expected_depth
+
+
+def test_staged_moves() -> None:
+    """Test that the staged move generator yields every legal move exactly once, with the first moves first."""
+    random.seed(3)
+    searcher = ChessAI.Searcher()
+    for _ in range(10):
+        board = chess.Board()
+        while not board.is_game_over() and board.ply() < 100:
+            legal_moves = list(board.legal_moves)
+            first_move = random.choice(legal_moves)
+            illegal_move = chess.Move(chess.A1, chess.H8)
+            searcher.killers[0] = [random.choice(legal_moves), illegal_move]
+            moves = list(searcher.staged_moves(board, 0, first_move, illegal_move, first_move))
+            assert moves[0] == first_move
+            assert sorted(moves, key=str) == sorted(legal_moves, key=str)
+            board.push(random.choice(legal_moves))
+
+
+@pytest.mark.parametrize(("pvs", "null_move", "late_move_reductions"),
+                         [(False, False, False), (True, False, False), (False, True, False), (False, False, True)])
+def test_selective_search(pvs: bool, null_move: bool, late_move_reductions: bool) -> None:
+    """Test that each selective search technique still finds a mate in two."""
+    board = chess.Board("6k1/4rppp/8/8/8/8/5PPP/3RR1K1 w - - 0 1")
+    searcher = ChessAI.Searcher(pvs=pvs, null_move=null_move, late_move_reductions=late_move_reductions)
+    move, score, _ = searcher.iterative_deepening(board, list(board.legal_moves), chess.engine.Limit(time=10))
+    assert move in [chess.Move.from_uci("d1d8"), chess.Move.from_uci("e1e8")]
+    assert score == ChessAI.CHECKMATE - 3
+
+
+@pytest.mark.parametrize("pvs", [False, True])
+def test_transposition_cutoffs(pvs: bool) -> None:
+    """Test that the transposition table cuts off a repeated search, with or without PVS."""
+    board = chess.Board("r1bqkb1r/pppp1ppp/2n2n2/4p3/2B1P3/5N2/PPPP1PPP/RNBQK2R w KQkq - 4 4")
+    searcher = ChessAI.Searcher(pvs=pvs)
+    nodes = []
+    for _ in range(2):
+        searcher.new_search(board)
+        searcher.iterative_deepening(board, list(board.legal_moves), max_depth=4)
+        nodes.append(searcher.nodes)
+    assert nodes[1] < nodes[0] / 2
+
+
+def test_static_exchange() -> None:
+    """Test static exchange evaluation of captures."""
+    def see(fen: str, uci: str) -> int:
+        board = chess.Board(fen)
+        return ChessAI.static_exchange(board, chess.Move.from_uci(uci))
+
+    # An undefended pawn.
+    assert see("1k1r4/1pp4p/p7/4p3/8/P5P1/1PP4P/2K1R3 w - - 0 1", "e1e5") == 1
+    # A defended pawn, attacked by rook and queen. Both recaptures lose material.
+    assert see("1k1r3q/1ppn3p/p4b2/4p3/8/P2N2P1/1PP1R1BP/2K1Q3 w - - 0 1", "d3e5") == -2
+    # A rook behind the capturing rook joins in.
+    assert see("3r2k1/8/8/3p4/8/8/3R4/3R2K1 w - - 0 1", "d2d5") == 1
+    # En passant.
+    assert see("4k3/8/8/3pP3/8/8/8/4K3 w - d6 0 1", "e5d6") == 1
+
+
+def test_lazy_smp(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> None:
+    """Test that helper processes search with the main search and share its transposition table."""
+    monkeypatch.setattr(os, "cpu_count", lambda: 3)
+    monkeypatch.setattr(smp, "REGISTRY", tmp_path)
+    lazy_smp = smp.LazySMP(3, 4, {})
+    try:
+        assert lazy_smp.helper_count() == 2
+        board = chess.Board("r1bq1rk1/pp2bppp/2n1pn2/3p4/2PP4/2N2N2/PP2BPPP/R2QKB1R w KQ - 0 9")
+        lazy_smp.transposition_table.new_search()
+        searcher = ChessAI.Searcher(lazy_smp.transposition_table)
+        move, _, depth = lazy_smp.search(searcher, board, list(board.legal_moves), chess.engine.Limit(time=2))
+        assert move is not None
+        assert move in board.legal_moves
+        assert depth >= 1
+        assert lazy_smp.helper_nodes > 0
+        assert board == chess.Board("r1bq1rk1/pp2bppp/2n1pn2/3p4/2PP4/2N2N2/PP2BPPP/R2QKB1R w KQ - 0 9")
+    finally:
+        lazy_smp.quit()
+    assert all(helper.process.poll() is not None for helper in lazy_smp.helpers)
+    assert not list(tmp_path.iterdir())
+
+
+def test_lazy_smp_registry(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> None:
+    """Test that games share the CPU cores, and that the records of games that have ended are removed."""
+    monkeypatch.setattr(smp, "REGISTRY", tmp_path)
+    assert smp.active_games() == 1
+    records = [smp.GameRecord() for _ in range(2)]
+    # A record that nobody holds a lock on was left by a game whose process has exited.
+    (tmp_path / "12345-ended.lock").touch()
+    assert smp.active_games() == 2
+    assert sorted(path.name for path in tmp_path.iterdir()) == sorted(record.path.name for record in records)
+    records[0].close()
+    assert smp.active_games() == 1
+    records[1].close()
+    assert not list(tmp_path.iterdir())
+
+
+def start_helper_in_pool(registry: Path) -> bool:
+    """Start a Lazy SMP helper from a process of a `multiprocessing` pool, as the games are played."""
+    smp.REGISTRY = registry
+    lazy_smp = smp.LazySMP(2, 1, {})
+    try:
+        lazy_smp.start_helpers(1)
+        return lazy_smp.helpers[0].process.poll() is None
+    finally:
+        lazy_smp.quit()
+
+
+def test_lazy_smp_in_pool(tmp_path: Path) -> None:
+    """Test that a game in the bot's pool of daemonic processes can start helpers."""
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        assert pool.apply(start_helper_in_pool, (tmp_path,))
+
+
+def test_pondering() -> None:
+    """Test that ChessAI ponders on the expected reply and reuses the result on a ponder hit."""
+    engine = ChessAIEngine([], {}, None, Configuration(DRAW_OR_RESIGN))
+    board = chess.Board("r1bq1rk1/pp2bppp/2n1pn2/3p4/2PP4/2N2N2/PP2BPPP/R2QKB1R w KQ - 0 9")
+    result = engine.search(board, chess.engine.Limit(time=1), True, False, ALL_MOVES)
+    assert result.move is not None
+    assert result.move in board.legal_moves
+    assert result.ponder is not None
+
+    # Ponder hit
+    engine.start_pondering(board, result)
+    time.sleep(1)
+    # Pondering has no depth limit, so it goes on until the opponent moves.
+    assert engine.ponder_thread is not None
+    assert engine.ponder_thread.is_alive()
+    expected_board = board.copy()
+    expected_board.push(result.move)
+    expected_board.push(result.ponder)
+    ponder_result = engine.stop_pondering(expected_board)
+    assert ponder_result is not None
+    assert ponder_result.move is not None
+    assert ponder_result.move in expected_board.legal_moves
+    assert engine.ponder_thread is None
+    # A second of pondering is enough for a half-second move, but not for a long one, which searches on.
+    assert engine.ponder_hit_is_enough(ponder_result, expected_board, chess.engine.Limit(time=0.5))
+    assert not engine.ponder_hit_is_enough(ponder_result, expected_board, chess.engine.Limit(time=60))
+    assert not engine.ponder_hit_is_enough(ponder_result, expected_board,
+                                           chess.engine.Limit(white_clock=600, black_clock=600))
+    assert engine.ponder_hit_is_enough(ponder_result, expected_board, chess.engine.Limit(white_clock=10, black_clock=10))
+
+    # Ponder miss
+    engine.start_pondering(board, result)
+    other_board = board.copy()
+    other_board.push(result.move)
+    other_board.push(next(move for move in other_board.legal_moves if move != result.ponder))
+    start = time.perf_counter()
+    assert engine.stop_pondering(other_board) is None
+    assert time.perf_counter() - start < 1
+    engine.quit()
+
+
+def test_search_state_kept_between_moves() -> None:
+    """Test that a searcher kept for the next move searches fewer nodes than a new one."""
+    board = chess.Board("r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1")
+    warm = ChessAI.Searcher()
+    warm.new_search(board)
+    warm.iterative_deepening(board, list(board.legal_moves))
+    expected_moves = warm.previous_pv[:2]
+    board.push(expected_moves[0])
+    board.push(expected_moves[1])
+
+    warm.new_search(board)
+    assert warm.nodes == 0
+    assert warm.previous_pv == warm.pv_table[0][2:]
+    warm.iterative_deepening(board, list(board.legal_moves))
+
+    cold = ChessAI.Searcher()
+    cold.new_search(board)
+    cold.iterative_deepening(board, list(board.legal_moves))
+    assert warm.nodes < cold.nodes
+
+    # After a takeback, the principal variation and killer moves don't apply anymore.
+    board.pop()
+    warm.new_search(board)
+    assert warm.previous_pv == []
+    assert all(killers == [None, None] for killers in warm.killers)
+
+
+def test_benchmark() -> None:
+    """Test that the benchmark's perft counts are right and that its searches report their statistics."""
+    suite = benchmark.load_suite()
+    perft_results = benchmark.run_perft(suite, 2)
+    assert perft_results
+    assert all(result["correct"] for result in perft_results)
+
+    search_results = benchmark.run_search(suite[6:8], depth=3)
+    for result in search_results:
+        assert result["depth"] == 3
+        assert list(result["time_to_depth"]) == [1, 2, 3]
+        assert result["nodes"] > 0
+        assert result["branching_factor"] is not None
+    assert benchmark.summarize(search_results)["nodes"] == sum(result["nodes"] for result in search_results)
+
+
+def test_search_info() -> None:
+    """Test that ChessAI reports its search like a UCI engine, so the score is used to offer draws and resign."""
+    engine = ChessAIEngine([], {}, None, Configuration(DRAW_OR_RESIGN | {"resign_enabled": True, "resign_moves": 1}))
+    board = chess.Board("6k1/4rppp/8/8/8/8/5PPP/3RR1K1 w - - 0 1")
+    result = engine.search(board, chess.engine.Limit(depth=3), False, False, ALL_MOVES)
+    info = result.info
+    assert info["score"] == chess.engine.PovScore(chess.engine.Mate(2), chess.WHITE)
+    assert info["pv"][0] == result.move
+    assert board.is_legal(info["pv"][0])
+    assert info["depth"] >= 1
+    assert info["seldepth"] >= info["depth"]
+    assert info["nodes"] > 0
+    assert info["time"] > 0
+    assert "nps" in info
+    assert "hashfull" in info
+    assert not result.resigned
+
+    board = chess.Board("6k1/8/8/8/8/8/5PPP/3QR1K1 b - - 0 1")
+    result = engine.search(board, chess.engine.Limit(time=1), False, False, ALL_MOVES)
+    assert result.info["score"].relative < chess.engine.Cp(-1000)
+    assert result.resigned
+    assert engine.scores[-1] == result.info["score"]
+    engine.quit()
+
+
+def test_search_controller() -> None:
+    """Test stopping a search at a hard deadline or from another thread."""
+    controller = SearchController()
+    controller.start(hard_limit=0.05)
+    assert not controller.should_stop()
+    time.sleep(0.1)
+    assert controller.should_stop()
+
+    controller.start()
+    assert not controller.should_stop()
+    controller.stop()
+    assert controller.should_stop()
+    controller.reset()
+    assert not controller.stop_event.is_set()
+    assert not controller.should_stop()
+
+    engine = ChessAIEngine([], {}, None, Configuration(DRAW_OR_RESIGN))
+    board = chess.Board("r1bq1rk1/pp2bppp/2n1pn2/3p4/2PP4/2N2N2/PP2BPPP/R2QKB1R w KQ - 0 9")
+    stopper = threading.Timer(0.5, engine.stop_search)
+    stopper.start()
+    start = time.perf_counter()
+    result = engine.search(board, chess.engine.Limit(time=600), False, False, ALL_MOVES)
+    assert time.perf_counter() - start < 2
+    assert result.move is not None
+    assert result.move in board.legal_moves
+    assert result.info["depth"] > 0
+    engine.quit()
+
+
+def test_search_limits() -> None:
+    """Test that ChessAI honors the node, depth, and mate limits of `chess.engine.Limit`."""
+    controller = SearchController()
+    controller.start(chess.engine.Limit(nodes=100))
+    assert not controller.should_stop(99)
+    assert controller.should_stop(100)
+    controller.start(chess.engine.Limit(depth=5, mate=2))
+    assert controller.max_depth() == 3
+    controller.start(chess.engine.Limit(depth=2, mate=2))
+    assert controller.max_depth() == 2
+
+    board = chess.Board("r1bq1rk1/pp2bppp/2n1pn2/3p4/2PP4/2N2N2/PP2BPPP/R2QKB1R w KQ - 0 9")
+    results = []
+    for _ in range(2):
+        engine = ChessAIEngine([], {}, None, Configuration(DRAW_OR_RESIGN))
+        results.append(engine.run_search(board, list(board.legal_moves), chess.engine.Limit(nodes=3000)))
+        engine.quit()
+    assert 3000 <= results[0].info["nodes"] < 3000 + ChessAI.TIME_CHECK_INTERVAL
+    assert results[0].move == results[1].move
+    assert results[0].info["nodes"] == results[1].info["nodes"]
+
+    engine = ChessAIEngine([], {}, None, Configuration(DRAW_OR_RESIGN))
+    assert engine.run_search(board, list(board.legal_moves), chess.engine.Limit(depth=2)).info["depth"] == 2
+    mate_board = chess.Board("6k1/4rppp/8/8/8/8/5PPP/3RR1K1 w - - 0 1")
+    result = engine.run_search(mate_board, list(mate_board.legal_moves), chess.engine.Limit(mate=2))
+    assert result.info["score"] == chess.engine.PovScore(chess.engine.Mate(2), chess.WHITE)
+    engine.quit()
+
+
+def test_mcts() -> None:
+    """Test that the MCTS engine stops at its node limit, finds a mate in one, and keeps its tree between moves."""
+    mcts = pytest.importorskip("engines.mcts")
+    options: dict[str, Any] = {"TreeSize": 50000, "go_commands": {"nodes": 400}}
+    engine = MCTS([], options, None, Configuration(DRAW_OR_RESIGN))
+    board = chess.Board("6k1/5ppp/8/8/8/8/5PPP/3R2K1 w - - 0 1")
+    result = engine.search(board, chess.engine.Limit(), False, False, ALL_MOVES)
+    assert result.move == chess.Move.from_uci("d1d8")
+    assert 400 <= result.info["nodes"] < 400 + mcts.BATCH_SIZE
+
+    board = chess.Board()
+    result = engine.search(board, chess.engine.Limit(), False, False, ALL_MOVES)
+    assert result.move is not None
+    assert result.ponder is not None
+    assert result.move in board.legal_moves
+    assert result.info["pv"][0] == result.move
+    board.push(result.move)
+    board.push(result.ponder)
+    tree = engine.tree
+    assert tree.set_root(board)
+    assert tree.visits[0] > 0
+    assert all(tree.find_child(0, move) >= 0 for move in board.legal_moves)
+    move = engine.search(board, chess.engine.Limit(), False, False, ALL_MOVES).move
+    assert move is not None
+    assert move in board.legal_moves
+    assert not tree.set_root(chess.Board("6k1/5ppp/8/8/8/8/5PPP/3R2K1 w - - 0 1"))
+
+    # A full tree stops growing, but the search still returns a move.
+    small = mcts.MCTSTree(capacity=100)
+    small.search(chess.Board(), lambda playouts: playouts >= 200)
+    assert small.size <= 100
+    assert small.best_move() in chess.Board().legal_moves
+    engine.quit()
+
+
+def test_nnue(tmp_path: Path) -> None:
+    """Test that the NNUE accumulators are updated correctly, and that the trainer writes weights the search can use."""
+    np = pytest.importorskip("numpy")
+    nnue = pytest.importorskip("engines.nnue")
+    train_nnue = pytest.importorskip("engines.train_nnue")
+    random.seed(5)
+    games = []
+    for game_result in ("1-0", "0-1", "1/2-1/2"):
+        board = chess.Board()
+        while not board.is_game_over() and board.ply() < 60:
+            board.push(random.choice(list(board.legal_moves)))
+        game = chess.pgn.Game.from_board(board)
+        game.headers["Result"] = game_result
+        games.append(str(game))
+    (tmp_path / "games.pgn").write_text("\n\n".join(games) + "\n")
+    weights_path = tmp_path / "nnue.npz"
+    assert train_nnue.main([str(tmp_path), "--output", str(weights_path), "--epochs", "2", "--hidden-size", "8"]) == 0
+
+    evaluator = nnue.NNUEEvaluator(weights_path)
+    assert isinstance(nnue.load_weights(weights_path)["feature_weights"], np.memmap)
+    board = chess.Board("r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1")
+    evaluator.reset(board)
+    fresh = nnue.NNUEEvaluator(weights_path)
+    while not board.is_game_over() and board.ply() < 80:
+        move = random.choice(list(board.legal_moves))
+        evaluator.push(board, move)
+        board.push(move)
+        fresh.reset(board)
+        assert abs(evaluator.evaluate(board) - fresh.evaluate(board)) < 1e-4
+    evaluator.pop()
+    board.pop()
+    fresh.reset(board)
+    assert abs(evaluator.evaluate(board) - fresh.evaluate(board)) < 1e-4
+
+    # Other processes get the weights from the file.
+    copy = pickle.loads(pickle.dumps(evaluator))  # noqa: S301
+    copy.reset(board)
+    assert copy.evaluate(board) == fresh.evaluate(board)
+
+    engine = ChessAIEngine([], {"Evaluation": "nnue", "NNUEWeights": str(weights_path)}, None,
+                           Configuration(DRAW_OR_RESIGN))
+    position = chess.Board("r1bq1rk1/pp2bppp/2n1pn2/3p4/2PP4/2N2N2/PP2BPPP/R2QKB1R w KQ - 0 9")
+    result = engine.run_search(position, list(position.legal_moves), chess.engine.Limit(depth=2))
+    assert result.move is not None
+    assert result.move in position.legal_moves
+    assert result.info["depth"] == 2
+    engine.quit()
+
+
+def test_pawn_structure() -> None:
+    """Test the pawn-structure terms, the incremental pawn key, and the pawn hash table."""
+    board = chess.Board("4k3/p7/8/8/8/P7/P6P/4K3 w - - 0 1")
+    # Doubled a-pawns, three isolated white pawns, and an isolated black pawn. The h-pawn is passed on its first rank.
+    white_pawns = board.pawns & board.occupied_co[chess.WHITE]
+    black_pawns = board.pawns & board.occupied_co[chess.BLACK]
+    assert abs(pawns.pawn_structure(white_pawns, black_pawns) - (-0.1 - 3 * 0.15 + 0.15)) < 1e-9
+    assert abs(pawns.pawn_structure(chess.BB_E4, chess.BB_A7) - pawns.PASSED_PAWN[3]) < 1e-9
+    assert pawns.king_shield(chess.Board()) == 0
+    assert abs(pawns.king_shield(chess.Board("4k3/8/8/8/8/7P/5PP1/6K1 w - - 0 1")) - 3 * pawns.SHIELD_PAWN) < 1e-9
+
+    table = pawns.PawnHashTable()
+    key = pawns.pawn_key(board)
+    assert table.score(board, key) == table.score(board, key)
+    assert table.hit_rate() == 0.5
+
+    random.seed(6)
+    searcher = ChessAI.Searcher()
+    for fen in (chess.STARTING_FEN, "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1"):
+        board = chess.Board(fen)
+        searcher.iterative_deepening(board, list(board.legal_moves), max_depth=1)
+        for _ in range(200):
+            moves = list(board.legal_moves)
+            if not moves:
+                break
+            searcher.make(board, random.choice(moves))
+            assert searcher.pawn_key == pawns.pawn_key(board)
+        while searcher.key_stack:
+            searcher.unmake(board)
+            assert searcher.pawn_key == pawns.pawn_key(board)
+
+    # Pawn moves are rare in a search, so nearly every middlegame position finds its pawn structure in the table.
+    board = chess.Board("r1bq1rk1/pp2bppp/2n1pn2/3p4/2PP4/2N2N2/PP2BPPP/R2QKB1R w KQ - 0 9")
+    searcher = ChessAI.Searcher()
+    searcher.iterative_deepening(board, list(board.legal_moves), max_depth=5)
+    assert searcher.pawn_table is not None
+    assert searcher.pawn_table.hit_rate() > 0.95
+    # The hit rate is reported for each move, so it starts over with each search.
+    searcher.new_search(board)
+    assert searcher.pawn_table.probes == 0
+    assert searcher.pawn_table.hit_rate() == 0
+
+
+def test_mate_solver(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that the mate solver proves mates by checks, and that ChessAI plays them at once."""
+    solver = MateSolver()
+    board = chess.Board("r1bqr3/ppp1B1kp/1b4p1/n2B4/3PQ1P1/2P5/P4P2/RN4K1 w - - 1 1")
+    pv = solver.solve(board)
+    assert pv is not None
+    mate_board = board.copy()
+    for move in pv:
+        mate_board.push(move)
+    assert mate_board.is_checkmate()
+    first_nodes = solver.nodes
+    # The node table is kept, so the rest of the mate is found again at once.
+    continuation = board.copy()
+    continuation.push(pv[0])
+    continuation.push(pv[1])
+    assert solver.solve(continuation) == pv[2:]
+    assert solver.nodes < first_nodes
+    # A mate that needs a quiet move isn't found, and the root moves are honored.
+    assert solver.solve(chess.Board("8/8/8/8/8/8/k7/2K4Q w - - 0 1"), time_limit=0.2) is None
+    assert solver.solve(board, [move for move in board.legal_moves if move != pv[0]], time_limit=0.5) != pv
+
+    engine = ChessAIEngine([], {"MateSolver": True}, None, Configuration(DRAW_OR_RESIGN))
+    # A stop request from the last move doesn't cut the next move's mate search short.
+    engine.stop_search()
+    monkeypatch.setattr(mate_solver, "CHECK_INTERVAL", 1)
+    result = engine.search(board, chess.engine.Limit(time=2), False, False, ALL_MOVES)
+    assert result.move == pv[0]
+    assert result.info["score"] == chess.engine.PovScore(chess.engine.Mate((len(pv) + 1) // 2), chess.WHITE)
+    assert result.info["string"] == "mate solver"
+    start = chess.Board()
+    result = engine.search(start, chess.engine.Limit(time=0.5), False, False, ALL_MOVES)
+    assert result.move is not None
+    assert result.move in start.legal_moves
+    assert result.info["string"] != "mate solver"
+    engine.quit()
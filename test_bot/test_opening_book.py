@@ -0,0 +1,224 @@
+"""Test the opening books that stay open for the life of the process."""
+import datetime
+import math
+import random
+import chess
+import chess.engine
+import chess.pgn
+import chess.polyglot
+from pathlib import Path
+from typing import Optional
+import yaml
+from lib import book_compiler, book_precompute, config, model, opening_book, pgn_book
+from lib.engine_wrapper import get_book_move
+from lib.lichess_types import GameEventType
+
+BOOK = "engines/books/Performance.bin"
+
+
+def test_lookup_matches_python_chess() -> None:
+    """Test that every way of choosing a move picks what the python-chess reader picks."""
+    opening_book.close_books()
+    book = opening_book.get_book(BOOK)
+    assert opening_book.get_book(BOOK) is book
+
+    board = chess.Board()
+    with chess.polyglot.open_reader(BOOK) as reader:
+        for _ in range(8):
+            position = book.lookup(board)
+            assert position.entries == list(reader.find_all(board, minimum_weight=0))
+            for seed in range(5):
+                assert position.weighted_choice(random.Random(seed)) == reader.weighted_choice(board,
+                                                                                               random=random.Random(seed))
+            min_weight = position.scaled_weight(10, "max")
+            assert min_weight == max(entry.weight for entry in position.entries) / 10
+            # Book weights are whole numbers, so they reach the scaled weight when they reach its ceiling.
+            allowed = list(reader.find_all(board, minimum_weight=math.ceil(min_weight)))
+            assert {position.uniform_choice(min_weight, random.Random(seed)) for seed in range(50)} == set(allowed)
+            assert position.best(min_weight) == reader.find(board, minimum_weight=math.ceil(min_weight))
+            best = position.best()
+            assert best is not None
+            board.push(best.move)
+
+    empty = book.lookup(chess.Board("8/8/8/4k3/8/8/8/4K2R w K - 0 1"))
+    assert not empty
+    assert empty.weighted_choice() is None
+    assert empty.best() is None
+    opening_book.close_books()
+
+
+def test_merged_book(tmp_path: Path) -> None:
+    """Test that a merged book gives the moves that going through the books one by one gives."""
+    opening_book.close_books()
+    entries = list(book_compiler.read_entries(BOOK))
+    # The first book has every other position of the second book, with different weights, and a repeated move.
+    keys = set(sorted({entry[0] for entry in entries})[::2])
+    first = [(key, move, (weight * 7) % 50, learn) for key, move, weight, learn in entries if key in keys]
+    first.insert(1, first[0])
+    books = [str(tmp_path / "first.bin"), str(tmp_path / "second.bin")]
+    opening_book.write_book(books[0], first)
+    opening_book.write_book(books[1], entries)
+    directory = str(tmp_path / "merged")
+
+    assert opening_book.merged_book(directory, "standard", books, "best_move", 20, "max") is None
+    opening_book.close_books()
+    book_path, count = book_compiler.compile_book(books, directory, "standard", "best_move", 20, "max")
+    assert 0 < count < len(first) + len(entries)
+    assert opening_book.merged_book(directory, "standard", books, "best_move", 20, "max") == book_path
+    assert opening_book.merged_book(directory, "standard", books, "best_move", 30, "max") is None
+
+    def sequential_best(board: chess.Board) -> Optional[chess.Move]:
+        for path in books:
+            position = opening_book.get_book(path).lookup(board)
+            entry = position.best(position.scaled_weight(20, "max"))
+            if entry is not None:
+                return entry.move
+        return None
+
+    merged = opening_book.get_book(book_path)
+    rng = random.Random(0)
+    for _ in range(20):
+        board = chess.Board()
+        while True:
+            position = merged.lookup(board)
+            entry = position.best(position.scaled_weight(20, "max"))
+            assert (entry.move if entry else None) == sequential_best(board)
+            if not position:
+                break
+            board.push(rng.choice(position.entries).move)
+
+    # Changing a book makes the merged book stale, and merging the books again makes it usable, without a restart.
+    opening_book.write_book(books[0], first[1:])
+    assert opening_book.merged_book(directory, "standard", books, "best_move", 20, "max") is None
+    book_compiler.compile_book(books, directory, "standard", "best_move", 20, "max")
+    assert opening_book.merged_book(directory, "standard", books, "best_move", 20, "max") == book_path
+    assert opening_book.get_book(book_path) is not merged
+    opening_book.close_books()
+
+
+def test_merged_book_moves(tmp_path: Path) -> None:
+    """Test that the bot gets the same book moves from a merged book as from its books one by one."""
+    opening_book.close_books()
+    entries = list(book_compiler.read_entries(BOOK))
+    keys = set(sorted({entry[0] for entry in entries})[::2])
+    first = [(key, move, (weight * 7) % 50, learn) for key, move, weight, learn in entries if key in keys]
+    # Repeat the second best move of the start position, so adding up the weights of a move would make it the best.
+    start_key = chess.polyglot.zobrist_hash(chess.Board())
+    start_entries = sorted((entry for entry in entries if entry[0] == start_key), key=lambda entry: -entry[2])
+    first = [entry for entry in first if entry[0] != start_key]
+    first[:0] = [start_entries[0], start_entries[1], start_entries[1]]
+    first.sort(key=lambda entry: entry[0])
+    books = [str(tmp_path / "first.bin"), str(tmp_path / "second.bin")]
+    opening_book.write_book(books[0], first)
+    opening_book.write_book(books[1], entries)
+
+    game_info: GameEventType = {"id": "zzzzzzzz", "variant": {"key": "standard", "name": "Standard", "short": "Std"},
+                                "speed": "bullet", "perf": {"name": "Bullet"}, "rated": False, "createdAt": 1700000000000,
+                                "white": {"id": "b", "name": "b", "title": "BOT", "rating": 3000},
+                                "black": {"id": "c", "name": "c", "title": None, "rating": 2000},
+                                "initialFen": "startpos", "clock": {"initial": 90000, "increment": 1000},
+                                "type": "gameFull", "state": {"type": "gameState", "moves": "", "wtime": 90000,
+                                                             "btime": 90000, "winc": 1000, "binc": 1000,
+                                                             "status": "started"}}
+    game = model.Game(game_info, "b", "https://lichess.org/", datetime.timedelta(seconds=30))
+    settings: list[tuple[str, opening_book.Normalization]] = [("best_move", "none"), ("best_move", "max"),
+                                                               ("uniform_random", "sum"), ("weighted_random", "none")]
+    for selection, normalization in settings:
+        directory = str(tmp_path / f"{selection}-{normalization}")
+        book_path, _ = book_compiler.compile_book(books, directory, "standard", selection, 20, normalization)
+        assert opening_book.merged_book(directory, "standard", books, selection, 20, normalization) == book_path
+        polyglot = {"enabled": True, "selection": selection, "min_weight": 20, "normalization": normalization,
+                    "max_depth": 20}
+        merged_cfg = config.Configuration({**polyglot, "book": {"standard": list(books)},
+                                           "merged_book_directory": directory})
+        separate_cfg = config.Configuration({**polyglot, "book": {"standard": list(books)},
+                                             "merged_book_directory": None})
+
+        rng = random.Random(0)
+        for _ in range(10):
+            board = chess.Board()
+            while True:
+                random.seed(len(board.move_stack))
+                merged_move = get_book_move(board, game, merged_cfg).move
+                random.seed(len(board.move_stack))
+                assert merged_move == get_book_move(board, game, separate_cfg).move
+                position = opening_book.get_book(books[1]).lookup(board)
+                if not position:
+                    break
+                board.push(rng.choice(position.entries).move)
+    opening_book.close_books()
+
+
+def test_pgn_book(tmp_path: Path) -> None:
+    """Test making a book out of game records."""
+    game_records = []
+    for index, (moves, result) in enumerate([("e2e4 e7e5 g1f3", "1-0"), ("e2e4 c7c5 e1e2", "0-1"), ("d2d4 d7d5", "1/2-1/2"),
+                                             ("e2e4 e7e5 g1f3 b8c6 f1c4 g8f6 e1g1", "1-0"), ("e2e4 e7e5", "*")]):
+        game = chess.pgn.Game({"Event": "Rated game", "White": "bot" if index % 2 == 0 else "human",
+                               "Black": "human" if index % 2 == 0 else "bot", "Result": result})
+        node: chess.pgn.GameNode = game
+        for uci in moves.split():
+            node = node.add_main_variation(chess.Move.from_uci(uci))
+        # The bot's score at the end of a principal variation, as lichess-bot writes it.
+        if moves.startswith("e2e4"):
+            pv_end = game.add_line([chess.Move.from_uci("e2e4"), chess.Move.from_uci("e7e5")])
+            pv_end.set_eval(chess.engine.PovScore(chess.engine.Cp(50), chess.WHITE), 10)
+        game_records.append(str(game))
+    (tmp_path / "all games.pgn").write_text("\n\n".join(game_records[:4]) + "\n\n")
+    (tmp_path / "other.pgn").write_text(game_records[4] + "\n\n")
+
+    chunks = pgn_book.file_chunks([str(tmp_path)], chunk_size=100)
+    start = chess.Board()
+    start_key_e4 = (chess.polyglot.zobrist_hash(start), opening_book.encode_move(start, chess.Move.from_uci("e2e4")))
+    assert len(chunks) == 5
+    games = sum(pgn_book.read_statistics(chunk).get(start_key_e4, [0])[pgn_book.GAMES] for chunk in chunks)
+    assert games == 3
+    statistics = pgn_book.collect_statistics([str(tmp_path)], processes=2)
+
+    e4 = statistics[start_key_e4]
+    assert e4 == [3, 2.0, 150.0, 3]
+    bot_moves = pgn_book.read_statistics((str(tmp_path / "all games.pgn"), 0, (tmp_path / "all games.pgn").stat().st_size),
+                                         player="bot")
+    assert sum(entry[pgn_book.GAMES] for entry in bot_moves.values()) == 2 + 1 + 1 + 3
+
+    book_path = str(tmp_path / "book.bin")
+    opening_book.write_book(book_path, pgn_book.book_entries(statistics))
+    with chess.polyglot.open_reader(book_path) as reader:
+        assert [entry.move for entry in reader.find_all(start)] == [chess.Move.from_uci("e2e4"), chess.Move.from_uci("d2d4")]
+        castling = chess.Board("r1bqkb1r/pppp1ppp/2n2n2/4p3/2B1P3/5N2/PPPP1PPP/RNBQK2R w KQkq - 4 4")
+        assert reader.find(castling).move == chess.Move.from_uci("e1g1")
+        assert reader.find(chess.Board()).weight == round(pgn_book.WEIGHT_SCALE * 3 * pgn_book.move_quality(e4, 0.5))
+
+
+def test_precomputed_book(tmp_path: Path) -> None:
+    """Test searching the opening tree ahead of time."""
+    with open("./config.yml.default") as file:
+        raw_config = yaml.safe_load(file)
+    config.insert_default_values(raw_config)
+    raw_config["engine"]["name"] = "ChessAIEngine"
+    raw_config["engine"]["protocol"] = "homemade"
+    raw_config["engine"]["homemade_options"] = {"go_commands": {"depth": 2}}
+    raw_config["engine"]["polyglot"]["book"]["standard"] = [BOOK]
+    statistics = {(chess.polyglot.zobrist_hash(chess.Board()), opening_book.encode_move(chess.Board(),
+                                                                                        chess.Move.from_uci("b2b3"))):
+                  [5, 3.0, 0.0, 0]}
+
+    results = book_precompute.precompute(config.Configuration(raw_config), depth=2, search_time=5, processes=2,
+                                         book_moves=1, history_move_count=1, statistics=statistics)
+    start = chess.Board()
+    children = {move.uci() for move in book_precompute.candidate_moves(start, None, [BOOK], {}, 1, 0)}
+    assert children == {"e2e4"}
+    after_b3 = start.copy()
+    after_b3.push_uci("b2b3")
+    assert chess.polyglot.zobrist_hash(start) in results
+    assert chess.polyglot.zobrist_hash(after_b3) in results
+    assert 4 <= len(results) <= 1 + 3 + 9
+
+    book_path = str(tmp_path / "precomputed.bin")
+    assert book_precompute.write_precomputed_book(book_path, results) == len(results)
+    with chess.polyglot.open_reader(book_path) as reader:
+        for key, (raw_move, score) in results.items():
+            entries = list(reader.find_all(key))
+            assert [entry.raw_move for entry in entries] == [raw_move]
+            assert opening_book.learn_to_score(entries[0].learn) == score
+        assert reader.find(start).move in start.legal_moves
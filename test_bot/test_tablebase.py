@@ -0,0 +1,68 @@
+"""Test the endgame tablebases that stay open for the life of the process."""
+import datetime
+from pathlib import Path
+import chess
+import pytest
+from lib import model, tablebase
+from lib.config import Configuration
+from lib.engine_wrapper import get_syzygy
+from lib.lichess_types import GameEventType
+
+
+def test_probe_cache() -> None:
+    """Test that probes are cached by position and probe type, and that the oldest result is dropped first."""
+    probed: list[str] = []
+
+    def probe(board: chess.Board) -> int:
+        probed.append(board.fen())
+        if board.king(chess.BLACK) is None:
+            raise KeyError("no table")
+        return len(board.piece_map())
+
+    cache = tablebase.ProbeCache(size=2)
+    kings = chess.Board("8/8/8/4k3/8/8/8/4K3 w - - 0 1")
+    rook = chess.Board("8/8/8/4k3/8/8/8/R3K3 w - - 0 1")
+    assert cache.probe(kings, "wdl", probe) == 2
+    assert cache.probe(kings, "wdl", probe) == 2
+    assert cache.probe(kings, "dtz", probe) == 2
+    assert len(probed) == 2
+    # The half-move clock isn't part of the key, since the tables don't depend on it.
+    assert cache.probe(chess.Board("8/8/8/4k3/8/8/8/4K3 w - - 30 60"), "dtz", probe) == 2
+    assert len(probed) == 2
+
+    assert cache.probe(rook, "wdl", probe) == 3
+    assert len(probed) == 3
+    cache.probe(kings, "wdl", probe)
+    assert len(probed) == 4
+
+    no_king = chess.Board("8/8/8/8/8/8/8/4K3 w - - 0 1")
+    for _ in range(2):
+        with pytest.raises(KeyError):
+            cache.probe(no_king, "wdl", probe)
+    assert len(probed) == 5
+    assert cache.hit_rate() == 3 / 8
+
+
+def test_tablebases_stay_open(tmp_path: Path) -> None:
+    """Test that each set of tablebase directories is opened once, and that a missing table is a missing move."""
+    tablebase.close_tablebases()
+    paths = [str(tmp_path)]
+    syzygy = tablebase.get_syzygy_tablebase(paths)
+    assert tablebase.get_syzygy_tablebase(paths) is syzygy
+    assert tablebase.get_gaviota_tablebase(paths) is tablebase.get_gaviota_tablebase(paths)
+
+    board = chess.Board("8/8/8/4k3/8/8/8/R3K3 w - - 0 1")
+    with pytest.raises(KeyError):
+        syzygy.probe_wdl(board)
+    syzygy_cfg = Configuration({"enabled": True, "paths": paths, "max_pieces": 7, "move_quality": "best"})
+    game_info: GameEventType = {"id": "zzzzzzzz", "variant": {"key": "standard", "name": "Standard", "short": "Std"},
+                                "speed": "bullet", "perf": {"name": "Bullet"}, "rated": False, "createdAt": 1700000000000,
+                                "white": {"id": "c", "name": "c", "title": None, "rating": 2000},
+                                "black": {"id": "b", "name": "b", "title": "BOT", "rating": 3000},
+                                "initialFen": board.fen(), "clock": {"initial": 90000, "increment": 1000},
+                                "type": "gameFull", "state": {"type": "gameState", "moves": "", "wtime": 90000,
+                                                             "btime": 90000, "winc": 1000, "binc": 1000,
+                                                             "status": "started"}}
+    game = model.Game(game_info, "b", "https://lichess.org/", datetime.timedelta(seconds=30))
+    assert get_syzygy(board, game, syzygy_cfg) == (None, -3)
+    tablebase.close_tablebases()